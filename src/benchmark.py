@@ -0,0 +1,108 @@
+import argparse
+import gc
+import multiprocessing
+import socket
+import time
+
+import lib.offload as offload
+from lib.connection import Message
+from lib.constants import MAX_PACKAGE_SIZE, GSO_MAX_SEGMENTS
+from lib.udp import UDPHeader, UDPFlags, unpack_package
+
+RECV_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def receiver(port_queue, result_queue, count, gro, pooled):
+    """Recibe como el servidor: desempaqueta y arma el mensaje de cada paquete."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    sock.bind(("127.0.0.1", 0))
+    if gro:
+        gro = offload.enable_gro(sock)
+    pool = offload.create_pool(sock)
+    port_queue.put(sock.getsockname()[1])
+
+    received = 0
+    start = last = None
+    collections = sum(stat["collections"] for stat in gc.get_stats())
+    while received < count:
+        if pooled:
+            batch = offload.receive_batch(sock, pool)
+        else:
+            data, addr = offload.recv_package(sock)
+            batch = ((addr, data, None),)
+        for addr, data, buffer in batch:
+            if not len(data):
+                break  # Marca de fin del emisor
+            data, header = unpack_package(data, True)
+            Message(header, data, buffer).release()
+            received += 1
+        else:
+            last = time.perf_counter()
+            start = start or last
+            continue
+        break
+    elapsed = last - start if start else 0
+    collections = sum(stat["collections"] for stat in gc.get_stats()) - collections
+    result_queue.put((received, elapsed, gro, collections))
+
+
+def run(count, size, batch, offloaded, pooled):
+    offload.gso_enabled = offloaded
+    port_queue, result_queue = multiprocessing.Queue(), multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=receiver, args=(port_queue, result_queue, count, offloaded, pooled)
+    )
+    process.start()
+    addr = ("127.0.0.1", port_queue.get())
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    header = UDPHeader(1, UDPFlags.DATA, extended=True).pack()
+    packages = [(header, bytes(size - len(header)))] * batch
+    start = time.perf_counter()
+    for _ in range(count // batch):
+        offload.send_packages(sock, packages, addr)
+    sent = time.perf_counter() - start
+    # Datagramas vacios como marca de fin, por si el receptor perdio parte
+    for _ in range(10):
+        time.sleep(0.1)
+        sock.sendto(b"", addr)
+
+    received, elapsed, gro, collections = result_queue.get()
+    process.join()
+    sent_count = count // batch * batch
+    mode = "gso/gro" if offloaded else "sendto/recvfrom"
+    if offloaded and not (offload.gso_enabled and gro):
+        mode += " (sin soporte)"
+    mode += " + pool" if pooled else ""
+    print(
+        f"{mode:>24}: envio {sent_count / sent:>10,.0f} paq/s "
+        f"({sent_count * size / sent / 1e6:,.0f} MB/s) | "
+        f"recepcion {received / elapsed if elapsed else 0:>10,.0f} paq/s "
+        f"({received}/{sent_count} recibidos, {collections} pasadas del GC)"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="Benchmark",
+        description="Compare the UDP send and receive paths on loopback.",
+    )
+    parser.add_argument("-c", "--count", type=int, default=200000, help="datagrams")
+    parser.add_argument(
+        "--size", type=int, default=MAX_PACKAGE_SIZE, help="datagram size in bytes"
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=min(GSO_MAX_SEGMENTS, offload.GRO_BUFFER_SIZE // MAX_PACKAGE_SIZE),
+        help="datagrams per send window",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    for offloaded in (False, True):
+        for pooled in (False, True):
+            run(args.count, args.size, args.batch, offloaded, pooled)
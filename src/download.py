@@ -1,7 +1,10 @@
 import socket
 import sys
 import os
+import random
+import select
 import signal
+import time
 import traceback
 from lib.parser import parse_download_args
 from lib.logger import setup_logger
@@ -17,8 +20,17 @@ from lib.connection import (
     force_send_close,
     connect_server,
 )
+from lib.multicast import open_group_socket, missing_ranges, send_nack
+from lib.offload import enable_gro, has_pending
+from lib.streams import run_streams
 from lib.udp import UDPFlags, UDPHeader
-from lib.constants import MAX_RETRIES, TIMEOUT, TIMEOUT_SACK
+from lib.constants import (
+    MAX_RETRIES,
+    TIMEOUT,
+    MULTICAST_NACK_INTERVAL,
+    MULTICAST_IDLE_TIMEOUT,
+    MULTICAST_RECV_BUFFER,
+)
 
 
 UPLOAD = False
@@ -30,12 +42,16 @@ logger = setup_logger(verbose=args.verbose, quiet=args.quiet)
 # Crear un socket UDP
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 client_socket.settimeout(TIMEOUT)
+enable_gro(client_socket)
 
 connection = Connection(
     addr=(args.host, args.port),
     sequence=0,
     download=DOWNLOAD,
     path=args.name,
+    protocol=args.protocol,
+    fsync=args.fsync,
+    rate=args.rate,
 )
 
 
@@ -45,12 +61,13 @@ def download_stop_and_wait():
 
     while connection.is_active:
         try:
-            addr, header, data = receive_package(client_socket)
-            if header.has_data():
+            client_socket.settimeout(connection.rtt.rto)
+            addr, header, data = receive_package(client_socket, connection)
+            if header.flags & UDPFlags.DATA:
                 # Cuando recibo data exitosamente reseteo el retries
                 connection.retries = 0
                 if header.sequence not in connection.fragments:
-                    connection.fragments[header.sequence] = data
+                    connection.write_fragment(header, data)
                     connection.sequence = header.sequence
                     logger.info(f"Fragmento {header.sequence} recibido del servidor.")
                 else:
@@ -60,19 +77,22 @@ def download_stop_and_wait():
                 logger.info(f"Se envio ACK  {header.sequence}")
 
             # Se recibio por completo el archivo
-            elif header.has_end():
+            elif header.flags & UDPFlags.END:
                 connection.is_active = False
+                if not connection.verify_digest(data):
+                    raise ValueError("Error: Lo descargado no coincide con el archivo")
                 connection.save_file()
 
             # Se cierra conexion desde el servidor
-            elif header.has_close():
+            elif header.flags & UDPFlags.CLOSE:
                 connection.is_active = False
                 if len(data) > 0:
-                    logger.info(f"Cierre del servidor: [{data.decode()}]")
+                    logger.info(f"Cierre del servidor: [{bytes(data).decode()}]")
                     raise ValueError(f"Archivo inexistente en Servidor")
         except ConnectionResetError:
             logger.error("Error: Conexion perdida")
         except socket.timeout:
+            connection.rtt.on_timeout()
             send_ack(client_socket, connection, sequence=connection.sequence)
             logger.warning(f"Reenviando ACK {connection.sequence}")
             if connection.retries > MAX_RETRIES:
@@ -82,70 +102,58 @@ def download_stop_and_wait():
 
 
 def download_with_sack():
-    client_socket.settimeout(TIMEOUT_SACK)
     connection.is_active = True
 
     while connection.is_active:
         try:
-            addr, header, data = receive_package(client_socket)
+            client_socket.settimeout(connection.acks.wait(connection.rtt.rto))
+            addr, header, data = receive_package(client_socket, connection)
+
+            if header.flags & UDPFlags.DATA and header.flags & UDPFlags.SACK:
+                # Paridad FEC: solo se confirma si reconstruyo algo
+                if connection.receive_parity(header, data):
+                    connection.sequence = connection.reassembly.cumulative
+                    send_sack_ack(client_socket, connection)
 
-            if header.has_data():
+            elif header.flags & UDPFlags.DATA:
                 connection.retries = 0
-                if header.sequence not in connection.fragments:
-                    connection.fragments[header.sequence] = data
+                gaps = bool(connection.reassembly.ranges)
+                new = connection.reassembly.add(header.sequence)
+                if new:
+                    connection.write_fragment(header, data)
                     logger.info(f"Fragmento {header.sequence} recibido del servidor.")
-
-                if header.sequence == connection.sequence + 1:
-                    connection.sequence = header.sequence
-                    send_sack_ack(client_socket, connection, connection.sequence)
-                    connection.received_out_of_order.sort()
-                    received_out_of_order = list(connection.received_out_of_order)
-                    for i in received_out_of_order:
-                        logger.info(f"Recibidos: , {received_out_of_order},  i: , {i}")
-                        if i == connection.sequence + 1:
-                            connection.sequence = i
-                            send_sack_ack(
-                                client_socket, connection, connection.sequence
-                            )
-                            connection.received_out_of_order.remove(i)
-                        else:
-                            break
-
-                elif header.sequence > connection.sequence + 1:
-                    logger.warning(
-                        f"Fragmento {header.sequence} recibido fuera de orden."
-                    )
-                    if header.sequence not in connection.received_out_of_order:
-                        connection.received_out_of_order.append(header.sequence)
-
-                send_sack_ack(
-                    client_socket,
-                    connection,
-                    connection.sequence,
-                    connection.received_out_of_order,
-                )
+                    if header.sequence > connection.reassembly.cumulative:
+                        logger.warning(
+                            f"Fragmento {header.sequence} recibido fuera de orden."
+                        )
+                connection.sequence = connection.reassembly.cumulative
+
+                gaps = gaps or bool(connection.reassembly.ranges)
+                if connection.acks.on_data(immediate=gaps or not new):
+                    send_sack_ack(client_socket, connection)
                 # time.sleep(0.05)
 
-            elif header.has_end():
+            elif header.flags & UDPFlags.END:
                 connection.is_active = False
-                if len(connection.fragments) > 1:
-                    connection.save_file()
-                    logger.info("Archivo recibido completamente.")
+                if not connection.verify_digest(data):
+                    raise ValueError("Error: Lo descargado no coincide con el archivo")
+                connection.save_file()
+                logger.info(f"Archivo recibido completamente. ACK:DATA {connection.acks}")
 
-            elif header.has_close():
+            elif header.flags & UDPFlags.CLOSE:
                 connection.is_active = False
                 if data:
-                    logger.warning(f"Cierre del servidor: [{data.decode()}]")
+                    logger.warning(f"Cierre del servidor: [{bytes(data).decode()}]")
                     raise ValueError("Archivo inexistente en Servidor")
 
         except socket.timeout:
+            if connection.acks.due():
+                # Vencio el ACK demorado, no el timeout
+                send_sack_ack(client_socket, connection)
+                continue
             # Manejo de tiempo de espera: reenviar el último SACK
-            send_sack_ack(
-                client_socket,
-                connection,
-                connection.sequence,
-                connection.received_out_of_order,
-            )
+            connection.rtt.on_timeout()
+            send_sack_ack(client_socket, connection)
             if connection.retries > MAX_RETRIES:
                 connection.is_active = False
                 return False
@@ -154,9 +162,86 @@ def download_with_sack():
     return True
 
 
+def download_multicast():
+    """Recibe el archivo de la distribucion multicast del servidor.
+
+    Los DATA llegan por el grupo (o por este socket si el servidor lo emula)
+    y solo se aceptan del socket de la sesion. Cada MULTICAST_NACK_INTERVAL,
+    con una espera al azar para que los receptores no pidan todos a la vez, se
+    piden los huecos hasta el mayor fragmento recibido, y tambien el final si
+    hace un intervalo que no llega nada. Con todo recibido se avisa hasta que
+    llega el END.
+    """
+    connection.is_active = True
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MULTICAST_RECV_BUFFER)
+    group_socket = open_group_socket(connection)
+    sockets = [client_socket] + ([group_socket] if group_socket else [])
+    source = int(connection.options["msrc"])
+    total = -(-int(connection.options["size"]) // connection.fragment_size)
+    received = connection.reassembly
+    received.window = total  # Se suma a mitad del envio: llega en cualquier orden
+    highest = 0  # Mayor fragmento recibido
+    last_heard = last_data = time.monotonic()
+    next_nack = last_data + MULTICAST_NACK_INTERVAL
+    logger.info(f"Recibiendo {total} fragmentos por multicast ({connection.options['mcast']})")
+
+    try:
+        while connection.is_active:
+            ready = [sock for sock in sockets if has_pending(sock)]
+            if not ready:
+                timeout = max(next_nack - time.monotonic(), 0)
+                ready = select.select(sockets, [], [], timeout)[0]
+            now = time.monotonic()
+            for sock in ready:
+                addr, header, data = receive_package(sock, connection)
+                if header.flags & UDPFlags.DATA:
+                    if addr[1] != source or not 1 <= header.sequence <= total:
+                        continue  # Otra sesion en el mismo grupo
+                    last_heard = last_data = now
+                    if received.add(header.sequence):
+                        connection.write_fragment(header, data)
+                        highest = max(highest, header.sequence)
+                    connection.sequence = received.cumulative
+
+                elif header.flags & UDPFlags.END:
+                    connection.is_active = False
+                    if not connection.verify_digest(data):
+                        raise ValueError("Error: Lo descargado no coincide con el archivo")
+                    connection.save_file()
+                    break
+
+                elif header.flags & UDPFlags.CLOSE:
+                    connection.is_active = False
+                    if data:
+                        logger.warning(f"Cierre del servidor: [{bytes(data).decode()}]")
+                        raise ValueError("Archivo inexistente en Servidor")
+                    break
+
+            if not connection.is_active or now < next_nack:
+                continue
+            if now - last_heard > MULTICAST_IDLE_TIMEOUT:
+                logger.error("Error: El servidor dejo de enviar")
+                return False
+            # Sin DATA durante un intervalo el final tambien falta
+            last = total if now - last_data >= MULTICAST_NACK_INTERVAL else highest
+            ranges = missing_ranges(received, last)
+            if ranges or received.cumulative == total:
+                send_nack(client_socket, connection, ranges)
+                if ranges:
+                    logger.debug(f"NACK de {len(ranges)} rangos desde {ranges[0][0]}")
+            next_nack = now + MULTICAST_NACK_INTERVAL * (1 + random.random())
+    finally:
+        if group_socket is not None:
+            group_socket.close()
+    return True
+
+
 def handle_download():
     connection.path = f"{args.dst}/{args.name}"
-    if args.protocol == "stop_and_wait":
+    connection.open_file()
+    if connection.options.get("mcast"):
+        download_multicast()
+    elif args.protocol == "stop_and_wait":
         download_stop_and_wait()
     elif args.protocol == "sack":
         download_with_sack()
@@ -189,9 +274,16 @@ def setup_signal_handling():
 
 
 if __name__ == "__main__":
+    if args.streams > 1 and args.stream is None and not args.multicast:
+        sys.exit(0 if run_streams(args) else 1)
     setup_signal_handling()
     try:
-        if connect_server(client_socket, connection, DOWNLOAD, args):
+        extra = {"sig": 1} if args.signature else None
+        if args.chunk_missing:
+            extra = {"missing": args.chunk_missing}
+        elif args.multicast:
+            extra = {"mcast": 1}
+        if connect_server(client_socket, connection, DOWNLOAD, args, extra):
             handle_download()
     except ValueError as e:
         logger.error(e)
@@ -201,3 +293,5 @@ if __name__ == "__main__":
     finally:
         close_connection(client_socket, connection)
         client_socket.close()
+        connection.release_fragments()
+    sys.exit(0 if getattr(connection.fragments, "committed", False) else 1)
@@ -0,0 +1,55 @@
+import time
+
+from lib.constants import MIN_WAIT
+
+
+class AckPolicy:
+    """Cuando confirma el receptor SACK los DATA que recibe.
+
+    Se manda un ACK cada ``every`` paquetes o, si no se llega, cuando vence
+    ``delay`` segundos desde el primero sin confirmar. Los duplicados y lo que
+    llega con huecos pendientes se confirman enseguida, para que el emisor
+    detecte la perdida sin esperar. Con ``every=1`` se confirma cada paquete,
+    que es lo que esperan los extremos que no negocian la opcion.
+    """
+
+    def __init__(self, every=1, delay=0.0):
+        self.every = max(every, 1)
+        self.delay = delay
+        self.pending = 0  # DATA recibidos desde el ultimo ACK
+        self.deadline = None
+        self.data_packets = 0
+        self.acks_sent = 0
+
+    def __str__(self):
+        return f"{self.acks_sent}/{self.data_packets} ({self.ratio:.2f})"
+
+    @property
+    def ratio(self):
+        """ACKs enviados por cada DATA recibido."""
+        return self.acks_sent / self.data_packets if self.data_packets else 0.0
+
+    def on_data(self, immediate=False):
+        """Registra un DATA recibido. Devuelve True si hay que confirmar ya."""
+        self.data_packets += 1
+        self.pending += 1
+        if immediate or self.pending >= self.every or self.delay <= 0:
+            return True
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.delay
+        return False
+
+    def on_ack_sent(self):
+        self.acks_sent += 1
+        self.pending = 0
+        self.deadline = None
+
+    def due(self):
+        """Hay DATA sin confirmar y ya vencio la espera."""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def wait(self, timeout):
+        """Acota ``timeout`` (segundos) al vencimiento del ACK demorado."""
+        if self.deadline is None:
+            return timeout
+        return max(min(timeout, self.deadline - time.monotonic()), MIN_WAIT)
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+
+from lib.connection import StopAndWaitSession, SackSession
+from lib.constants import WRITE_QUEUE_SIZE
+from lib.udp import UDPFlags
+
+logger = logging.getLogger("app_logger")
+
+
+class AsyncConnection:
+    """Alimenta una sesion desde el event loop, sin hilo ni cola propios.
+
+    Los mensajes se procesan apenas llegan y la espera de la sesion es un unico
+    timer del loop, que solo se reprograma cuando el nuevo vencimiento es
+    anterior al que ya estaba armado.
+
+    Lo que espera al disco corre en el executor del loop: preparar el archivo
+    al arrancar (armarlo desde el chunk store, firmarlo, abrir el temporal),
+    pasar a la cola del escritor los fragmentos que no entraron (el
+    FragmentSink no bloquea), el digest del END y el cierre del archivo. Si el backlog de escritura llega
+    a WRITE_QUEUE_SIZE los DATA se descartan como si se hubieran perdido y el
+    emisor los reenvia.
+    """
+
+    blocking_writes = False
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.timer = None
+        self.deadline = None
+        self.started = False
+        self.flushing = False  # Hay un flush del FragmentSink en el executor
+        self.waiting = None  # Tarea del executor que la sesion espera
+        self.released = False
+
+    def activate(self):
+        """Arranca la transferencia al confirmarse el START (una sola vez)."""
+        if self.is_active or self.started:
+            return
+        self.is_active = True
+        self.started = True
+        # La sesion queda en pausa hasta que el archivo este listo
+        self.waiting = self.loop.run_in_executor(None, self.prepare_transfer)
+        self.waiting.add_done_callback(
+            lambda future: self._run(self._prepared, future)
+        )
+
+    def _prepared(self, future):
+        self.waiting = None
+        future.result()
+        if self.is_active:  # Si no, se cerro mientras se preparaba
+            self.begin_transfer()
+
+    def stop(self):
+        self.is_active = False
+        self._finish()
+
+    def put_message(self, message):
+        self.rtt.on_receive(message.header)
+        if self.is_active and self.waiting is None and self._accepts(message):
+            self._run(self.handle_message, message)
+        message.release()
+
+    def send_end_confirmation(self, digest=b""):
+        if not self.verify or self.digest is not None:
+            super().send_end_confirmation(digest)
+            return
+        # El digest espera al hilo escritor: la sesion queda en pausa mientras
+        self.waiting = self.loop.run_in_executor(None, self.fragments.finish_digest)
+        self.waiting.add_done_callback(
+            lambda future: self._run(self._end_digest, future, digest)
+        )
+
+    def _end_digest(self, future, digest):
+        self.waiting = None
+        self.digest = future.result()
+        if self.is_active:  # Si no, se cerro mientras se calculaba
+            super().send_end_confirmation(digest)
+
+    def save_file(self):
+        # El fsync y el rename corren fuera del loop para no frenar al resto
+        sink = self.fragments
+        self.fragments = {}
+        future = self.loop.run_in_executor(None, self.commit_file, sink)
+        future.add_done_callback(self._file_saved)
+
+    def _file_saved(self, future):
+        if future.exception() is not None:
+            logger.error(f"Error guardando {self.path}: {future.exception()}")
+        elif future.result():
+            logger.info(f"Archivo guardado en {self.path}")
+
+    def _accepts(self, message):
+        backlog = getattr(self.fragments, "backlog", 0)
+        if backlog < WRITE_QUEUE_SIZE or not message.header.flags & UDPFlags.DATA:
+            return True
+        logger.debug(f"Escritura atrasada, se descarta el DATA de {self.addr}")
+        return False
+
+    def _flush(self):
+        sink = self.fragments
+        if self.flushing or not getattr(sink, "backlog", 0):
+            return
+        self.flushing = True
+        future = self.loop.run_in_executor(None, sink.flush)
+        future.add_done_callback(self._flushed)
+
+    def _flushed(self, future):
+        self.flushing = False
+        if future.exception() is not None:
+            logger.error(f"Error escribiendo {self.path}: {future.exception()}")
+            return
+        self._flush()  # Lo que llego mientras tanto
+
+    def _on_timer(self):
+        self.timer = None
+        if not self.is_active or self.waiting is not None:
+            return
+        if self.loop.time() < self.deadline:
+            self.timer = self.loop.call_at(self.deadline, self._on_timer)
+            return
+        self._run(self.handle_timeout)
+
+    def _run(self, handler, *args):
+        try:
+            handler(*args)
+        except Exception as e:
+            logger.error(f"Error con {self.addr}: {e}")
+            self.is_active = False
+            self.waiting = None
+
+        self._flush()
+        if not self.is_active:
+            self._finish()
+        elif self.waiting is None:
+            self._schedule()
+
+    def _schedule(self):
+        self.deadline = self.loop.time() + self.next_timeout()
+        if self.timer is not None and self.timer.when() <= self.deadline:
+            return  # Al vencer se vuelve a armar hasta el nuevo deadline
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_at(self.deadline, self._on_timer)
+
+    def _finish(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.released or self.waiting is not None:
+            return  # Se libera al terminar lo que se espera
+        self.released = True
+        # Cerrar el FragmentSink espera al hilo escritor
+        future = self.loop.run_in_executor(None, self.release_fragments)
+        future.add_done_callback(self._fragments_released)
+
+    def _fragments_released(self, future):
+        if future.exception() is not None:
+            logger.error(f"Error liberando {self.path}: {future.exception()}")
+
+
+class AsyncClientConnection(AsyncConnection, StopAndWaitSession):
+    def __init__(self, socket, addr, path, **kwargs):
+        StopAndWaitSession.__init__(self, socket, addr, path, **kwargs)
+        AsyncConnection.__init__(self)
+
+
+class AsyncClientConnectionSACK(AsyncConnection, SackSession):
+    def __init__(self, socket, addr, path, **kwargs):
+        SackSession.__init__(self, socket, addr, path, **kwargs)
+        AsyncConnection.__init__(self)
+
+
+class DatagramServer(asyncio.DatagramProtocol):
+    """Entrega cada datagrama recibido a ``handle_package(transport, addr, data)``."""
+
+    def __init__(self, handle_package):
+        self.handle_package = handle_package
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.handle_package(self.transport, addr, data)
+
+    def error_received(self, exc):
+        logger.error(f"Error en el socket del servidor: {exc}")
+
+
+async def serve(server_socket, handle_package):
+    """Atiende todas las conexiones en un unico event loop sobre ``server_socket``."""
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DatagramServer(handle_package), sock=server_socket
+    )
+    try:
+        await loop.create_future()
+    finally:
+        transport.close()
@@ -0,0 +1,135 @@
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+from lib.constants import FILE_CACHE_HISTORY
+
+logger = logging.getLogger("app_logger")
+
+
+class FileCache:
+    """Cache del servidor con el contenido de los archivos mas descargados.
+
+    Cada archivo se carga una sola vez y todas las descargas que lo piden
+    envian vistas de solo lectura sobre el mismo contenido (ver el ``data``
+    de FragmentSource). Solo entra un archivo pedido por segunda vez (o
+    mientras otra descarga lo envia): la primera descarga se hace desde el
+    disco como siempre, asi un archivo pedido una sola vez no ocupa memoria
+    ni espera a leerse entero. La clave es la ruta con la fecha de
+    modificacion, el tamano y el inodo, asi que un archivo reemplazado nunca
+    se sirve de una version vieja, aunque lo haya subido otro proceso; un
+    upload ademas lo invalida para liberar la memoria enseguida.
+
+    Se desalojan los archivos usados hace mas tiempo hasta que el total entra
+    en ``budget`` bytes. El total cuenta el tamano de cada archivo y no la
+    memoria residente: un archivo comun es un mapeo de solo lectura, cuyas
+    paginas son las del page cache y el sistema las descarta cuando le hace
+    falta, y solo lo armado desde el chunk store es una copia en memoria
+    (``memory``). ``budget`` acota entonces los bytes mapeados mas los
+    copiados, no la RAM del proceso. Un archivo desalojado sigue vivo mientras lo este
+    enviando alguna descarga, pero ya no se le entrega a las nuevas. Con el
+    motor de hilos, si varias descargas piden a la vez un archivo que no
+    esta, lo lee la primera y las demas la esperan.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0  # Bytes en la cache, mapeados o copiados
+        self.memory = 0  # De esos, los copiados en memoria
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # (ruta, mtime, tamano, inodo) -> contenido
+        self._seen = OrderedDict()  # Claves pedidas una vez, aun sin cargar
+        self._loading = {}  # Clave -> Event de la lectura en curso
+        self._lock = threading.Lock()
+
+    def get(self, path, size, load):
+        """Contenido de ``path``, que ocupa ``size`` bytes en memoria y se
+        lee con ``load(path)`` si no esta. None si no entra en la cache o si
+        es la primera vez que se pide."""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        while True:
+            with self._lock:
+                data = self._entries.get(key)
+                if data is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+                loading = self._loading.get(key)
+                if loading is None:
+                    self.misses += 1
+                    if size > self.budget or not self._admit(key):
+                        return None
+                    loading = self._loading[key] = threading.Event()
+                    break
+            loading.wait()
+
+        try:
+            data = load(path)
+            with self._lock:
+                self._remove(path)  # Versiones anteriores del archivo
+                self._entries[key] = data
+                self._account(data, 1)
+                while self.size > self.budget:
+                    self._evict()
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        logger.info(f"Cache: {path} cargado ({len(data)} bytes). {self.summary()}")
+        return data
+
+    def invalidate(self, path):
+        """Saca de la cache todas las versiones de ``path``."""
+        with self._lock:
+            self._remove(path)
+
+    def summary(self):
+        requests = self.hits + self.misses
+        ratio = self.hits / requests if requests else 0.0
+        return (
+            f"Cache de archivos: {self.hits} hits, {self.misses} misses "
+            f"({ratio:.0%} de aciertos), {self.evictions} desalojos, "
+            f"{len(self._entries)} archivos en {self.size} de {self.budget} bytes "
+            f"({self.memory} copiados en memoria, el resto mapeado)"
+        )
+
+    def _account(self, data, sign):
+        self.size += sign * len(data)
+        if not isinstance(data, mmap.mmap):
+            self.memory += sign * len(data)
+
+    def _admit(self, key):
+        if self._seen.pop(key, None) is not None:
+            return True
+        self._remember(key)
+        return False
+
+    def _remember(self, key):
+        self._seen[key] = True
+        if len(self._seen) > FILE_CACHE_HISTORY:
+            self._seen.popitem(last=False)
+
+    def _remove(self, path):
+        for key in [key for key in self._entries if key[0] == path]:
+            self._account(self._entries.pop(key), -1)
+
+    def _evict(self):
+        key, data = self._entries.popitem(last=False)
+        self._account(data, -1)
+        self.evictions += 1
+        self._remember(key)  # Ya se pidio varias veces: vuelve a entrar al pedirlo
+        logger.debug(f"Cache: se desaloja {key[0]} ({len(data)} bytes)")
+
+
+def read_file(path):
+    """Mapeo de solo lectura del archivo: comparte el page cache en vez de
+    copiarlo, y se lee del disco a medida que se envia."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
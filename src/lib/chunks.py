@@ -0,0 +1,365 @@
+import hashlib
+import logging
+import mmap
+import os
+import secrets
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+
+from lib.constants import CHUNK_MIN_SIZE, CHUNK_MAX_SIZE, CHUNK_MARKER_BITS
+from lib.fragments import resume_token
+
+logger = logging.getLogger("app_logger")
+
+# Chunk store del servidor (--chunk-store): cada archivo se parte en chunks
+# definidos por su contenido, que se guardan una sola vez bajo su hash en
+# ``<storage>/.chunks``, y en lugar del archivo queda su manifiesto (la lista
+# de hashes). Un upload con --dedup va en tres pasos, cada uno una
+# transferencia comun con una opcion del START que lleva el token del archivo:
+#   1. ``manifest``: el cliente sube el manifiesto de su archivo, que el
+#      servidor deja pendiente junto al destino.
+#   2. ``missing``: el cliente baja la lista de los hashes de ese manifiesto
+#      que el servidor no tiene.
+#   3. ``chunks``: el cliente sube un paquete con solo esos chunks; el
+#      servidor los verifica, los guarda y el manifiesto pasa a ser el archivo.
+
+DEDUP_STEPS = ("manifest", "missing", "chunks")
+PENDING_SUFFIX = {"manifest": "manifest", "chunks": "pack"}  # Pasos que suben algo
+MANIFEST_MAGIC = b"FTCHUNK1"
+MANIFEST_HEADER = struct.Struct("!8sQ")  # Magic y tamano del archivo
+CHUNK_ENTRY = struct.Struct("!16sI")  # Hash y tamano de un chunk
+HASH_SIZE = 16
+COPY_CHUNKS = 64  # Chunks por escritura al armar un archivo
+SCAN_SIZE = 4 * 1024 * 1024  # Bytes que se mezclan de una vez al buscar cortes
+
+# Constantes de la mezcla: fijas, porque cliente y servidor tienen que cortar
+# igual. El multiplicador es impar y de 128 bits; la tabla tiene la mitad de
+# los bytes en 1.
+_MULTIPLIER = int.from_bytes(
+    hashlib.blake2b(b"file_transfer chunks", digest_size=16).digest(), "little"
+) | 1 | (1 << 127)
+_MULTIPLIER_SIZE = 16
+_ORDER = hashlib.shake_128(b"file_transfer chunk bits").digest(512)
+_RANKS = sorted(range(256), key=lambda b: _ORDER[2 * b : 2 * b + 2])
+_BITS = bytes(int(_RANKS.index(b) < 128) for b in range(256))
+_MARKER = b"\x01" * CHUNK_MARKER_BITS
+
+
+def chunk_boundaries(data):
+    """Offsets donde termina cada chunk de ``data``.
+
+    Un chunk se corta despues de CHUNK_MARKER_BITS bytes seguidos cuyo bit
+    (ver _mix) vale 1, entre CHUNK_MIN_SIZE y CHUNK_MAX_SIZE bytes de su
+    comienzo. Ese bit depende solo de los bytes cercanos, asi que insertar o
+    borrar algo mueve los cortes de alrededor y el resto de los chunks se
+    repite tal cual. En vez de rodar un hash byte a byte, que en Python va a
+    pocos MB/s, se calculan todos los bits de un tramo con una multiplicacion
+    de enteros grandes y un ``bytes.translate``, y la marca se busca con
+    ``bytes.find``.
+    """
+    size = len(data)
+    cuts = []
+    start, bits = 0, b""  # Tramo ya mezclado
+    pos = 0
+    while pos < size:
+        end = min(pos + CHUNK_MAX_SIZE, size)
+        if end - pos <= CHUNK_MIN_SIZE:
+            cut = end
+        else:
+            first = pos + CHUNK_MIN_SIZE - len(_MARKER)
+            if first < start or end > start + len(bits):
+                start = max(first - _MULTIPLIER_SIZE, 0)
+                bits = _mix(data[start : min(start + SCAN_SIZE, size)])
+            found = bits.find(_MARKER, first - start, end - start)
+            cut = end if found < 0 else start + found + len(_MARKER)
+        cuts.append(cut)
+        pos = cut
+    return cuts
+
+
+def chunk_file(path):
+    """``(size, chunks)`` de ``path``, con ``chunks`` la lista de
+    ``(hash, offset, tamano)`` de cada chunk."""
+    with open(path, "rb") as source:
+        size = os.fstat(source.fileno()).st_size
+        if size == 0:
+            return 0, []
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            chunks, offset = [], 0
+            for cut in chunk_boundaries(view):
+                chunks.append((chunk_hash(view[offset:cut]), offset, cut - offset))
+                offset = cut
+            view.release()
+    return size, chunks
+
+
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=HASH_SIZE).digest()
+
+
+def write_manifest(path, size, chunks):
+    """Escribe el manifiesto de un archivo de ``size`` bytes partido en
+    ``chunks`` (pares o ternas que empiezan por hash y terminan por tamano)."""
+    with open(path, "wb") as manifest:
+        manifest.write(MANIFEST_HEADER.pack(MANIFEST_MAGIC, size))
+        for chunk in chunks:
+            manifest.write(CHUNK_ENTRY.pack(chunk[0], chunk[-1]))
+
+
+def read_manifest(path):
+    """``(size, chunks)`` de un manifiesto, con ``chunks`` la lista de
+    ``(hash, tamano)``."""
+    with open(path, "rb") as manifest:
+        data = manifest.read()
+    if len(data) < MANIFEST_HEADER.size:
+        raise ValueError(f"Manifiesto invalido: {path}")
+    magic, size = MANIFEST_HEADER.unpack_from(data)
+    entries = data[MANIFEST_HEADER.size :]
+    if magic != MANIFEST_MAGIC or len(entries) % CHUNK_ENTRY.size:
+        raise ValueError(f"Manifiesto invalido: {path}")
+    chunks = list(CHUNK_ENTRY.iter_unpack(entries))
+    if sum(length for _, length in chunks) != size:
+        raise ValueError(f"Manifiesto invalido: {path}")
+    return size, chunks
+
+
+def is_manifest(path):
+    with open(path, "rb") as f:
+        return f.read(len(MANIFEST_MAGIC)) == MANIFEST_MAGIC
+
+
+def dedup_path(path, step, token):
+    """Donde el servidor recibe lo que se sube en el paso ``step`` de un
+    upload con dedup de ``path``."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{token}.{PENDING_SUFFIX[step]}")
+
+
+class ChunkStore:
+    """Chunks guardados por hash en ``<storage>/.chunks/<hh>/<hash>``.
+
+    Un chunk se escribe en un temporal y se mueve a su lugar de forma atomica,
+    asi que cualquier chunk que exista esta completo, aunque lo escriban dos
+    conexiones a la vez. Los chunks no se borran cuando se pisa el archivo
+    que los usaba: otro archivo puede compartirlos.
+    """
+
+    def __init__(self, storage):
+        self.root = os.path.join(storage, ".chunks")
+
+    def chunk_path(self, key):
+        name = key.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def has(self, key):
+        return os.path.exists(self.chunk_path(key))
+
+    def put(self, key, data, fsync=True):
+        """Guarda el chunk ``data`` si no se tenia. Devuelve True si era nuevo."""
+        path = self.chunk_path(key)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, "wb") as chunk:
+                chunk.write(data)
+                if fsync:
+                    chunk.flush()
+                    os.fsync(chunk.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            _remove(temp_path)
+            raise
+        return True
+
+    def get(self, key):
+        with open(self.chunk_path(key), "rb") as chunk:
+            return chunk.read()
+
+    def store_file(self, path, fsync=True):
+        """Pasa al store los chunks de ``path`` y deja en su lugar el
+        manifiesto (es lo que se hace con un upload comun)."""
+        size, chunks = chunk_file(path)
+        added = stored = 0
+        with open(path, "rb") as source:
+            for key, offset, length in chunks:
+                source.seek(offset)
+                if self.put(key, source.read(length), fsync):
+                    added += 1
+                    stored += length
+        self._replace_with_manifest(path, size, chunks, fsync)
+        logger.info(
+            f"Chunk store: {path} en {len(chunks)} chunks, {added} nuevos "
+            f"({stored} de {size} bytes)"
+        )
+
+    def write_missing(self, manifest_path):
+        """Escribe en un temporal los hashes del manifiesto ``manifest_path``
+        que no estan en el store y devuelve su ruta."""
+        _, chunks = read_manifest(manifest_path)
+        missing = dict.fromkeys(key for key, _ in chunks if not self.has(key))
+        directory, name = os.path.split(manifest_path)
+        fd, missing_path = tempfile.mkstemp(
+            dir=directory or ".", prefix=f"{name}.", suffix=".missing"
+        )
+        with os.fdopen(fd, "wb") as out:
+            out.write(b"".join(missing))
+        logger.info(f"Chunk store: faltan {len(missing)} de {len(chunks)} chunks")
+        return missing_path
+
+    def commit_pack(self, path, pack_path, manifest_path, fsync=True):
+        """Guarda los chunks del paquete ``pack_path`` (cada uno precedido
+        por su CHUNK_ENTRY) y, si con ellos estan todos los del manifiesto
+        pendiente, lo mueve a ``path``."""
+        try:
+            with open(pack_path, "rb") as pack:
+                while entry := pack.read(CHUNK_ENTRY.size):
+                    if len(entry) != CHUNK_ENTRY.size:
+                        raise ValueError("Paquete de chunks truncado")
+                    key, length = CHUNK_ENTRY.unpack(entry)
+                    data = pack.read(length)
+                    if len(data) != length or chunk_hash(data) != key:
+                        raise ValueError(f"Chunk {key.hex()} invalido en el paquete")
+                    self.put(key, data, fsync)
+        finally:
+            _remove(pack_path)
+        size, chunks = read_manifest(manifest_path)
+        missing = sum(1 for key, _ in chunks if not self.has(key))
+        if missing:
+            raise ValueError(f"Faltan {missing} chunks de {path}")
+        os.replace(manifest_path, path)
+
+    def assemble(self, path):
+        """Arma en un temporal el archivo cuyo manifiesto es ``path`` y
+        devuelve su ruta."""
+        size, chunks = read_manifest(path)
+        directory, name = os.path.split(path)
+        fd, temp_path = tempfile.mkstemp(
+            dir=directory or ".", prefix=f".{name}.", suffix=".assembled"
+        )
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for start in range(0, len(chunks), COPY_CHUNKS):
+                    batch = chunks[start : start + COPY_CHUNKS]
+                    out.write(b"".join(self._read(*chunk) for chunk in batch))
+        except BaseException:
+            _remove(temp_path)
+            raise
+        return temp_path
+
+    def read_file(self, path):
+        """Contenido del archivo cuyo manifiesto es ``path``, en memoria."""
+        _, chunks = read_manifest(path)
+        return b"".join(self._read(*chunk) for chunk in chunks)
+
+    def _read(self, key, length):
+        data = self.get(key)
+        if len(data) != length:
+            raise ValueError(f"Chunk {key.hex()} de tamano inesperado")
+        return data
+
+    def _replace_with_manifest(self, path, size, chunks, fsync):
+        directory, name = os.path.split(path)
+        fd, temp_path = tempfile.mkstemp(
+            dir=directory or ".", prefix=f".{name}.", suffix=".manifest"
+        )
+        os.close(fd)
+        try:
+            os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+            write_manifest(temp_path, size, chunks)
+            if fsync:
+                with open(temp_path, "rb") as manifest:
+                    os.fsync(manifest.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            _remove(temp_path)
+            raise
+
+
+def prepare_dedup(args):
+    """Hace los dos primeros pasos de un upload con dedup de ``args.src`` y
+    arma el paquete con los chunks que le faltan al servidor.
+
+    Devuelve ``(token, path)``, con el token del archivo y el paquete (ver
+    discard_dedup), o None si el servidor no tiene chunk store.
+    """
+    directory = tempfile.mkdtemp(prefix="dedup-")
+    manifest = os.path.join(directory, "manifest")
+    token = resume_token(args.src)
+    size, chunks = chunk_file(args.src)
+    write_manifest(manifest, size, chunks)
+    missing_dir = os.path.join(directory, "missing")
+    uploaded = _run_client(args, "upload.py", "-s", manifest, "--chunk-manifest", token)
+    if not uploaded or not _run_client(
+        args, "download.py", "-d", missing_dir, "--chunk-missing", token
+    ):
+        logger.info("El servidor no tiene chunk store, se sube el archivo entero")
+        shutil.rmtree(directory)
+        return None
+    with open(os.path.join(missing_dir, args.name), "rb") as f:
+        data = f.read()
+    missing = {data[i : i + HASH_SIZE] for i in range(0, len(data), HASH_SIZE)}
+
+    path = os.path.join(directory, "pack")
+    sent = set()
+    with open(args.src, "rb") as source, open(path, "wb") as pack:
+        for key, offset, length in chunks:
+            if key in missing and key not in sent:
+                sent.add(key)
+                source.seek(offset)
+                pack.write(CHUNK_ENTRY.pack(key, length))
+                pack.write(source.read(length))
+    logger.info(
+        f"Dedup: {len(chunks) - len(missing)} de {len(chunks)} chunks ya estan en "
+        f"el servidor, se suben {len(missing)} ({os.path.getsize(path)} bytes)"
+    )
+    return token, path
+
+
+def discard_dedup(path):
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def _run_client(args, script, *options):
+    """Corre ``script`` (upload.py o download.py) contra el mismo servidor y
+    archivo. Devuelve True si termino bien."""
+    script = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), script)
+    command = [
+        sys.executable,
+        script,
+        "-H",
+        args.host,
+        "-p",
+        str(args.port),
+        "-n",
+        args.name,
+        "-P",
+        args.protocol,
+        *options,
+        "--no-resume",
+        "-q",
+    ]
+    return subprocess.run(command).returncode == 0
+
+
+def _mix(data):
+    """Un bit por byte de ``data`` que depende de ese byte y los 15 anteriores:
+    el producto por _MULTIPLIER mezcla cada byte con los previos (el acarreo
+    rara vez llega mas lejos) y _BITS se queda con un bit de cada resultado."""
+    size = len(data)
+    value = int.from_bytes(data, "little") * _MULTIPLIER
+    return value.to_bytes(size + _MULTIPLIER_SIZE, "little")[:size].translate(_BITS)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
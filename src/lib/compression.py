@@ -0,0 +1,152 @@
+import logging
+import lzma
+import time
+import zlib
+
+from lib.constants import (
+    ZLIB_LEVEL,
+    LZMA_PRESET,
+    COMPRESSION_SAMPLE,
+    COMPRESSION_MIN_SAVING,
+    COMPRESSION_BACKOFF,
+    COMPRESSION_MAX_BACKOFF,
+    COMPRESSION_CACHE,
+)
+
+logger = logging.getLogger("app_logger")
+
+# Compresion por fragmento que se negocia en el START con ``comp=<codec>``.
+# Cada fragmento se comprime por separado (sin header ni checksum, que ya
+# estan en UDP), asi se puede perder, llegar desordenado y escribirse en su
+# offset como siempre. El codec de cada DATA viaja en el campo sack del header,
+# que los DATA no usan: 0 es un fragmento sin comprimir.
+
+RAW = 0
+CODEC_IDS = {"zlib": 1, "lzma": 2}
+CODECS = tuple(CODEC_IDS)
+# Los fragmentos no pasan de 64 KiB: un diccionario mayor solo gasta memoria
+LZMA_FILTERS = [
+    {"id": lzma.FILTER_LZMA2, "preset": LZMA_PRESET, "dict_size": 64 * 1024}
+]
+
+
+class FragmentCompression:
+    """Compresion de los fragmentos de una conexion y sus metricas.
+
+    El emisor comprime de a muestras de COMPRESSION_SAMPLE fragmentos y si una
+    muestra no ahorra al menos COMPRESSION_MIN_SAVING deja de comprimir por un
+    tiempo (que se duplica mientras siga sin servir), asi no se gasta CPU en
+    archivos ya comprimidos. Un fragmento que no achica viaja sin comprimir.
+    Los ultimos fragmentos enviados se recuerdan para que una retransmision
+    no se vuelva a comprimir.
+    """
+
+    def __init__(self, codec):
+        if codec not in CODEC_IDS:
+            raise ValueError(f"Compresion no soportada: {codec}")
+        self.codec = codec
+        self.id = CODEC_IDS[codec]
+        self.fragments = 0  # Fragmentos enviados o recibidos
+        self.compressed = 0  # De ellos, los que viajaron comprimidos
+        self.raw_bytes = 0  # Bytes del archivo
+        self.wire_bytes = 0  # Bytes en la red
+        self.cpu = 0.0  # Segundos de CPU comprimiendo o descomprimiendo
+        self._backoff = COMPRESSION_BACKOFF
+        self._bypass = 0  # Fragmentos que faltan para volver a probar
+        self._sample_raw = 0
+        self._sample_wire = 0
+        self._sampled = 0
+        self._sent = {}  # Secuencia -> (payload, codec) de lo ultimo enviado
+
+    def compress(self, data, seq=None):
+        """Devuelve ``(payload, codec)`` para enviar el fragmento ``data``
+        (el de secuencia ``seq``)."""
+        if seq in self._sent:
+            payload, codec = self._sent[seq]
+            return (payload, codec) if codec else (data, RAW)
+        payload, codec = self._compress(data)
+        if seq is not None:
+            if len(self._sent) >= COMPRESSION_CACHE:
+                del self._sent[next(iter(self._sent))]  # El mas viejo
+            # Sin comprimir no se guarda el fragmento, que es una vista del archivo
+            self._sent[seq] = (payload if codec else None, codec)
+        return payload, codec
+
+    def _compress(self, data):
+        size = len(data)
+        self.fragments += 1
+        self.raw_bytes += size
+        if self._bypass:
+            self._bypass -= 1
+            self.wire_bytes += size
+            return data, RAW
+
+        start = time.thread_time()
+        if self.id == CODEC_IDS["zlib"]:
+            packed = zlib.compress(data, ZLIB_LEVEL, wbits=-zlib.MAX_WBITS)
+        else:
+            packed = lzma.compress(data, lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+        self.cpu += time.thread_time() - start
+        self._sample(size, min(len(packed), size))
+
+        if len(packed) >= size:
+            self.wire_bytes += size
+            return data, RAW
+        self.compressed += 1
+        self.wire_bytes += len(packed)
+        return packed, self.id
+
+    def decompress(self, codec, data, limit):
+        """Devuelve el fragmento que viajo como ``data`` con ``codec``. Nunca
+        produce mas de ``limit`` bytes (el tamano de fragmento)."""
+        self.fragments += 1
+        self.wire_bytes += len(data)
+        if codec == RAW:
+            self.raw_bytes += len(data)
+            return data
+        if codec != self.id:
+            raise ValueError(f"Fragmento con un codec no negociado: {codec}")
+
+        start = time.thread_time()
+        if codec == CODEC_IDS["zlib"]:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+        try:
+            fragment = decompressor.decompress(data, limit + 1)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f"Fragmento comprimido invalido: {e}")
+        self.cpu += time.thread_time() - start
+        if not decompressor.eof or len(fragment) > limit:
+            raise ValueError("Fragmento comprimido invalido o mayor al fragmento")
+        self.compressed += 1
+        self.raw_bytes += len(fragment)
+        return fragment
+
+    def summary(self):
+        """Una linea con el ratio logrado y lo que costo en CPU."""
+        ratio = self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+        speed = self.raw_bytes / self.cpu / 1024**2 if self.cpu else 0.0
+        return (
+            f"Compresion {self.codec}: {self.raw_bytes} -> {self.wire_bytes} bytes "
+            f"(ratio {ratio:.2f}), {self.compressed}/{self.fragments} fragmentos "
+            f"comprimidos, {self.cpu:.3f} s de CPU ({speed:.1f} MiB/s)"
+        )
+
+    def _sample(self, raw, wire):
+        self._sampled += 1
+        self._sample_raw += raw
+        self._sample_wire += wire
+        if self._sampled < COMPRESSION_SAMPLE:
+            return
+        saving = 1 - self._sample_wire / self._sample_raw if self._sample_raw else 0
+        if saving < COMPRESSION_MIN_SAVING:
+            self._bypass = self._backoff
+            logger.info(
+                f"Los datos no comprimen ({saving:.0%}), se envian "
+                f"{self._bypass} fragmentos sin comprimir"
+            )
+            self._backoff = min(self._backoff * 2, COMPRESSION_MAX_BACKOFF)
+        else:
+            self._backoff = COMPRESSION_BACKOFF
+        self._sampled = self._sample_raw = self._sample_wire = 0
@@ -0,0 +1,119 @@
+import time
+from abc import ABC, abstractmethod
+
+from lib.constants import INITIAL_CWND, MIN_CWND, MAX_CWND
+
+
+class CongestionController(ABC):
+    """Ventana de congestion en paquetes para el emisor SACK.
+
+    Las subclases deciden como crece la ventana en evitacion de congestion;
+    el arranque lento, la reduccion ante perdida y el timeout son comunes.
+    """
+
+    name = None
+    beta = 0.5  # Factor de reduccion multiplicativa ante una perdida
+
+    def __init__(self, initial_window=INITIAL_CWND, max_window=MAX_CWND):
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        self.max_window = max_window
+
+    @property
+    def window(self):
+        """Paquetes que pueden estar en vuelo."""
+        return int(self.cwnd)
+
+    def available(self, in_flight):
+        return max(self.window - in_flight, 0)
+
+    def on_ack(self, acked, rtt=None):
+        """Agranda la ventana por ``acked`` paquetes recien confirmados."""
+        if acked <= 0:
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.congestion_avoidance(acked, rtt)
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    @abstractmethod
+    def congestion_avoidance(self, acked, rtt):
+        """Crecimiento de la ventana por ``acked`` paquetes confirmados por
+        encima de ssthresh."""
+
+    def snapshot(self):
+        """Estado actual, para deshacer una reduccion que resulte innecesaria."""
+        return dict(vars(self))
+
+    def restore(self, state):
+        vars(self).update(state)
+
+    def on_loss(self):
+        """Perdida detectada por SACK: reduccion multiplicativa."""
+        self.ssthresh = max(self.cwnd * self.beta, MIN_CWND)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        """Timeout de retransmision: se vuelve a arranque lento."""
+        self.ssthresh = max(self.cwnd * self.beta, MIN_CWND)
+        self.cwnd = float(MIN_CWND)
+
+
+class NewReno(CongestionController):
+    """AIMD clasico: un paquete mas por ventana confirmada."""
+
+    name = "newreno"
+
+    def congestion_avoidance(self, acked, rtt):
+        self.cwnd += acked / self.cwnd
+
+
+class Cubic(CongestionController):
+    """Crecimiento cubico respecto del tiempo desde la ultima perdida (RFC 8312)."""
+
+    name = "cubic"
+    beta = 0.7
+    C = 0.4
+
+    def __init__(self, initial_window=INITIAL_CWND, max_window=MAX_CWND):
+        super().__init__(initial_window, max_window)
+        self.w_max = 0.0
+        self.w_est = 0.0
+        self.k = 0.0
+        self.epoch = None
+
+    def congestion_avoidance(self, acked, rtt):
+        now = time.monotonic()
+        if self.epoch is None:
+            self.epoch = now
+            self.w_max = max(self.w_max, self.cwnd)
+            self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+            self.w_est = self.cwnd
+        t = now - self.epoch + (rtt or 0)
+        target = self.C * (t - self.k) ** 3 + self.w_max
+        # Lo que haria NewReno en el mismo tiempo (region TCP-friendly)
+        self.w_est += 3 * (1 - self.beta) / (1 + self.beta) * acked / self.cwnd
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) * acked / self.cwnd
+        self.cwnd = max(self.cwnd, self.w_est)
+
+    def on_loss(self):
+        self.w_max = self.cwnd
+        self.epoch = None
+        super().on_loss()
+
+    def on_timeout(self):
+        self.w_max = self.cwnd
+        self.epoch = None
+        super().on_timeout()
+
+
+CONGESTION_CONTROLLERS = {cls.name: cls for cls in (NewReno, Cubic)}
+
+
+def create_congestion_controller(name):
+    try:
+        return CONGESTION_CONTROLLERS[name]()
+    except KeyError:
+        raise ValueError(f"Control de congestion no soportado: {name}")
@@ -5,19 +5,69 @@ import queue
 import os
 import select
 import logging
+import math
 
 from lib.constants import (
     TIMEOUT,
     TIMEOUT_SACK,
     FRAGMENT_SIZE,
-    PACKAGE_SIZE,
+    MIN_FRAGMENT_SIZE,
+    MAX_FRAGMENT_SIZE,
     MAX_RETRIES,
-    SACK_WINDOW_SIZE,
-    SEND_WINDOW_SIZE,
-    PACKAGE_SEND_DELAY,
-    MAX_SAC_DIF,
+    MIN_WAIT,
+    DUPACK_THRESHOLD,
+    MAX_REORDERING,
+    CLOCK_GRANULARITY,
+    CONGESTION_CONTROL,
+    FSYNC_POLICY,
+    HEADER_VERSION,
+    GSO_MAX_SEGMENTS,
+    SACK_BLOCKS,
+    MAX_SACK_BLOCKS,
+    ACK_EVERY,
+    ACK_DELAY,
+    MAX_STREAMS,
+    RESUME_MAX_RANGES,
+    REASSEMBLY_SIZE,
 )
-from lib.udp import UDPHeader, UDPFlags, UDPPackage
+from lib.udp import (
+    UDPHeader,
+    UDPFlags,
+    MAX_HEADER_SIZE,
+    pack_header_into,
+    pack_crc_into,
+    unpack_package,
+    encode_sack_blocks,
+    decode_sack_blocks,
+)
+from lib.fragments import (
+    FragmentSource,
+    FragmentSink,
+    resume_token,
+    find_partial,
+    discard_partial,
+    encode_ranges,
+    decode_ranges,
+)
+from lib.delta import write_signature, apply_delta, delta_path
+from lib.chunks import (
+    DEDUP_STEPS,
+    PENDING_SUFFIX,
+    dedup_path,
+    is_manifest,
+    read_manifest,
+)
+from lib.cache import read_file
+from lib.compression import FragmentCompression, CODECS
+from lib.fec import FecEncoder, FecDecoder, parse_fec
+from lib.reassembly import ReassemblyTracker
+from lib.scoreboard import Scoreboard
+from lib.ack_policy import AckPolicy
+from lib.offload import send_buffers, send_packages, recv_package, has_pending
+from lib.pmtu import path_fragment_size
+from lib.rtt import RTTEstimator, timestamp, echo_age
+from lib.congestion import create_congestion_controller
+from lib.pacer import Pacer
 
 logger = logging.getLogger("app_logger")
 
@@ -25,8 +75,20 @@ logger = logging.getLogger("app_logger")
 class BaseConnection:
     """Clase base que contiene atributos y comportamientos comunes de conexiones."""
 
+    blocking_writes = True  # write() del FragmentSink espera lugar en su cola
+
     def __init__(
-        self, addr, path=None, sequence=0, download=False, protocol="stop_and_wait"
+        self,
+        addr,
+        path=None,
+        sequence=0,
+        download=False,
+        protocol="stop_and_wait",
+        fsync=FSYNC_POLICY,
+        congestion=CONGESTION_CONTROL,
+        rate=None,
+        reordering=DUPACK_THRESHOLD,
+        cache=None,
     ):
         self.addr = addr
         self.path = path
@@ -36,43 +98,583 @@ class BaseConnection:
         self.upload = not download
         self.protocol = protocol
         self.fragments = {}
-        self.received_out_of_order = []
-        self.window_sents = 0
+        # Recepcion SACK: no se acepta mas que REASSEMBLY_SIZE por delante
+        self.reassembly = ReassemblyTracker(sequence, window=REASSEMBLY_SIZE)
+        self.acks = AckPolicy()  # ACK por paquete salvo que se negocie otra cosa
         self.retries = 0
+        self.fsync = fsync
+        self.options = {}
+        self.extended = False
+        self.sack_blocks = False  # ACKs selectivos con rangos en el payload
+        self.fragment_size = FRAGMENT_SIZE  # Payload de cada DATA, se negocia en el START
+        self.stream = (0, 1)  # Stream de esta conexion y total, con --streams
+        self.transfer = None  # Identificador comun a los streams de un archivo
+        self.resume = None  # Version del archivo, si se puede reanudar la transferencia
+        self.skip = []  # Rangos de fragmentos que el receptor ya tenia al reanudar
+        self.delta = None  # Version de la copia del servidor a la que se aplica el delta
+        self.signature = False  # Se pidio la firma del archivo en vez del archivo
+        self.dedup = None  # Paso y token de un upload con dedup (ver lib.chunks)
+        self.store = None  # Chunk store del servidor, con --chunk-store
+        self.temp_source = None  # Temporal que se envia en vez del archivo
+        self.cache = cache  # Cache de archivos del servidor (ver lib.cache)
+        self.compression = None  # Compresion de los fragmentos, si se negocio
+        self.fec_options = None  # Fragmentos y paridades por bloque FEC, si se negocio
+        self.fec = None  # FecEncoder del emisor o FecDecoder del receptor
+        self.crc = False  # Cada datagrama lleva el CRC32 de si mismo
+        self.verify = False  # Se compara el digest de lo transferido en el END
+        self.digest = None  # Digest de lo enviado o recibido, una vez calculado
+        self.rtt = RTTEstimator(TIMEOUT_SACK if protocol == "sack" else TIMEOUT)
+        self.congestion = create_congestion_controller(congestion)
+        self.scoreboard = Scoreboard(sequence + 1)  # Envio SACK
+        self.reordering = reordering  # Evidencia necesaria para dar un hueco por perdido
+        self.dupacks = 0  # ACKs seguidos que no avanzan el acumulado
+        self.recovery_point = None  # Mayor secuencia enviada al detectar la perdida
+        self.undo_state = None  # Ventana previa a la ultima reduccion
+        self.undo_seq = None  # Primer hueco de esa reduccion
+        self.undo_sent = None  # Cuando se lo reenvio por primera vez
+        self.undo_timeout = False  # La reduccion fue por timeout, no por SACK
+        self.rate = rate  # Limite de envio en bytes por segundo
+        self.pacer = Pacer(rate)
+        self.pacing_delay = 0  # Espera pendiente si el pacer freno el envio
+        self.last_progress = time.monotonic()  # Inicio del timer de retransmision
+        # Headers de datos que se reescriben en cada envio, uno por datagrama GSO
+        self.header_buffer = bytearray(MAX_HEADER_SIZE * GSO_MAX_SEGMENTS)
+        self.header_view = memoryview(self.header_buffer)
 
     def __repr__(self):
         return f"Cliente ({self.addr})"
 
-    def save_file(self):
-        output_path = self.path
-        dir = self.path.split("/")[0]
-        if not os.path.exists(dir):
-            os.makedirs(dir)
+    @property
+    def package_size(self):
+        """Mayor datagrama de datos de la conexion, con el header extendido."""
+        return self.fragment_size + MAX_HEADER_SIZE
+
+    def set_options(self, options):
+        """Aplica las opciones negociadas en el START."""
+        self.options = options
+        self.extended = options.get("hdr") == str(HEADER_VERSION)
+        self.sack_blocks = options.get("sack") == SACK_BLOCKS
+        self.crc = options.get("crc") == "1"
+        self.verify = options.get("digest") == "1"
+        if "frag" in options:
+            self.fragment_size = int(options["frag"])
+            self.pacer.set_package_size(self.package_size)
+        if "stream" in options:
+            self.stream = parse_stream(options["stream"])
+            self.transfer = options["transfer"]
+        if is_transfer_id(options.get("resume", "")):
+            self.resume = options["resume"]
+            self.skip = decode_ranges(options.get("have", ""))
+        if is_transfer_id(options.get("delta", "")):
+            self.delta = options["delta"]
+        self.signature = options.get("sig") == "1"
+        for step in DEDUP_STEPS:
+            if is_transfer_id(options.get(step, "")):
+                self.dedup = (step, options[step])
+        if options.get("comp") in CODECS:
+            self.compression = FragmentCompression(options["comp"])
+        if "fec" in options:
+            block, parity = parse_fec(options["fec"])
+            self.fec_options = (block, parity, options.get("fec_adapt") == "1")
+            # Un hueco puede reconstruirse cuando llegan las paridades de su
+            # bloque: no se lo da por perdido antes
+            self.raise_reordering(block + parity)
+        if "ack" in options:
+            delay = float(options.get("ack_delay", 0)) / 1000
+            self.acks = AckPolicy(int(options["ack"]), delay)
+        if "rate" in options:
+            rate = int(options["rate"])
+            self.pacer.set_limit(min(rate, self.rate) if self.rate else rate)
+
+    def open_file(self):
+        """Prepara el archivo destino para escribir los fragmentos a medida que llegan."""
+        path = self.path
+        if self.delta:
+            path = delta_path(self.path, self.delta)
+        elif self.dedup and self.dedup[0] in PENDING_SUFFIX:
+            path = dedup_path(self.path, *self.dedup)
+        self.fragments = FragmentSink(
+            path,
+            fragment_size=self.fragment_size,
+            fsync=self.fsync,
+            stream=self.stream,
+            transfer=self.transfer,
+            resume=self.resume,
+            skip=self.skip,
+            digest=self.verify,
+            block=self.blocking_writes,
+        )
+        if self.fec_options is not None:
+            block = self.fec_options[0]
+            self.fec = FecDecoder(block, self.fragment_size, self.reassembly)
+
+    def negotiate_resume(self, requested):
+        """Acepta del lado del servidor la reanudacion pedida en el START.
+
+        En un upload el token es el del archivo del cliente y se responde con
+        los rangos que ya se tienen de esa version. En un download el token es
+        el del archivo propio, y los rangos que dice tener el cliente solo se
+        aceptan si su copia parcial es de esa version y con el mismo fragmento.
+        """
+        token = requested.get("resume")
+        if token is None:
+            return
+        options = dict(self.options)
+        if self.download:
+            try:
+                options["resume"] = resume_token(self.path)
+            except OSError:
+                return  # get_fragments avisa que no existe
+            have = requested.get("have", "")
+            same = token == options["resume"]
+            if same and requested.get("frag") == str(self.fragment_size) and have:
+                try:
+                    decode_ranges(have)
+                    options["have"] = have
+                except ValueError:
+                    pass
+        elif is_transfer_id(token):
+            options["resume"] = token
+            partial = find_partial(self.path, self.stream, token)
+            if partial is not None and partial[1] == self.fragment_size:
+                options["have"] = encode_ranges(partial[2][:RESUME_MAX_RANGES])
+        self.set_options(options)
+        if self.skip:
+            logger.info(f"Reanudando {self.path}: ya se tienen {encode_ranges(self.skip)}")
+
+    def negotiate_delta(self, requested):
+        """Acepta del lado del servidor un upload delta (ver lib.delta): en un
+        download se puede pedir la firma del archivo en vez del archivo, y en
+        un upload mandar el delta contra la version que se firmo, si sigue
+        siendo la que hay."""
+        if self.store is not None:
+            return  # Se firmaria el manifiesto, no el archivo
+        options = dict(self.options)
+        if self.download and requested.get("sig") == "1":
+            options["sig"] = "1"
+        elif self.upload and "delta" in requested:
+            try:
+                if resume_token(self.path) != requested["delta"]:
+                    return
+            except OSError:
+                return
+            options["delta"] = requested["delta"]
+        else:
+            return
+        self.set_options(options)
 
-        with open(output_path, "wb") as f:
-            for i in sorted(self.fragments.keys()):
-                f.write(self.fragments[i])
-        logger.info(f"Archivo guardado en {output_path}")
+    def negotiate_chunks(self, requested, store):
+        """Con chunk store (``store``) los uploads se guardan partidos en
+        chunks y los downloads se arman desde el store; ademas se acepta el
+        paso de un upload con dedup que se pida en el START."""
+        if store is None:
+            return
+        self.store = store
+        step = next((step for step in DEDUP_STEPS if step in requested), None)
+        if step is None or (step == "missing") != self.download:
+            return
+        if is_transfer_id(requested[step]):
+            self.set_options({**self.options, step: requested[step]})
+
+    def commit_file(self, sink):
+        """Confirma lo recibido en ``sink``. Devuelve True si el archivo quedo
+        en su destino; en un upload delta, una vez reconstruido a partir de la
+        copia anterior, y con chunk store, una vez guardados sus chunks."""
+        if not sink.commit():
+            return False
+        fsync = self.fsync != "never"
+        if self.delta:
+            apply_delta(self.path, sink.path, self.delta, fsync=fsync)
+        elif self.dedup and self.dedup[0] == "chunks":
+            manifest = dedup_path(self.path, "manifest", self.dedup[1])
+            self.store.commit_pack(self.path, sink.path, manifest, fsync=fsync)
+        elif self.store is not None and not self.dedup:
+            self.store.store_file(self.path, fsync=fsync)
+        if self.cache is not None:
+            self.cache.invalidate(self.path)
+        return True
+
+    def write_fragment(self, header, data, buffer=None):
+        """Escribe un DATA recibido en su lugar, descomprimido si hace falta,
+        y lo que eso permita reconstruir si se negocio FEC."""
+        if self.compression is not None:
+            codec = header.sack
+            data = self.compression.decompress(codec, data, self.fragment_size)
+            if codec and buffer is not None:
+                buffer.release()  # Se escribe la copia descomprimida
+                buffer = None
+        recovered = []
+        if self.fec is not None:
+            recovered = self.fec.add_data(header.sequence, data)
+        self.fragments.write(header.sequence, data, buffer)
+        self.write_recovered(recovered)
+
+    def receive_parity(self, header, data):
+        """Procesa una paridad FEC (un DATA con el flag SACK). Devuelve True
+        si permitio reconstruir algun fragmento."""
+        if self.fec is None:
+            return False
+        recovered = self.fec.add_parity(header.sequence, header.sack, data)
+        return self.write_recovered(recovered)
+
+    def write_recovered(self, recovered):
+        for seq, fragment in recovered:
+            if self.reassembly.add(seq):
+                self.fragments.write(seq, fragment)
+                logger.info(f"Fragmento {seq} reconstruido con FEC")
+        return bool(recovered)
+
+    def local_digest(self):
+        """Digest de lo enviado o recibido, que viaja en el END y en su
+        confirmacion (vacio si no se negocio)."""
+        if not self.verify:
+            return b""
+        if self.digest is None:
+            self.digest = self.fragments.finish_digest()
+        return self.digest
+
+    def verify_digest(self, digest):
+        """Compara el digest que mando el emisor en el END con el de lo
+        recibido. Si no coinciden descarta lo recibido y devuelve False."""
+        if not self.verify:
+            return True
+        digest, local = bytes(digest), self.local_digest()
+        if digest == local:
+            logger.info(f"Digest de {self.path} verificado: {local.hex()}")
+            return True
+        logger.error(
+            f"Error: El digest de {self.path} no coincide "
+            f"({digest.hex()} != {local.hex()}), se descarta lo recibido"
+        )
+        self.fragments.discard()
+        return False
+
+    def check_peer_digest(self, digest):
+        """Compara el digest de la confirmacion del END con el de lo enviado."""
+        if not self.verify or bytes(digest) == self.local_digest():
+            return True
+        logger.error(f"Error: El receptor de {self.path} recibio otro contenido.")
+        return False
+
+    def save_file(self):
+        if self.commit_file(self.fragments):
+            logger.info(f"Archivo guardado en {self.path}")
+        else:
+            index, streams = self.stream
+            logger.info(f"Stream {index + 1}/{streams} de {self.path} recibido")
+
+    def release_fragments(self):
+        """Libera el archivo asociado; descarta lo recibido si no se guardo."""
+        compression, self.compression = self.compression, None
+        if compression is not None and compression.fragments:
+            logger.info(compression.summary())
+        fec, self.fec = self.fec, None
+        if fec is not None:
+            logger.info(fec.summary())
+        if hasattr(self.fragments, "close"):
+            self.fragments.close()
+        if self.temp_source is not None:
+            os.remove(self.temp_source)
+            self.temp_source = None
+
+    def prepare_transfer(self):
+        """Prepara el archivo de la transferencia: el origen de un download
+        (que puede armarse desde el chunk store, firmarse o cargarse en la
+        cache) o el temporal de un upload. Puede leer el archivo entero."""
+        if self.download:
+            self.get_fragments()
+        else:
+            self.open_file()
 
     def get_fragments(self):
         try:
-            with open(self.path, "rb") as f:
-                for i, fragment in enumerate(iter(lambda: f.read(FRAGMENT_SIZE), b"")):
-                    self.fragments[i + 1] = fragment
+            path, data = self.path, None
+            if self.signature:
+                self.temp_source = path = write_signature(self.path)
+            elif self.dedup and self.dedup[0] == "missing":
+                manifest = dedup_path(self.path, "manifest", self.dedup[1])
+                self.temp_source = path = self.store.write_missing(manifest)
+            else:
+                stored = self.store is not None and is_manifest(self.path)
+                if self.cache is not None:
+                    data = self.cached_file(stored)
+                if data is None and stored:
+                    self.temp_source = path = self.store.assemble(self.path)
+            self.fragments = FragmentSource(
+                path, self.fragment_size, self.stream, self.skip, self.verify, data
+            )
+            if self.fec_options is not None:
+                block, parity, adaptive = self.fec_options
+                total = self.fragments.total
+                self.fec = FecEncoder(block, parity, total, self.fragment_size, adaptive)
             logger.info(f"Fragments listos para enviar [{len(self.fragments)}]")
         except FileNotFoundError:
             logger.error(f"Error: Archivo {self.path} no encontrado.")
             self.is_active = False
             if hasattr(self, "socket"):
                 close_connection(self.socket, self, "Archivo no encontrado.")
-
-    def send_end_confirmation(self):
+        except ValueError as e:
+            # Manifiesto o chunk del store danado
+            logger.error(f"Error: {e}")
+            self.is_active = False
+            if hasattr(self, "socket"):
+                close_connection(self.socket, self, "Archivo danado en el servidor.")
+
+    def cached_file(self, stored):
+        """Contenido del archivo desde la cache, o None si no entra. Con
+        ``stored`` el archivo es un manifiesto y se arma desde el chunk store."""
+        if stored:
+            size = read_manifest(self.path)[0]
+            return self.cache.get(self.path, size, self.store.read_file)
+        return self.cache.get(self.path, os.path.getsize(self.path), read_file)
+
+    def send_end_confirmation(self, digest=b""):
+        """Confirma el END y guarda el archivo, si el digest que trae
+        coincide con el de lo recibido."""
+        self.is_active = False
+        if not self.verify_digest(digest):
+            close_connection(self.socket, self, "El digest del archivo no coincide.")
+            return
         send_end_confirmation(self.socket, self)
         self.save_file()
-        self.is_active = False
 
+    def send_window(self, socket):
+        """Llena la ventana de congestion: primero reenvia lo dado por perdido
+        y despues sigue con fragmentos nuevos, sin pasar de REASSEMBLY_SIZE
+        por delante del primero sin confirmar (la ventana de recepcion).
+        Devuelve la cantidad enviada."""
+        budget = self.congestion.available(self.in_flight())
+        self.pacer.update(self.congestion, self.rtt.srtt)
+        self.pacing_delay = 0
+        batch = []
+        sent = 0
+        while sent < budget:
+            key = self.scoreboard.next_lost()
+            retransmission = key is not None
+            if key is None:
+                key = self.scoreboard.next_seq
+                if key not in self.fragments:
+                    break  # Ya se envio todo el archivo al menos una vez
+                if key >= self.scoreboard.base + REASSEMBLY_SIZE:
+                    break  # El receptor lo descartaria: espera que se llene el hueco
+            self.pacing_delay = self.pacer.delay(self.package_size)
+            if self.pacing_delay > 0:
+                break
+            self.send_fragment(socket, key, batch)
+            sent += 1
+            if self.fec is not None:
+                sent += self.send_parity(socket, key, batch, retransmission)
+            if len(batch) == GSO_MAX_SEGMENTS:
+                send_packages(socket, batch, self.addr)
+                batch.clear()
+        # La ventana sale junta (un solo syscall si hay GSO)
+        send_packages(socket, batch, self.addr)
+        return sent
+
+    def in_flight(self):
+        """Paquetes en vuelo para la ventana: los del scoreboard y las
+        paridades FEC."""
+        if self.fec is None:
+            return self.scoreboard.pipe
+        return self.scoreboard.pipe + self.fec.pipe
+
+    def send_fragment(self, socket, key, batch=None):
+        """Envia un fragmento, o lo agrega a ``batch`` para enviarlo despues."""
+        data = self.fragments[key]
+        slot = 0 if batch is None else len(batch)
+        package = data_package(self, data, sequence=key, slot=slot)
+        if batch is None:
+            send_buffers(socket, package, self.addr)
+        else:
+            batch.append(package)
+        self.pacer.consume(len(package[0]) + len(package[1]))
+        now = time.monotonic()
+        if not self.scoreboard.pipe:
+            self.last_progress = now
+        if key == self.undo_seq and self.undo_sent is None:
+            self.undo_sent = now
+        self.scoreboard.on_send(key, now)
+        logger.info(
+            f"Enviando paquete {self.addr}: {key} - Ventana: {self.congestion.window}"
+        )
+
+    def send_parity(self, socket, key, batch, retransmission):
+        """Agrega a ``batch`` las paridades FEC del bloque que completa el
+        fragmento ``key`` recien enviado por primera vez y devuelve cuantas
+        son. Ocupan la ventana como los DATA (ver in_flight) y pasan por el
+        pacer."""
+        if retransmission:
+            self.fec.on_retransmit(key)
+            return 0
+        parities = self.fec.add(key, self.fragments[key])
+        if len(batch) + len(parities) > GSO_MAX_SEGMENTS:
+            send_packages(socket, batch, self.addr)
+            batch.clear()
+        first = key - (key - 1) % self.fec.block
+        for field, parity in parities:
+            package = parity_package(self, first, field, parity, len(batch))
+            batch.append(package)
+            self.pacer.consume(len(package[0]) + len(package[1]))
+        return len(parities)
+
+    def process_sack(self, socket, header, payload=b""):
+        """Registra lo confirmado por un ACK selectivo y ajusta la ventana.
+
+        Lo confirmado fuera de orden viene en los rangos del payload si se
+        negociaron, o en el bitmap de 32 bits del header si no. Un hueco se da
+        por perdido y send_window lo reenvia cuando hay ``reordering``
+        secuencias SACKeadas por encima o ``reordering`` ACKs duplicados; una
+        retransmision, cuando el receptor ya recibio algo enviado despues. La
+        ventana se reduce una sola vez hasta que se confirme lo enviado al
+        detectar la primera perdida (NewReno) y se restaura si la reduccion
+        resulta espuria.
+        """
+        if self.sack_blocks:
+            cumulative = header.sequence
+            blocks = decode_sack_blocks(payload)
+        else:
+            cumulative, sacked = header.get_sequences()
+            blocks = [(seq, seq) for seq in sacked]
+
+        scoreboard = self.scoreboard
+        if self.undo_seq is not None and cumulative >= self.undo_seq:
+            self.check_spurious(header)
+        delivered = scoreboard.ack(cumulative)
+        for seq in range(self.sequence + 1, cumulative + 1):
+            if seq in self.fragments:
+                del self.fragments[seq]
+        for start, end in blocks:
+            delivered += scoreboard.sack(start, end)
+        if self.fec is not None:
+            self.fec.on_ack(max([cumulative] + [end for _, end in blocks]))
+
+        if cumulative > self.sequence:
+            self.sequence = cumulative
+            self.dupacks = 0
+        elif scoreboard.highest_sent > cumulative and (blocks or not self.sack_blocks):
+            # Con rangos, un ACK sin ninguno es por un duplicado y no por un hueco
+            self.dupacks += 1
+        if delivered:
+            self.last_progress = time.monotonic()
+
+        if self.recovery_point is not None and cumulative >= self.recovery_point:
+            self.recovery_point = None
+        if self.recovery_point is None:
+            self.congestion.on_ack(delivered, self.rtt.srtt)
+
+        lost = scoreboard.detect_losses(self.reordering)
+        if self.dupacks >= self.reordering and scoreboard.mark_lost(cumulative + 1):
+            # Sin SACK que lo cubra (por ejemplo, mas alla del bitmap de 32 bits)
+            lost += 1
+        age = echo_age(header)
+        if age is not None:
+            # Lo que el receptor acaba de ver salio hace ``age``: lo reenviado
+            # antes de eso (con margen de reordenamiento) no llego
+            window = (self.rtt.srtt or 0) / 4
+            lost += scoreboard.detect_lost_retransmissions(
+                time.monotonic() - age - window
+            )
+        if lost and self.recovery_point is None:
+            logger.info(f"Perdida detectada {self.addr}: {lost} desde {cumulative + 1}")
+            self.save_undo(timeout=False)
+            self.recovery_point = scoreboard.highest_sent
+            self.congestion.on_loss()
+
+    def save_undo(self, timeout):
+        """Guarda la ventana antes de reducirla por la primera secuencia que se
+        acaba de dar por perdida."""
+        self.undo_seq = self.scoreboard.next_lost()
+        self.undo_state = self.congestion.snapshot()
+        self.undo_sent = None
+        self.undo_timeout = timeout
+
+    def raise_reordering(self, threshold):
+        """Sube el umbral de reordenamiento hasta ``threshold``, sin pasar de
+        MAX_REORDERING; nunca lo baja."""
+        self.reordering = max(self.reordering, min(threshold, MAX_REORDERING))
+
+    def check_spurious(self, header):
+        """El ACK cubre el hueco que causo la ultima reduccion. Si lo que llego
+        fue el envio original (el eco es anterior a la retransmision, como en
+        Eifel) o ni siquiera se habia reenviado, la reduccion sobraba y se
+        restaura la ventana. Si la habia causado el SACK, ademas hubo
+        reordenamiento y se sube el umbral."""
+        age = echo_age(header)
+        if self.undo_sent is None:
+            spurious = True
+        elif age is None:
+            spurious = False
+        else:
+            echoed = time.monotonic() - age
+            spurious = echoed < self.undo_sent - CLOCK_GRANULARITY
+        if spurious:
+            self.congestion.restore(self.undo_state)
+            self.recovery_point = None
+            if not self.undo_timeout:
+                self.raise_reordering(self.reordering * 2)
+            logger.info(
+                f"Retransmision espuria {self.addr}: {self.undo_seq}, se restaura "
+                f"la ventana ({self.congestion.window}), umbral {self.reordering}"
+            )
+        self.undo_state = self.undo_seq = self.undo_sent = None
+
+    def on_send_timeout(self):
+        """Sin ACKs durante un RTO: se da por perdido lo enviado antes del
+        ultimo RTT, lo mas reciente todavia puede confirmarse."""
+        now = time.monotonic()
+        self.scoreboard.on_timeout(now - (self.rtt.srtt or 0))
+        if self.fec is not None:
+            self.fec.on_timeout()
+        self.save_undo(timeout=True)
+        self.congestion.on_timeout()
+        self.recovery_point = None
+        self.dupacks = 0
+        self.last_progress = now
+
+    def rto_expired(self):
+        return time.monotonic() >= self.last_progress + self.rtt.rto
+
+    def sender_wait(self):
+        """Cuanto esperar ACKs: lo que falta para el RTO o, si el pacer freno el
+        envio, hasta que vuelva a haber tokens."""
+        wait = self.last_progress + self.rtt.rto - time.monotonic()
+        if self.pacing_delay > 0:
+            wait = min(wait, self.pacing_delay)
+        return max(wait, MIN_WAIT)
+
+
+class Message:
+    """Paquete recibido para una conexion.
+
+    Si ``data`` apunta a un buffer del pool de recepcion, quien se quede con
+    ``data`` mas alla de handle_message() debe tomarlo con take_buffer() y
+    liberarlo despues; si no, el driver lo libera al terminar de procesarlo.
+    """
+
+    __slots__ = ("header", "data", "buffer")
+
+    def __init__(self, header, data, buffer=None):
+        self.header = header
+        self.data = data
+        self.buffer = buffer
+
+    def take_buffer(self):
+        buffer, self.buffer = self.buffer, None
+        return buffer
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+
+
+class StopAndWaitSession(BaseConnection):
+    """Maquina de estados stop and wait de un cliente del servidor.
+
+    No sabe quien la alimenta: recibe los mensajes por handle_message(), los
+    vencimientos por handle_timeout() y expone cuanto esperar en next_timeout().
+    """
 
-class ClientConnection(BaseConnection, threading.Thread):
     def __init__(
         self,
         socket: socket.socket,
@@ -80,217 +682,294 @@ class ClientConnection(BaseConnection, threading.Thread):
         path,
         download=False,
         protocol="stop_and_wait",
+        fsync=FSYNC_POLICY,
+        congestion=CONGESTION_CONTROL,
+        rate=None,
+        cache=None,
     ):
-        super().__init__(addr, path, download=download, protocol=protocol)
-        threading.Thread.__init__(self)
+        super().__init__(
+            addr,
+            path,
+            download=download,
+            protocol=protocol,
+            fsync=fsync,
+            congestion=congestion,
+            rate=rate,
+            cache=cache,
+        )
         self.socket = socket
-        self.message_queue = queue.Queue()
 
-    def run(self):
+    def start_transfer(self):
+        self.prepare_transfer()
+        self.begin_transfer()
+
+    def begin_transfer(self):
+        """Primer envio, una vez preparado el archivo (ver prepare_transfer)."""
         if self.download:
-            self.get_fragments()
             self.send_data()
 
-        while self.is_active:
-            try:
-                message = self.message_queue.get(timeout=TIMEOUT)
+    def next_timeout(self):
+        return self.sender_wait() if self.download else self.rtt.rto
 
-                if self.upload:
-                    if message["header"].has_data():
-                        self.retries = 0
-                        self.receive_data(message)
-                    elif message["header"].has_end():
-                        self.send_end_confirmation()
-                else:
-                    self.send_data(message)
+    def handle_message(self, message):
+        if self.upload:
+            if message.header.flags & UDPFlags.DATA:
+                self.retries = 0
+                self.receive_data(message)
+            elif message.header.flags & UDPFlags.END:
+                self.send_end_confirmation(message.data)
+        else:
+            self.send_data(message)
 
-            except queue.Empty:
-                logger.warning(f"Cliente {self.addr} no ha enviado mensajes recientes.")
-                if self.retries > MAX_RETRIES:
-                    logger.warning(
-                        f"Cliente {self.addr} inactivo por {MAX_RETRIES} intentos."
-                    )
-                    self.is_active = False
-                else:
-                    if self.upload:
-                        send_ack(self.socket, self)
-                    else:
-                        self.send_data()
-
-                self.retries += 1
-            except Exception as e:
-                logger.error(f"Error con {self.addr}: {e}")
-                self.is_active = False
+    def handle_timeout(self):
+        if self.download and not self.rto_expired():
+            # Solo vencio la espera del pacer, no hubo timeout
+            self.send_data()
+            return
+        logger.warning(f"Cliente {self.addr} no ha enviado mensajes recientes.")
+        self.rtt.on_timeout()
+        if self.retries > MAX_RETRIES:
+            logger.warning(f"Cliente {self.addr} inactivo por {MAX_RETRIES} intentos.")
+            self.is_active = False
+        else:
+            if self.upload:
+                send_ack(self.socket, self)
+            else:
+                self.send_data()
 
-    def put_message(self, message):
-        """Agrega un mensaje a la cola para ser procesado por el hilo."""
-        self.message_queue.put(message)
+        self.retries += 1
 
     def receive_data(self, message):
-        if message["header"].sequence in self.fragments:
-            send_ack(self.socket, self, message["header"].sequence)
+        if message.header.sequence in self.fragments:
+            send_ack(self.socket, self, message.header.sequence)
             return
 
-        self.sequence = message["header"].sequence
+        self.sequence = message.header.sequence
         logger.info(f"Mensaje Recibido: {self.addr} [DATA] - Frag Seq: {self.sequence}")
-        self.fragments[self.sequence] = message["data"]
+        self.write_fragment(message.header, message.data, message.take_buffer())
         send_ack(self.socket, self)
 
     def send_data(self, message=None):
-        if message and message["header"].has_ack():
+        if message and message.header.flags & UDPFlags.ACK:
             self.retries = 0
-            sequence = message["header"].sequence
+            sequence = message.header.sequence
             logger.info(f"Mensaje Recibido: {self.addr} [ACK] Seq: {sequence}")
             if sequence in self.fragments:
                 self.fragments.pop(sequence)
         if self.fragments:
             key = next(iter(self.fragments))
             data = self.fragments[key]
+            self.pacing_delay = self.pacer.delay(len(data) + UDPHeader.HEADER_SIZE)
+            if self.pacing_delay > 0:
+                return
+            self.pacer.consume(len(data) + UDPHeader.HEADER_SIZE)
             send_data(self.socket, self, data, sequence=key)
+            self.last_progress = time.monotonic()
             logger.info(f"Enviando paquete {self.addr}: {key}")
         else:
+            # Se repite en cada timeout hasta que llegue el END-ACK del cliente
             send_end(self.socket, self)
-            self.is_active = False
 
 
-class ClientConnectionSACK(BaseConnection, threading.Thread):
+class SackSession(BaseConnection):
+    """Maquina de estados SACK de un cliente del servidor (ver StopAndWaitSession)."""
+
     def __init__(
-        self, socket: socket.socket, addr, path, download=False, protocol="sack"
+        self,
+        socket: socket.socket,
+        addr,
+        path,
+        download=False,
+        protocol="sack",
+        fsync=FSYNC_POLICY,
+        congestion=CONGESTION_CONTROL,
+        rate=None,
+        reordering=DUPACK_THRESHOLD,
+        cache=None,
     ):
-        super().__init__(addr, path, download=download, protocol=protocol)
-        threading.Thread.__init__(self)
+        super().__init__(
+            addr,
+            path,
+            download=download,
+            protocol=protocol,
+            fsync=fsync,
+            congestion=congestion,
+            rate=rate,
+            reordering=reordering,
+            cache=cache,
+        )
         self.socket = socket
-        self.message_queue = queue.Queue()
 
-    def run(self):
+    def start_transfer(self):
+        self.prepare_transfer()
+        self.begin_transfer()
+
+    def begin_transfer(self):
+        """Primer envio, una vez preparado el archivo (ver prepare_transfer)."""
         if self.download:
-            self.get_fragments()
             self.send_data_sack()
 
-        while self.is_active:
-            try:
-                message = self.message_queue.get(timeout=TIMEOUT_SACK)
-
-                if self.upload:
-                    if message["header"].has_data():
-                        self.retries = 0
-                        # print("RECIBI DATA ", message["header"].sequence)
-                        self.receive_data(message)
-                    elif message["header"].has_end():
-                        logger.info(f"Mensaje Recibido: {self.addr} [END]")
-                        self.send_end_confirmation()
-                else:
-                    self.handle_sack_ack(message)
-                    while not self.message_queue.empty():
-                        message = self.message_queue.get(timeout=TIMEOUT_SACK)
-                        self.handle_sack_ack(message)
-                    self.send_data_sack()
-                    # Para que el cliente no sature al servidor con el envio de paquetes
-                    time.sleep(PACKAGE_SEND_DELAY)
+    def next_timeout(self):
+        return self.sender_wait() if self.download else self.acks.wait(self.rtt.rto)
+
+    def handle_message(self, message):
+        if self.upload:
+            if message.header.flags & UDPFlags.DATA:
+                self.retries = 0
+                # print("RECIBI DATA ", message.header.sequence)
+                self.receive_data(message)
+            elif message.header.flags & UDPFlags.END:
+                logger.info(f"Mensaje Recibido: {self.addr} [END] - ACK:DATA {self.acks}")
+                self.send_end_confirmation(message.data)
+        else:
+            self.handle_sack_ack(message)
+            self.send_data_sack()
 
-            except queue.Empty:
-                logger.warning(f"Cliente {self.addr} no ha enviado mensajes recientes.")
-                if self.retries > MAX_RETRIES:
-                    logger.warning(
-                        f"Cliente {self.addr} inactivo por {MAX_RETRIES} intentos."
-                    )
-                    self.is_active = False
-                else:
-                    if self.upload:
-                        send_sack_ack(
-                            self.socket, self, self.sequence, self.received_out_of_order
-                        )
-                    else:
-                        self.send_data_sack()
-
-                self.retries += 1
-            except ValueError as e:
-                logger.error(f"Error con {self.addr}: {e}")
-                self.is_active = False
+    def handle_timeout(self):
+        if self.download and not self.rto_expired():
+            # Solo vencio la espera del pacer, no hubo timeout
+            self.send_data_sack()
+            return
+        if self.upload and self.acks.due():
+            # Vencio el ACK demorado, no el timeout
+            send_sack_ack(self.socket, self)
+            return
+        logger.warning(f"Cliente {self.addr} no ha enviado mensajes recientes.")
+        self.rtt.on_timeout()
+        if self.retries > MAX_RETRIES:
+            logger.warning(f"Cliente {self.addr} inactivo por {MAX_RETRIES} intentos.")
+            self.is_active = False
+        else:
+            if self.upload:
+                send_sack_ack(self.socket, self)
+            else:
+                self.on_send_timeout()
+                self.send_data_sack()
 
-    def send_data_sack(self):
-        for seq, (key, data) in enumerate(self.fragments.items()):
-            if (
-                seq >= SACK_WINDOW_SIZE or self.window_sents > SEND_WINDOW_SIZE
-            ):  # Solo mandamos los primeros 8 elementos
-                break
-            if key > self.sequence + MAX_SAC_DIF:
-                break
+        self.retries += 1
 
-            send_data(self.socket, self, data, sequence=key)
-            self.window_sents += 1
-            logger.info(f"Enviando paquete {self.addr}: {key} - Seq: {self.sequence}")
+    def send_data_sack(self):
+        self.send_window(self.socket)
 
         if not self.fragments:
+            # Se repite en cada timeout hasta que llegue el END-ACK del cliente
             send_end(self.socket, self)
-            self.is_active = False
 
     def receive_data(self, message):
-        if message["header"].sequence not in self.fragments:
-            self.fragments[message["header"].sequence] = message["data"]
-            logger.info(
-                f"Mensaje Recibido: {self.addr} [DATA] - Frag Seq: {message['header'].sequence}"
-            )
+        sequence = message.header.sequence
+        gaps = bool(self.reassembly.ranges)
+        if message.header.flags & UDPFlags.SACK:
+            # Paridad FEC: solo se confirma si reconstruyo algo
+            if self.receive_parity(message.header, message.data):
+                self.sequence = self.reassembly.cumulative
+                send_sack_ack(self.socket, self)
+            return
+        new = self.reassembly.add(sequence)
+        if new:
+            self.write_fragment(message.header, message.data, message.take_buffer())
+            logger.info(f"Mensaje Recibido: {self.addr} [DATA] - Frag Seq: {sequence}")
+            if sequence > self.reassembly.cumulative:
+                logger.warning(f"Fragmento {sequence} recibido fuera de orden.")
+        self.sequence = self.reassembly.cumulative
+
+        # Duplicados y huecos se confirman ya para que el emisor reaccione
+        gaps = gaps or bool(self.reassembly.ranges)
+        if self.acks.on_data(immediate=gaps or not new):
+            send_sack_ack(self.socket, self)
 
-        if message["header"].sequence == self.sequence + 1:
-            self.sequence = message["header"].sequence
-            # send_sack_ack(self.socket, self, self.sequence)
-            self.received_out_of_order.sort()
-            received_out_of_order = list(self.received_out_of_order)
-            for i in received_out_of_order:
-                logger.info(
-                    f"Recibidos OutOrder:  {self.received_out_of_order} - Borrando: {i}"
-                )
-                if i == self.sequence + 1:
-                    self.sequence = i
-                    # send_sack_ack(self.socket, self, self.sequence)
-                    self.received_out_of_order.remove(i)
-                else:
-                    break
-            send_sack_ack(self.socket, self, self.sequence, self.received_out_of_order)
-
-        elif message["header"].sequence > self.sequence + 1:
-            logger.warning(
-                f"Fragmento {message['header'].sequence} recibido fuera de orden."
-            )
-            if message["header"].sequence not in self.received_out_of_order:
-                self.received_out_of_order.append(message["header"].sequence)
+    def handle_sack_ack(self, message):
+        if message.header.flags & UDPFlags.ACK:
+            self.retries = 0
+            self.process_sack(self.socket, message.header, message.data)
 
-        send_sack_ack(self.socket, self, self.sequence, self.received_out_of_order)
-        # time.sleep(0.05)
 
-    def handle_sack_ack(self, message):
-        if message["header"].has_ack():
-            self.window_sents -= 1
-            if message["header"].sequence > self.sequence:
-                self.window_sents -= message["header"].sequence - self.sequence
-                seq = self.sequence
-                self.sequence = message["header"].sequence
-
-                for i in range(seq, message["header"].sequence + 1):
-                    self.sequence = i
-                    if i in self.fragments:
-                        self.window_sents -= 1
-                        logger.info(f"Borrando fragmento {i}")
-                        del self.fragments[i]
+class ThreadedConnection(threading.Thread):
+    """Alimenta una sesion desde un hilo propio a traves de una cola de mensajes."""
 
-            else:
-                sack = message["header"].get_sequences()[1]
-                for i in sack:
-                    if i in self.fragments:
-                        self.window_sents -= 1
-                        del self.fragments[i]
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.message_queue = queue.Queue()
+
+    def run(self):
+        self.start_transfer()
+
+        while self.is_active:
+            message = None
+            try:
+                message = self.message_queue.get(timeout=self.next_timeout())
+                self.handle_message(message)
+            except queue.Empty:
+                self.handle_timeout()
+            except Exception as e:
+                logger.error(f"Error con {self.addr}: {e}")
+                self.is_active = False
+            finally:
+                if message is not None:
+                    message.release()
+
+        # Lo que quedo en la cola no se procesa, pero sus buffers vuelven al pool
+        while not self.message_queue.empty():
+            self.message_queue.get_nowait().release()
+        self.release_fragments()
+
+    def activate(self):
+        """Arranca la transferencia al confirmarse el START (una sola vez)."""
+        if not self.is_active and self.ident is None:
+            self.is_active = True
+            self.start()
+
+    def stop(self):
+        self.is_active = False
+        if self.is_alive():
+            self.join()
 
     def put_message(self, message):
-        """Agrega un mensaje a la cola para ser procesado por el hilo."""
+        """Agrega un mensaje a la cola para ser procesado por el hilo.
+
+        La conexion pasa a ser duena del buffer del mensaje.
+        """
+        self.rtt.on_receive(message.header)
         self.message_queue.put(message)
 
 
+class ClientConnection(StopAndWaitSession, ThreadedConnection):
+    def __init__(self, socket: socket.socket, addr, path, **kwargs):
+        StopAndWaitSession.__init__(self, socket, addr, path, **kwargs)
+        ThreadedConnection.__init__(self)
+
+
+class ClientConnectionSACK(SackSession, ThreadedConnection):
+    def __init__(self, socket: socket.socket, addr, path, **kwargs):
+        SackSession.__init__(self, socket, addr, path, **kwargs)
+        ThreadedConnection.__init__(self)
+
+
 class Connection(BaseConnection):
     """Clase que maneja conexiones genéricas."""
 
-    def __init__(self, addr, sequence=None, download=False, path=None):
-        super().__init__(addr, path, sequence, download)
+    def __init__(
+        self,
+        addr,
+        sequence=None,
+        download=False,
+        path=None,
+        protocol="stop_and_wait",
+        fsync=FSYNC_POLICY,
+        congestion=CONGESTION_CONTROL,
+        rate=None,
+        reordering=DUPACK_THRESHOLD,
+    ):
+        super().__init__(
+            addr,
+            path,
+            sequence,
+            download,
+            protocol,
+            fsync=fsync,
+            congestion=congestion,
+            rate=rate,
+            reordering=reordering,
+        )
 
 
 class CloseConnectionException(Exception):
@@ -299,56 +978,103 @@ class CloseConnectionException(Exception):
         self.codigo_error = codigo_error
 
 
+def new_header(connection: Connection, sequence):
+    """Crea el header de un paquete con la extension negociada por la conexion."""
+    header = UDPHeader(sequence, extended=connection.extended, crc=connection.crc)
+    if connection.extended:
+        header.ts = timestamp()
+        header.ts_echo = connection.rtt.ts_recent
+    return header
+
+
 def send_package(socket: socket.socket, connection: Connection, header, data):
-    package = UDPPackage().pack(header, data)
-    socket.sendto(package, connection.addr)
+    # Los paquetes de control pueden salir desde otro hilo que el de la
+    # conexion, asi que no usan su buffer de headers
+    send_buffers(socket, (header.pack(data), data), connection.addr)
 
 
-def send_data(
-    socket: socket.socket, connection: Connection, data: bytes, sequence=None
-):
+def data_package(connection: Connection, data, sequence=None, slot=0):
+    """Devuelve ``(header, payload)`` de un paquete de datos sin copiar el
+    payload, salvo que se haya negociado comprimirlo.
+
+    El header se escribe en el lugar ``slot`` del buffer de la conexion y vale
+    hasta el proximo envio que use ese lugar.
+    """
     seq = sequence if sequence else connection.sequence
-    header = UDPHeader(seq)
-    header.set_flag(UDPFlags.DATA)
-    package = UDPPackage().pack(header, data)
-    socket.sendto(package, connection.addr)
+    offset = slot * MAX_HEADER_SIZE
+    ts = timestamp() if connection.extended else None
+    codec = 0
+    if connection.compression is not None:
+        data, codec = connection.compression.compress(data, seq)
+    size = pack_header_into(
+        connection.header_buffer,
+        offset,
+        UDPFlags.DATA,
+        seq,
+        codec,  # Los DATA no llevan SACK: el campo indica la compresion
+        ts,
+        connection.rtt.ts_recent,
+    )
+    if connection.crc:
+        size = pack_crc_into(connection.header_buffer, offset, size, data)
+    return connection.header_view[offset : offset + size], data
+
+
+def parity_package(connection: Connection, first, field, parity, slot=0):
+    """Como data_package, para una paridad FEC del bloque que empieza en
+    ``first``: un DATA con el flag SACK y ``field`` en el campo del SACK
+    (ver lib.fec)."""
+    offset = slot * MAX_HEADER_SIZE
+    ts = timestamp() if connection.extended else None
+    flags = UDPFlags.DATA | UDPFlags.SACK
+    buffer = connection.header_buffer
+    size = pack_header_into(buffer, offset, flags, first, field, ts, connection.rtt.ts_recent)
+    if connection.crc:
+        size = pack_crc_into(buffer, offset, size, parity)
+    return connection.header_view[offset : offset + size], parity
+
+
+def send_data(socket: socket.socket, connection: Connection, data, sequence=None):
+    send_buffers(socket, data_package(connection, data, sequence), connection.addr)
 
 
 def send_ack(socket: socket.socket, connection: Connection, sequence=None):
     seq = sequence if sequence else connection.sequence
-    header = UDPHeader(seq)
+    header = new_header(connection, seq)
     header.set_flag(UDPFlags.ACK)
-    package = UDPPackage().pack(header, b"")
-    socket.sendto(package, connection.addr)
+    socket.sendto(header.pack(), connection.addr)
 
 
-def send_sack_ack(
-    socket: socket.socket, connection: Connection, sequence=None, sack_packages=[]
-):
-    sequence if sequence else connection.sequence
-    header = UDPHeader(connection.sequence)
+def send_sack_ack(socket: socket.socket, connection: Connection):
+    """Confirma el acumulado y lo recibido fuera de orden segun ``connection.reassembly``."""
+    header = new_header(connection, connection.sequence)
     header.set_flag(UDPFlags.ACK)
     header.set_flag(UDPFlags.SACK)
-    header.set_sack(sack_packages)
+    reassembly = connection.reassembly
+    connection.acks.on_ack_sent()
+    if connection.sack_blocks:
+        ranges = reassembly.sack_ranges(MAX_SACK_BLOCKS)
+        send_package(socket, connection, header, encode_sack_blocks(ranges))
+        return
+    header.set_sack(list(reassembly.sequences(32)))
     # if sack_packages:
     # 	print("Sack: ", format(header.sack, f'0{32}b'))
-    package = UDPPackage().pack(header, b"")
-    socket.sendto(package, connection.addr)
+    socket.sendto(header.pack(), connection.addr)
 
 
 def send_end(socket: socket.socket, connection: Connection):
-    header = UDPHeader(connection.sequence)
+    """Manda el END con el digest de lo enviado, si se negocio."""
+    header = new_header(connection, connection.sequence)
     header.set_flag(UDPFlags.END)
-    package = UDPPackage().pack(header, b"")
-    socket.sendto(package, connection.addr)
+    send_package(socket, connection, header, connection.local_digest())
 
 
 def send_end_confirmation(socket: socket.socket, connection: Connection):
-    header = UDPHeader(connection.sequence)
+    """Confirma el END con el digest de lo recibido, si se negocio."""
+    header = new_header(connection, connection.sequence)
     header.set_flag(UDPFlags.END)
     header.set_flag(UDPFlags.ACK)
-    package = UDPPackage().pack(header, b"")
-    socket.sendto(package, connection.addr)
+    send_package(socket, connection, header, connection.local_digest())
 
 
 def send_start_confirmation(socket: socket.socket, connection: Connection):
@@ -356,19 +1082,33 @@ def send_start_confirmation(socket: socket.socket, connection: Connection):
     # header.set_sack([11,15])
     header.set_flag(UDPFlags.START)
     header.set_flag(UDPFlags.ACK)
-    package = UDPPackage().pack(header, b"")
-    socket.sendto(package, connection.addr)
-
-
-def receive_package(socket: socket.socket):
-
-    data, addr = socket.recvfrom(PACKAGE_SIZE)
-    data, header = UDPPackage(data).unpack()
+    send_package(socket, connection, header, encode_options(connection.options))
+
+
+def receive_package(socket: socket.socket, connection: Connection = None):
+    """Recibe un paquete. Si se indica la conexion, se lee con el tamano de
+    fragmento y se desempaqueta con el header que negocio, y se actualiza su
+    estimacion de RTT. Los paquetes corruptos (si se negocio el CRC) se
+    descartan y se sigue esperando, como si se hubieran perdido."""
+    extended = connection is not None and connection.extended
+    crc = connection is not None and connection.crc
+    while True:
+        if connection is None:
+            data, addr = recv_package(socket)
+        else:
+            data, addr = recv_package(socket, connection.package_size)
+        try:
+            data, header = unpack_package(data, extended, crc)
+            break
+        except ValueError as e:
+            logger.warning(f"Paquete descartado de {addr}: {e}")
+    if connection is not None:
+        connection.rtt.on_receive(header)
     return addr, header, data
 
 
 def close_connection(socket: socket.socket, connection: Connection, data=""):
-    header = UDPHeader(0)
+    header = new_header(connection, 0)
     header.set_flag(UDPFlags.CLOSE)
     send_package(socket, connection, header, data.encode())
 
@@ -384,6 +1124,8 @@ def reject_connection(socket: socket.socket, connection: Connection):
 
 
 def is_data_available(socket: socket.socket, timeout=0.0):
+    if has_pending(socket):
+        return True
     ready = select.select([socket], [], [], timeout)
     return bool(ready[0])
 
@@ -391,14 +1133,27 @@ def is_data_available(socket: socket.socket, timeout=0.0):
 ###################
 # Common to clients
 def force_send_end(socket: socket.socket, connection: Connection, function):
-    for i in range(3):
+    """Manda el END (o su confirmacion) hasta que responda el otro extremo.
+    Devuelve False si no respondio, si cerro la conexion o si confirmo con
+    otro digest."""
+    attempts = 0
+    function(socket, connection)
+    while attempts < 3:
         try:
-            function(socket, connection)
-            addr, header, data = receive_package(socket)
-            if header.has_end():
-                break
+            socket.settimeout(connection.rtt.rto)
+            addr, header, data = receive_package(socket, connection)
+            if header.flags & UDPFlags.END:
+                return connection.check_peer_digest(data)
+            if header.flags & UDPFlags.CLOSE:
+                if data:
+                    logger.error(f"Cierre del servidor: [{bytes(data).decode()}]")
+                return False
+            # ACKs atrasados de la transferencia: no cuentan como intento
         except TimeoutError:
-            pass
+            attempts += 1
+            connection.rtt.on_timeout()
+            function(socket, connection)
+    return False
 
 
 def force_send_close(socket: socket.socket, connection: Connection, function):
@@ -406,16 +1161,180 @@ def force_send_close(socket: socket.socket, connection: Connection, function):
     for i in range(3):
         try:
             function(socket, connection)
-            addr, header, data = receive_package(socket)
-            if header.has_close():
+            addr, header, data = receive_package(socket, connection)
+            if header.flags & UDPFlags.CLOSE:
                 break
         except TimeoutError:
-            pass
+            connection.rtt.on_timeout()
+            socket.settimeout(connection.rtt.rto)
+
+
+def encode_options(options: dict) -> bytes:
+    return ";".join(f"{key}={value}" for key, value in options.items()).encode()
+
+
+def decode_options(data: bytes) -> dict:
+    options = {}
+    for option in bytes(data).decode().split(";"):
+        if "=" in option:
+            key, value = option.split("=", 1)
+            options[key] = value
+    return options
+
+
+def encode_start(path: str, options: dict) -> bytes:
+    """Payload del START: el nombre del archivo y, tras un NUL, las opciones pedidas."""
+    if not options:
+        return path.encode()
+    return path.encode() + b"\0" + encode_options(options)
+
+
+def decode_start(data: bytes):
+    """Inversa de encode_start. Los clientes viejos solo mandan el nombre."""
+    path, _, options = bytes(data).partition(b"\0")
+    return path.decode(), decode_options(options)
+
+
+def negotiate_options(
+    requested: dict,
+    rate=None,
+    ack_every=ACK_EVERY,
+    ack_delay=ACK_DELAY,
+    max_fragment=MAX_FRAGMENT_SIZE,
+) -> dict:
+    """Devuelve las opciones pedidas por el cliente que el servidor acepta.
+
+    ``rate`` es el limite por cliente del servidor; si el cliente pidio uno
+    tambien, rige el menor para ambos sentidos. Lo mismo con la frecuencia y
+    la demora de los ACK (en milisegundos), que aplica quien reciba los datos,
+    y con el tamano de fragmento, que ``max_fragment`` acota del lado del
+    servidor. La compresion se acepta si se conoce el codec, el FEC si el
+    bloque entra en los limites del codigo, y el CRC de cada datagrama y el
+    digest en el END siempre. Los valores que no son numeros validos se
+    ignoran y los que se salen de rango se acotan (un rate no positivo se
+    ignora): las opciones vienen del cliente.
+    """
+    accepted = {}
+    if requested.get("hdr") == str(HEADER_VERSION):
+        accepted["hdr"] = requested["hdr"]
+    if requested.get("sack") == SACK_BLOCKS:
+        accepted["sack"] = SACK_BLOCKS
+    for check in ("crc", "digest"):
+        if requested.get(check) == "1":
+            accepted[check] = "1"
+    every = parse_number(requested, "ack", int)
+    if every is not None:
+        accepted["ack"] = max(min(every, ack_every), 1)
+        delay = parse_number(requested, "ack_delay", float)
+        accepted["ack_delay"] = max(min(delay or 0, ack_delay), 0)
+    fragment = parse_number(requested, "frag", int)
+    if fragment is not None:
+        accepted["frag"] = max(min(fragment, max_fragment), MIN_FRAGMENT_SIZE)
+    if requested.get("comp") in CODECS:
+        accepted["comp"] = requested["comp"]
+    try:
+        accepted["fec"] = "%d:%d" % parse_fec(requested.get("fec", ""))
+        if requested.get("fec_adapt") == "1":
+            accepted["fec_adapt"] = "1"
+    except ValueError:
+        pass
+    transfer = requested.get("transfer", "")
+    if parse_stream(requested.get("stream", "")) and is_transfer_id(transfer):
+        accepted["stream"] = requested["stream"]
+        accepted["transfer"] = transfer
+    requested_rate = parse_number(requested, "rate", int)
+    rates = [requested_rate] if requested_rate is not None and requested_rate > 0 else []
+    if rate:
+        rates.append(rate)
+    if rates:
+        accepted["rate"] = min(rates)
+    return accepted
+
+
+def parse_number(options: dict, key: str, parse):
+    """Valor de la opcion ``key`` convertido con ``parse`` (int o float), o
+    None si falta o no es un numero finito."""
+    try:
+        value = parse(options[key])
+        return value if math.isfinite(value) else None
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+
+
+def parse_stream(value: str):
+    """``"i/n"`` a ``(i, n)``, o None si no es un stream valido."""
+    index, _, streams = value.partition("/")
+    if not (index.isdigit() and streams.isdigit()):
+        return None
+    index, streams = int(index), int(streams)
+    if not index < streams <= MAX_STREAMS:
+        return None
+    return index, streams
+
+
+def is_transfer_id(value: str) -> bool:
+    """El identificador termina en nombres de archivo: solo hexadecimal."""
+    return 0 < len(value) <= 32 and all(c in "0123456789abcdef" for c in value)
+
+
+def client_options(args, fragment_size=None) -> dict:
+    """Opciones que el cliente pide en el START. ``fragment_size`` es el
+    fragmento a pedir si no se fijo uno con --fragment-size."""
+    options = {"hdr": HEADER_VERSION}
+    if args.verify:
+        options["crc"] = 1
+        options["digest"] = 1
+    fragment_size = args.fragment_size or fragment_size
+    if fragment_size:
+        options["frag"] = fragment_size
+    if args.stream:
+        options["stream"] = "/".join(map(str, args.stream))
+        options["transfer"] = args.transfer
+    if args.protocol == "sack":
+        options["sack"] = SACK_BLOCKS
+        options["ack"] = args.ack_every
+        options["ack_delay"] = args.ack_delay
+    if args.rate:
+        options["rate"] = args.rate
+    if args.compress:
+        options["comp"] = args.compress
+    if args.fec and args.protocol == "sack":
+        options["fec"] = "%d:%d" % args.fec
+        if args.fec_adaptive:
+            options["fec_adapt"] = 1
+    return options
+
+
+def resume_request(args, DOWNLOAD) -> dict:
+    """Opciones para reanudar que el cliente pide en el START, salvo con
+    --no-resume. En un upload va el token del archivo a subir; en un download
+    el de la copia parcial que haya en destino, con los rangos que ya tiene y
+    su tamano de fragmento (o un token vacio si no hay ninguna)."""
+    if not args.resume:
+        return {}
+    if not DOWNLOAD:
+        return {"resume": resume_token(args.src)}
+    partial = find_partial(f"{args.dst}/{args.name}", args.stream or (0, 1))
+    if partial is None or args.fragment_size not in (None, partial[1]):
+        return {"resume": ""}
+    token, fragment_size, ranges = partial
+    return {
+        "resume": token,
+        "frag": fragment_size,
+        "have": encode_ranges(ranges[:RESUME_MAX_RANGES]),
+    }
 
 
 def connect_server(
-    client_socket: socket.socket, connection: Connection, DOWNLOAD: bool, args
+    client_socket: socket.socket,
+    connection: Connection,
+    DOWNLOAD: bool,
+    args,
+    extra=None,
 ):
+    """Hace el START. ``extra`` son opciones a pedir ademas de las de
+    ``args`` (la firma o el delta de un upload delta, o un paso de un
+    upload con dedup)."""
     header = UDPHeader(connection.sequence)
     header.set_flag(UDPFlags.START)
     if DOWNLOAD:
@@ -425,22 +1344,58 @@ def connect_server(
     elif args.protocol == "sack":
         header.set_flag(UDPFlags.PROTOCOL)
 
+    resume = resume_request(args, DOWNLOAD)
+    fragment_size = resume.get("frag")
+    if args.fragment_size is None and fragment_size is None:
+        fragment_size = path_fragment_size(connection.addr)
+        logger.info(f"Fragmento segun el MTU del camino: {fragment_size}")
+    options = client_options(args, fragment_size)
+    options.update(resume)
+    options.update(extra or {})
+    payload = encode_start(connection.path, options)
     try:
-        send_package(client_socket, connection, header, connection.path.encode())
-        addr, header, data = receive_package(client_socket)
-
-        if header.has_ack() and header.has_start() and header.sequence == 0:
-            header.set_flag(UDPFlags.ACK)
-            send_package(client_socket, connection, header, b"")
-            send_package(client_socket, connection, header, b"")
-            logger.info("Conexión establecida con el servidor.")
-            return True
-        else:
-            logger.error("Error: No se pudo establecer conexión con el servidor.")
-            return False
+        for _ in range(MAX_RETRIES):
+            send_package(client_socket, connection, header, payload)
+            client_socket.settimeout(connection.rtt.rto)
+            try:
+                addr, response, data = receive_package(client_socket)
+            except socket.timeout:
+                # Se perdio el START o su confirmacion: se reintenta con backoff
+                connection.rtt.on_timeout()
+                continue
+
+            handshake = UDPFlags.START | UDPFlags.ACK
+            if (response.flags & handshake) == handshake and response.sequence == 0:
+                connection.set_options(decode_options(data))
+                logger.info(f"Tamano de fragmento: {connection.fragment_size}")
+                if args.stream and connection.stream != args.stream:
+                    # Cada stream se tomaria por el archivo entero
+                    logger.error("Error: El servidor no soporta transferencias en streams.")
+                    return False
+                if "sig" in options and not connection.signature:
+                    # Mandaria el archivo entero en vez de su firma
+                    logger.error("Error: El servidor no soporta uploads delta.")
+                    return False
+                if ("manifest" in options or "missing" in options) and not connection.dedup:
+                    # Guardaria el manifiesto como si fuera el archivo
+                    logger.error("Error: El servidor no tiene chunk store.")
+                    return False
+                token = resume.get("resume")
+                if DOWNLOAD and token and connection.resume not in (None, token):
+                    # El archivo cambio en el servidor: lo descargado ya no sirve
+                    streams = connection.stream[1]
+                    discard_partial(f"{args.dst}/{args.name}", token, streams)
+                if connection.skip:
+                    logger.info(f"Reanudando: ya se tienen {encode_ranges(connection.skip)}")
+                header.set_flag(UDPFlags.ACK)
+                send_package(client_socket, connection, header, b"")
+                send_package(client_socket, connection, header, b"")
+                logger.info("Conexión establecida con el servidor.")
+                return True
+            break
+
+        logger.error("Error: No se pudo establecer conexión con el servidor.")
+        return False
     except ConnectionResetError:
         logger.error("Error: Conexión rechazada por el servidor.")
         return False
-    except socket.timeout:
-        logger.error("Error: No se pudo establecer conexión con el servidor.")
-        return False
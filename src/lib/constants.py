@@ -4,13 +4,76 @@ import struct
 TIMEOUT = 0.1  # Timeout in seconds
 TIMEOUT_SACK = 0.6  # Timeout in seconds
 MAX_RETRIES = 10  # Numero maximo de reintentos
-SACK_WINDOW_SIZE = 8
-SEND_WINDOW_SIZE = SACK_WINDOW_SIZE * 2
-
-MAX_SAC_DIF = 25
+MIN_RTO = 0.02  # Cotas del timeout de retransmision adaptativo (segundos)
+MAX_RTO = 3.0
+CLOCK_GRANULARITY = 0.001  # Resolucion de los timestamps del header
+INITIAL_CWND = 8  # Ventana de congestion inicial (paquetes)
+MIN_CWND = 2
+MAX_CWND = 1024
+DUPACK_THRESHOLD = 3  # Umbral de reordenamiento: SACKs o ACKs duplicados para dar un hueco por perdido
+MAX_REORDERING = 64  # Tope del umbral cuando se adapta tras retransmisiones espurias
+CONGESTION_CONTROL = "newreno"
 
 HEADER_FORMAT = "!B I I"
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
-FRAGMENT_SIZE = 1449
+EXT_HEADER_FORMAT = "!I I"  # Timestamp y eco del timestamp (ms)
+EXT_HEADER_SIZE = struct.calcsize(EXT_HEADER_FORMAT)
+CRC_FORMAT = "!I"  # CRC32 del datagrama, al final del header si se negocia
+CRC_SIZE = struct.calcsize(CRC_FORMAT)
+HEADER_VERSION = 2  # Version del header extendido que se negocia en el START
+SACK_BLOCKS = "ranges"  # Opcion del START para confirmar con rangos en vez del bitmap
+MAX_SACK_BLOCKS = 128  # Rangos por ACK (8 bytes cada uno, entra en un datagrama)
+ACK_EVERY = 2  # DATA que el receptor SACK junta antes de confirmar
+ACK_DELAY = 5.0  # Espera maxima de un ACK demorado (milisegundos)
+REASSEMBLY_SIZE = 2 * MAX_CWND  # Secuencias por delante del acumulado que marca el receptor
+FRAGMENT_SIZE = 1449  # Fragmento por defecto, el de los extremos que no negocian otro
 PACKAGE_SIZE = HEADER_SIZE + FRAGMENT_SIZE
-PACKAGE_SEND_DELAY = 0.1
+MAX_PACKAGE_SIZE = PACKAGE_SIZE + EXT_HEADER_SIZE + CRC_SIZE
+MAX_DATAGRAM_SIZE = 65507  # Mayor payload UDP sobre IPv4
+MIN_FRAGMENT_SIZE = 512  # Cotas del fragmento que se negocia en el START
+MAX_FRAGMENT_SIZE = MAX_DATAGRAM_SIZE - HEADER_SIZE - EXT_HEADER_SIZE - CRC_SIZE
+PMTU_PROBE_WAIT = 0.05  # Espera de un ICMP "fragmentation needed" por sonda (segundos)
+MAX_STREAMS = 64  # Sesiones paralelas de una misma transferencia (--streams)
+PACING_BURST = 8  # Paquetes que el pacer deja salir juntos
+PACING_GAIN_SS = 2.0  # Tasa de envio respecto de cwnd/RTT en arranque lento
+PACING_GAIN_CA = 1.25  # y en evitacion de congestion
+MIN_WAIT = 0.001  # Espera minima del emisor entre intentos de envio (segundos)
+READAHEAD_FRAGMENTS = 512  # Fragmentos a pedir por adelantado al leer el archivo
+WRITE_QUEUE_SIZE = 1024  # Fragmentos pendientes de escritura antes de frenar al receptor
+PREALLOCATE_SIZE = 8 * 1024 * 1024  # Bytes que se reservan en disco por adelantado
+FSYNC_POLICIES = ("never", "end", "always")
+FSYNC_POLICY = "end"
+RESUME_SAVE_INTERVAL = 1.0  # Segundos entre actualizaciones del mapa de lo recibido
+RESUME_MAX_RANGES = 64  # Rangos de fragmentos ya recibidos que viajan en el START
+DELTA_MIN_BLOCK = 1024  # Cotas del bloque de la firma de un upload delta (bytes)
+DELTA_MAX_BLOCK = 128 * 1024
+CHUNK_MIN_SIZE = 16 * 1024  # Cotas de los chunks del chunk store (bytes)
+CHUNK_MAX_SIZE = 256 * 1024
+CHUNK_MARKER_BITS = 13  # Bits de la marca de corte: chunks de ~32 KiB en promedio
+FILE_CACHE_SIZE = 0  # Bytes de archivos en memoria por proceso del servidor (0: sin cache)
+FILE_CACHE_HISTORY = 4096  # Archivos pedidos una vez que la cache recuerda para admitirlos
+MULTICAST_RATE = 10 * 1024 * 1024  # Tasa de una distribucion multicast sin --rate (bytes/s)
+MULTICAST_JOIN_WAIT = 1.0  # Espera de mas receptores antes de empezar a enviar (segundos)
+MULTICAST_NACK_INTERVAL = 0.05  # Espera minima del receptor entre NACKs (segundos)
+MULTICAST_REPAIR_SHARE = 0.25  # Fraccion de receptores que piden un fragmento para repararlo al grupo
+MULTICAST_IDLE_TIMEOUT = 10.0  # Silencio tras el cual se da por perdido al otro extremo (segundos)
+MULTICAST_TTL = 1  # Saltos de los datagramas al grupo
+MULTICAST_RECV_BUFFER = 4 * 1024 * 1024  # Buffer de recepcion de los receptores
+FEC_MAX_BLOCK = 128  # Cotas del FEC: fragmentos por bloque y paridades por bloque
+FEC_MAX_PARITY = 32
+FEC_ADAPT_BLOCKS = 32  # Bloques por evaluacion de la paridad adaptativa
+FEC_ADAPT_CLEAN = 4  # Evaluaciones sin retransmisiones para bajar una paridad
+FEC_PENDING_BYTES = 64 * 1024 * 1024  # Memoria del receptor para bloques FEC incompletos
+ZLIB_LEVEL = 1  # Niveles de compresion de los fragmentos (--compress)
+LZMA_PRESET = 6
+COMPRESSION_SAMPLE = 16  # Fragmentos por muestra de cuanto comprimen los datos
+COMPRESSION_MIN_SAVING = 0.1  # Ahorro minimo de una muestra para seguir comprimiendo
+COMPRESSION_BACKOFF = 64  # Fragmentos sin comprimir tras una muestra que no ahorro
+COMPRESSION_MAX_BACKOFF = 4096
+DIGEST_SIZE = 16  # Bytes del BLAKE2b de lo transferido que viaja en el END
+COMPRESSION_CACHE = 256  # Fragmentos enviados que se recuerdan comprimidos para reenviarlos
+WORKER_RESTART_DELAY = 1.0  # Espera antes de relanzar un worker caido (segundos)
+UDP_OFFLOAD = True  # Usar UDP GSO/GRO en Linux si el kernel lo soporta
+GSO_MAX_SEGMENTS = 64  # Datagramas por envio segmentado (limite del kernel)
+RECV_BATCH = 64  # Lecturas por despertar del servidor antes de volver a bloquearse
+RECV_POOL_BYTES = 4 * 1024 * 1024  # Memoria preasignada para buffers de recepcion
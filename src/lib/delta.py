@@ -0,0 +1,312 @@
+import hashlib
+import logging
+import math
+import mmap
+import os
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+
+from lib.constants import DELTA_MIN_BLOCK, DELTA_MAX_BLOCK
+from lib.fragments import resume_token
+
+logger = logging.getLogger("app_logger")
+
+# Upload delta al estilo rsync: el servidor firma por bloques la copia que ya
+# tiene, el cliente busca esos bloques en cualquier posicion de su archivo con
+# un checksum rodante y sube solo un delta (copias de bloques y datos
+# literales), y el servidor reconstruye el archivo junto al viejo.
+
+SIGNATURE_HEADER = struct.Struct("!8sQI")  # Token de la copia, tamano y bloque
+BLOCK_SIGNATURE = struct.Struct("!I16s")  # Checksum rodante y fuerte de un bloque
+DELTA_HEADER = struct.Struct("!I")  # Tamano de bloque de la firma usada
+COPY = b"C"  # Seguido de COPY_RUN: primer bloque de la copia y cantidad
+COPY_RUN = struct.Struct("!II")
+LITERAL = b"L"  # Seguido de LITERAL_SIZE y esa cantidad de bytes
+LITERAL_SIZE = struct.Struct("!Q")
+ADLER_MOD = 65521
+COPY_CHUNK = 1024 * 1024  # Bytes por lectura al reconstruir
+
+
+def delta_block_size(size):
+    """Bloque de la firma: cerca de la raiz del tamano, como rsync, asi la
+    firma y lo que se reenvia por cada cambio crecen parejo."""
+    block_size = math.isqrt(size) // 8 * 8
+    return min(max(block_size, DELTA_MIN_BLOCK), DELTA_MAX_BLOCK)
+
+
+def delta_path(path, token):
+    """Donde el servidor recibe el delta contra la version ``token`` de ``path``."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{token}.delta")
+
+
+def write_signature(path):
+    """Firma ``path`` en un temporal junto a el y devuelve su ruta.
+
+    La firma lleva el token de esta version del archivo, su tamano, el bloque
+    y por cada bloque su Adler-32 (que se puede rodar byte a byte) y un
+    BLAKE2b de 128 bits para confirmar las coincidencias.
+    """
+    token = resume_token(path)
+    directory, name = os.path.split(path)
+    with open(path, "rb") as basis:
+        size = os.fstat(basis.fileno()).st_size
+        block_size = delta_block_size(size)
+        fd, signature_path = tempfile.mkstemp(
+            dir=directory or ".", prefix=f".{name}.", suffix=".sig"
+        )
+        with os.fdopen(fd, "wb") as signature:
+            header = SIGNATURE_HEADER.pack(bytes.fromhex(token), size, block_size)
+            signature.write(header)
+            while block := basis.read(block_size):
+                weak, strong = zlib.adler32(block), _strong(block)
+                signature.write(BLOCK_SIGNATURE.pack(weak, strong))
+    return signature_path
+
+
+def read_signature(path):
+    """``(token, size, block_size, blocks)`` de una firma, con ``blocks`` la
+    lista de ``(adler32, blake2b)`` de cada bloque."""
+    with open(path, "rb") as signature:
+        data = signature.read()
+    token, size, block_size = SIGNATURE_HEADER.unpack_from(data)
+    blocks = list(BLOCK_SIGNATURE.iter_unpack(data[SIGNATURE_HEADER.size :]))
+    if block_size == 0 or len(blocks) != -(-size // block_size):
+        raise ValueError(f"Firma invalida: {path}")
+    return token.hex(), size, block_size, blocks
+
+
+def write_delta(path, signature, out_path, max_literal=None):
+    """Escribe en ``out_path`` las instrucciones para reconstruir ``path``
+    desde la copia firmada. Devuelve cuantos bytes salen de la copia y
+    cuantos van literales, o None si se pasan de ``max_literal``.
+
+    Se recorre el archivo con el Adler-32 de la ventana de un bloque: si
+    coincide con el de algun bloque (y el BLAKE2b lo confirma) se copia ese
+    bloque y se salta la ventana entera; si no, la ventana avanza un byte
+    actualizando el checksum en O(1) y ese byte queda literal.
+    """
+    token, size, block_size, blocks = signature
+    lookup = {}
+    for index, (weak, strong) in enumerate(blocks):
+        lookup.setdefault(weak, []).append(index)
+    last = len(blocks) - 1
+    last_size = size - last * block_size  # El ultimo bloque puede ser mas corto
+
+    with open(path, "rb") as source, open(out_path, "wb") as out:
+        length = os.fstat(source.fileno()).st_size
+        data = b""
+        if length > 0:
+            data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        delta = _DeltaWriter(out, data)
+        out.write(DELTA_HEADER.pack(block_size))
+
+        pos = literal = 0  # Ventana actual y comienzo de lo literal pendiente
+        end = length - block_size if blocks else -1  # Sin copia todo es literal
+        weak = None
+        while pos <= end:
+            if weak is None:
+                weak = zlib.adler32(data[pos : pos + block_size])
+                a, b = weak & 0xFFFF, weak >> 16
+            candidates = lookup.get(weak)
+            if candidates is not None:
+                strong = _strong(data[pos : pos + block_size])
+                match = next((i for i in candidates if blocks[i][1] == strong), None)
+                if match is not None:
+                    delta.literal(literal, pos)
+                    delta.copy(match)
+                    pos += block_size
+                    literal = pos
+                    weak = None
+                    continue
+            if pos == end:
+                break
+            pending = delta.literal_bytes + pos - literal
+            if max_literal is not None and pending > max_literal:
+                break  # Ya no compensa: se abandona sin terminar el delta
+            removed, added = data[pos], data[pos + block_size]
+            a = (a - removed + added) % ADLER_MOD
+            b = (b - block_size * removed + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            pos += 1
+
+        # El final puede coincidir con el ultimo bloque de la copia, mas corto
+        tail = length - last_size
+        if (
+            0 < last_size < block_size
+            and tail >= literal
+            and _strong(data[tail:length]) == blocks[last][1]
+        ):
+            delta.literal(literal, tail)
+            delta.copy(last)
+        else:
+            delta.literal(literal, length)
+        delta.flush()
+        if length > 0:
+            data.close()
+    if max_literal is not None and delta.literal_bytes > max_literal:
+        return None
+    return length - delta.literal_bytes, delta.literal_bytes
+
+
+def apply_delta(path, delta, token, fsync=True):
+    """Reconstruye ``path`` desde su copia actual y las instrucciones de
+    ``delta``, en un temporal junto a el que despues lo reemplaza de forma
+    atomica. Falla si ``path`` ya no es la version ``token`` que se firmo."""
+    if resume_token(path) != token:
+        raise ValueError(f"{path} cambio desde que se firmo")
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory or ".", prefix=f".{name}.", suffix=".new"
+    )
+    try:
+        os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        with os.fdopen(fd, "wb") as out, open(path, "rb") as basis:
+            with open(delta, "rb") as instructions:
+                _rebuild(basis, instructions, out)
+            out.flush()
+            if fsync:
+                os.fsync(out.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        _remove(temp_path)
+        raise
+    finally:
+        _remove(delta)
+
+
+def fetch_signature(args, directory):
+    """Descarga en ``directory`` la firma de la copia del servidor, con
+    download.py en otro proceso. Devuelve la firma, o None si el servidor no
+    tiene el archivo o no soporta deltas."""
+    script = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "download.py")
+    command = [
+        sys.executable,
+        script,
+        "-H",
+        args.host,
+        "-p",
+        str(args.port),
+        "-n",
+        args.name,
+        "-d",
+        directory,
+        "-P",
+        args.protocol,
+        "--signature",
+        "--no-resume",
+        "-q",
+    ]
+    if subprocess.run(command).returncode != 0:
+        return None
+    return read_signature(os.path.join(directory, args.name))
+
+
+def prepare_delta(args):
+    """Arma el delta de ``args.src`` contra la copia del servidor.
+
+    Devuelve ``(token, path)``, con el token de la copia y el archivo con el
+    delta (ver discard_delta), o None si conviene subir el archivo entero.
+    """
+    directory = tempfile.mkdtemp(prefix="delta-")
+    path = os.path.join(directory, "delta")
+    signature = fetch_signature(args, os.path.join(directory, "signature"))
+    if signature is None:
+        logger.info("Sin firma de la copia del servidor, se sube el archivo entero")
+        shutil.rmtree(directory)
+        return None
+    size = os.path.getsize(args.src)
+    result = write_delta(args.src, signature, path, max_literal=size // 2)
+    if result is None or os.path.getsize(path) >= size:
+        logger.info("El archivo cambio demasiado, se sube entero")
+        shutil.rmtree(directory)
+        return None
+    copied, literal = result
+    logger.info(f"Delta: {copied} bytes ya estan en el servidor, {literal} literales")
+    return signature[0], path
+
+
+def discard_delta(path):
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+class _DeltaWriter:
+    """Escribe las instrucciones juntando en una sola las copias de bloques
+    consecutivos."""
+
+    def __init__(self, out, data):
+        self.out = out
+        self.data = data
+        self.first = 0  # Copia pendiente: primer bloque y cantidad
+        self.count = 0
+        self.literal_bytes = 0
+
+    def copy(self, index):
+        if self.count and index == self.first + self.count:
+            self.count += 1
+            return
+        self.flush()
+        self.first, self.count = index, 1
+
+    def literal(self, start, end):
+        if end <= start:
+            return
+        self.flush()
+        self.out.write(LITERAL + LITERAL_SIZE.pack(end - start))
+        self.out.write(self.data[start:end])
+        self.literal_bytes += end - start
+
+    def flush(self):
+        if self.count:
+            self.out.write(COPY + COPY_RUN.pack(self.first, self.count))
+            self.count = 0
+
+
+def _rebuild(basis, instructions, out):
+    size = os.fstat(basis.fileno()).st_size
+    (block_size,) = DELTA_HEADER.unpack(_read(instructions, DELTA_HEADER.size))
+    blocks = -(-size // block_size)
+    while kind := instructions.read(1):
+        if kind == COPY:
+            first, count = COPY_RUN.unpack(_read(instructions, COPY_RUN.size))
+            if count == 0 or first + count > blocks:
+                raise ValueError(f"Copia fuera de la copia anterior: {first}+{count}")
+            basis.seek(first * block_size)
+            _copy(basis, out, min(count * block_size, size - first * block_size))
+        elif kind == LITERAL:
+            (length,) = LITERAL_SIZE.unpack(_read(instructions, LITERAL_SIZE.size))
+            _copy(instructions, out, length)
+        else:
+            raise ValueError(f"Instruccion de delta desconocida: {kind!r}")
+
+
+def _copy(source, out, length):
+    while length > 0:
+        chunk = source.read(min(length, COPY_CHUNK))
+        if not chunk:
+            raise ValueError("Delta truncado")
+        out.write(chunk)
+        length -= len(chunk)
+
+
+def _read(source, size):
+    data = source.read(size)
+    if len(data) != size:
+        raise ValueError("Delta truncado")
+    return data
+
+
+def _strong(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
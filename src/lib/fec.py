@@ -0,0 +1,295 @@
+import logging
+from collections import deque
+from functools import lru_cache
+
+from lib.constants import (
+    FEC_MAX_BLOCK,
+    FEC_MAX_PARITY,
+    FEC_ADAPT_BLOCKS,
+    FEC_ADAPT_CLEAN,
+    FEC_PENDING_BYTES,
+)
+
+logger = logging.getLogger("app_logger")
+
+# Aritmetica en GF(2^8) con el polinomio 0x11d
+_EXP = [0] * 510
+_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    _EXP[_power] = _EXP[_power + 255] = _value
+    _LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11D
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def gf_inv(a):
+    return _EXP[255 - _LOG[a]]
+
+
+@lru_cache(maxsize=None)
+def coefficient(parity, index):
+    """Coeficiente del fragmento ``index`` en la paridad ``parity``.
+
+    Es una matriz de Cauchy ``1 / (x_j + y_i)`` con ``x_j = 255 - j`` e
+    ``y_i = i``, asi que cualquier conjunto de paridades y fragmentos
+    recibidos alcanza para despejar los que faltan (MDS). Cada columna se
+    divide por la primera fila, que queda en unos: la primera paridad es el
+    XOR de los fragmentos.
+    """
+    return gf_mul(255 ^ index, gf_inv((255 - parity) ^ index))
+
+
+@lru_cache(maxsize=None)
+def _table(factor):
+    return bytes(gf_mul(factor, value) for value in range(256))
+
+
+def _scaled(data, factor):
+    """``data`` multiplicado byte a byte por ``factor``, como entero para
+    sumarlo (XOR) con otros; los fragmentos mas cortos quedan con ceros."""
+    if factor != 1:
+        data = bytes(data).translate(_table(factor))
+    return int.from_bytes(data, "little")
+
+
+def invert(matrix):
+    """Inversa de una matriz cuadrada en GF(2^8) (Gauss-Jordan)."""
+    size = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next(r for r in range(col, size) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(scale, value) for value in rows[col]]
+        for r in range(size):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [a ^ gf_mul(factor, b) for a, b in zip(rows[r], rows[col])]
+    return [row[size:] for row in rows]
+
+
+def pack_parity(count, parity, last):
+    """Campo del SACK de un paquete de paridad: fragmentos del bloque, indice
+    de la paridad y largo del ultimo fragmento del bloque."""
+    return count << 24 | parity << 16 | last
+
+
+def unpack_parity(value):
+    return value >> 24, value >> 16 & 0xFF, value & 0xFFFF
+
+
+def parse_fec(value):
+    """``(K, M)`` de una opcion ``K:M``: M paridades por bloque de K fragmentos.
+    ValueError si no entra en los limites del codigo."""
+    block, _, parity = value.partition(":")
+    block, parity = int(block), int(parity)
+    if not 1 <= block <= FEC_MAX_BLOCK or not 1 <= parity <= min(block, FEC_MAX_PARITY):
+        raise ValueError(f"bloque FEC invalido: {value}")
+    return block, parity
+
+
+class FecEncoder:
+    """Paridades de los bloques de ``block`` fragmentos que envia el emisor.
+
+    Se alimenta con cada fragmento la primera vez que sale, en orden, y al
+    completar un bloque devuelve sus paridades. Se acumulan a medida que
+    pasan los fragmentos, asi que no hay que volver a leerlos. Con
+    ``adaptive`` la cantidad de paridades se ajusta cada FEC_ADAPT_BLOCKS
+    bloques: sube si hubo que retransmitir algo de alguno (la perdida supero
+    a la paridad) y baja tras FEC_ADAPT_CLEAN evaluaciones sin
+    retransmisiones.
+
+    ``pipe`` son las paridades en vuelo, que el emisor suma a las de su
+    scoreboard para la ventana: las de un bloque dejan de contar cuando el
+    receptor confirma la ultima secuencia del bloque (o algo posterior), ya
+    que para entonces llegaron o se perdieron, o cuando vence el RTO.
+    """
+
+    def __init__(self, block, parity, total, fragment_size, adaptive=False):
+        self.block = block
+        self.parity = parity
+        self.total = total
+        self.fragment_size = fragment_size
+        self.adaptive = adaptive
+        self.minimum = 1 if adaptive else parity
+        self.sent = 0  # Paquetes de paridad enviados
+        self.blocks = 0  # Bloques completos
+        self.failed = set()  # Bloques con retransmisiones desde la ultima evaluacion
+        self.clean = 0  # Evaluaciones seguidas sin retransmisiones
+        self.pipe = 0  # Paridades en vuelo
+        self._in_flight = deque()  # (ultima secuencia del bloque, paridades)
+        self._next = None  # Secuencia que sigue en el bloque en curso
+        self._sums = []  # Paridades del bloque en curso
+
+    def add(self, seq, data):
+        """Suma un fragmento. Si ``seq`` completa el bloque devuelve sus
+        paridades como ``(campo, payload)`` (ver pack_parity)."""
+        index = (seq - 1) % self.block
+        if index == 0:
+            self._sums = [0] * self.parity
+        elif seq != self._next:
+            # Falto un fragmento del bloque: queda sin paridad
+            self._next = None
+            return []
+        self._next = seq + 1
+        for parity in range(len(self._sums)):
+            self._sums[parity] ^= _scaled(data, coefficient(parity, index))
+        if index + 1 < self.block and seq < self.total:
+            return []
+
+        parities = []
+        for parity, value in enumerate(self._sums):
+            field = pack_parity(index + 1, parity, len(data))
+            parities.append((field, value.to_bytes(self.fragment_size, "little")))
+        self._next = None
+        self.sent += len(parities)
+        self.pipe += len(parities)
+        self._in_flight.append((seq, len(parities)))
+        self.blocks += 1
+        if self.adaptive and self.blocks % FEC_ADAPT_BLOCKS == 0:
+            self._adapt()
+        return parities
+
+    def on_ack(self, highest):
+        """El receptor confirmo hasta ``highest`` (acumulado o por SACK)."""
+        while self._in_flight and self._in_flight[0][0] <= highest:
+            self.pipe -= self._in_flight.popleft()[1]
+
+    def on_timeout(self):
+        self._in_flight.clear()
+        self.pipe = 0
+
+    def on_retransmit(self, seq):
+        self.failed.add((seq - 1) // self.block)
+
+    def summary(self):
+        return (
+            f"FEC: {self.sent} paridades enviadas en {self.blocks} bloques de "
+            f"{self.block} ({self.parity} por bloque al final)"
+        )
+
+    def _adapt(self):
+        if self.failed:
+            self.parity = min(self.parity + 1, self.block, FEC_MAX_PARITY)
+            self.clean = 0
+        else:
+            self.clean += 1
+            if self.clean >= FEC_ADAPT_CLEAN and self.parity > self.minimum:
+                self.parity -= 1
+                self.clean = 0
+        self.failed.clear()
+        logger.debug(f"FEC: {self.parity} paridades por bloque de {self.block}")
+
+
+class FecDecoder:
+    """Reconstruye en el receptor los fragmentos perdidos de cada bloque.
+
+    Guarda una copia de lo recibido de los bloques incompletos (``received``
+    es el ReassemblyTracker de la conexion) y las paridades que llegan; en
+    cuanto un bloque tiene tantas paridades como fragmentos le faltan, los
+    despeja. Si lo guardado supera FEC_PENDING_BYTES se descartan los bloques
+    mas viejos y lo que les falta queda para las retransmisiones.
+    """
+
+    def __init__(self, block, fragment_size, received):
+        self.block = block
+        self.fragment_size = fragment_size
+        self.received = received
+        self.recovered = 0  # Fragmentos reconstruidos
+        self.size = 0  # Bytes guardados
+        self._blocks = {}  # Primera secuencia -> [k, ultimo largo, datos, paridades]
+
+    def add_data(self, seq, data):
+        """Registra un fragmento recibido (ya marcado en ``received``).
+        Devuelve los ``(seq, fragmento)`` que se pudieron reconstruir."""
+        first = seq - (seq - 1) % self.block
+        state = self._state(first)
+        if self._complete(first, state):
+            self._drop(first)
+            return []
+        data = bytes(data)
+        state[2][seq - first] = data
+        self.size += len(data)
+        return self._recover(first, state)
+
+    def add_parity(self, first, field, payload):
+        """Registra la paridad ``payload`` del bloque que empieza en ``first``,
+        descripta por ``field`` (ver pack_parity). Devuelve los
+        ``(seq, fragmento)`` que se pudieron reconstruir."""
+        count, parity, last = unpack_parity(field)
+        if (first - 1) % self.block or not 1 <= count <= self.block:
+            return []
+        if len(payload) != self.fragment_size or not 0 < last <= self.fragment_size:
+            return []
+        state = self._state(first)
+        state[0], state[1] = count, last
+        if self._complete(first, state):
+            self._drop(first)
+            return []
+        data = bytes(payload)
+        state[3][parity] = data
+        self.size += len(data)
+        return self._recover(first, state)
+
+    def summary(self):
+        return f"FEC: {self.recovered} fragmentos reconstruidos sin retransmitir"
+
+    def _state(self, first):
+        state = self._blocks.get(first)
+        if state is None:
+            state = self._blocks[first] = [self.block, None, {}, {}]
+        return state
+
+    def _complete(self, first, state):
+        return all(first + index in self.received for index in range(state[0]))
+
+    def _recover(self, first, state):
+        count, last, data, parities = state
+        missing = [i for i in range(count) if i not in data]
+        if any(first + i in self.received for i in missing):
+            # Se descarto antes de completarse: ya no estan todos los datos
+            self._drop(first)
+            return []
+        if last is None or len(missing) > len(parities):
+            self._trim()
+            return []
+
+        rows = sorted(parities)[: len(missing)]
+        sums = []
+        for parity in rows:
+            value = int.from_bytes(parities[parity], "little")
+            for index, fragment in data.items():
+                value ^= _scaled(fragment, coefficient(parity, index))
+            sums.append(value.to_bytes(self.fragment_size, "little"))
+        inverse = invert([[coefficient(p, i) for i in missing] for p in rows])
+
+        recovered = []
+        for row, index in zip(inverse, missing):
+            value = 0
+            for factor, partial in zip(row, sums):
+                if factor:
+                    value ^= _scaled(partial, factor)
+            length = last if index == count - 1 else self.fragment_size
+            fragment = value.to_bytes(self.fragment_size, "little")[:length]
+            recovered.append((first + index, fragment))
+        self.recovered += len(recovered)
+        self._drop(first)
+        return recovered
+
+    def _drop(self, first):
+        state = self._blocks.pop(first, None)
+        if state is not None:
+            stored = list(state[2].values()) + list(state[3].values())
+            self.size -= sum(map(len, stored))
+
+    def _trim(self):
+        while self.size > FEC_PENDING_BYTES and self._blocks:
+            self._drop(min(self._blocks))
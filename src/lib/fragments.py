@@ -0,0 +1,664 @@
+import glob
+import hashlib
+import mmap
+import os
+import queue
+import secrets
+import threading
+import time
+import logging
+from bisect import bisect
+from collections import deque
+
+from lib.constants import (
+    FRAGMENT_SIZE,
+    READAHEAD_FRAGMENTS,
+    WRITE_QUEUE_SIZE,
+    PREALLOCATE_SIZE,
+    FSYNC_POLICIES,
+    FSYNC_POLICY,
+    RESUME_SAVE_INTERVAL,
+    DIGEST_SIZE,
+    REASSEMBLY_SIZE,
+)
+from lib.reassembly import ReassemblyTracker
+
+logger = logging.getLogger("app_logger")
+
+
+class FragmentSource:
+    """Fuente de fragmentos de salida respaldada por mmap.
+
+    Se comporta como el diccionario ``{seq: fragmento}`` de fragmentos pendientes
+    que usaban las conexiones, pero sin cargar el archivo en memoria: cada
+    fragmento se entrega como un ``memoryview`` sobre el mapeo recien cuando se
+    pide, y solo se guardan los numeros de secuencia ya confirmados.
+
+    Con ``stream=(i, n)`` solo se recorre uno de ``n`` streams paralelos: la
+    secuencia ``seq`` es el fragmento ``(seq - 1) * n + i`` del archivo. Al
+    reanudar, ``skip`` son los rangos de fragmentos que el receptor ya tiene
+    y las secuencias numeran solo los que faltan (ver MissingFragments).
+
+    Con ``digest`` se calcula el de los fragmentos del stream (ver
+    FragmentDigest) a medida que se leen para enviarlos por primera vez.
+
+    Con ``data`` (el contenido del archivo ya en memoria, ver lib.cache) los
+    fragmentos son vistas de solo lectura sobre ``data`` y no se abre el
+    archivo.
+    """
+
+    def __init__(
+        self,
+        path,
+        fragment_size=FRAGMENT_SIZE,
+        stream=(0, 1),
+        skip=(),
+        digest=False,
+        data=None,
+    ):
+        self.path = path
+        self.fragment_size = fragment_size
+        self.index, self.streams = stream
+        self.missing = MissingFragments(skip)
+        self._file = None
+        if data is None:
+            self._file = open(path, "rb")
+            self.size = os.fstat(self._file.fileno()).st_size
+        else:
+            self.size = len(data)
+        fragments = (self.size + fragment_size - 1) // fragment_size
+        self.stripe = (fragments - self.index + self.streams - 1) // self.streams
+        self.total = self.stripe - self.missing.count(self.stripe)
+        self.digest = None
+        self._digest = FragmentDigest() if digest else None
+        self._map = None
+        self._view = None
+        if data is not None:
+            self._view = memoryview(data).toreadonly()
+        elif self.size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+            self._advise(getattr(mmap, "MADV_SEQUENTIAL", None), 0, self.size)
+        self._base = 1  # Primer fragmento no confirmado
+        self._acked = set()  # Confirmados por encima de _base
+        self._readahead_until = 0
+        self.readahead(1)
+
+    def __len__(self):
+        return self.total - (self._base - 1) - len(self._acked)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __contains__(self, seq):
+        return self._base <= seq <= self.total and seq not in self._acked
+
+    def __iter__(self):
+        for seq in range(self._base, self.total + 1):
+            if seq not in self._acked:
+                yield seq
+
+    def __getitem__(self, seq):
+        if seq not in self:
+            raise KeyError(seq)
+        if seq + READAHEAD_FRAGMENTS // 2 > self._readahead_until:
+            self.readahead(seq)
+        fragment = self.missing.fragment(seq)
+        if self._digest is not None:
+            self._update_digest(fragment)
+        return self._fragment(fragment)
+
+    def __delitem__(self, seq):
+        if seq not in self:
+            raise KeyError(seq)
+        self._mark_acked(seq)
+
+    def items(self):
+        for seq in self:
+            yield seq, self[seq]
+
+    def pop(self, seq, default=None):
+        if seq not in self:
+            return default
+        data = bytes(self[seq])
+        self._mark_acked(seq)
+        return data
+
+    def finish_digest(self):
+        """Digest de todos los fragmentos del stream, o None sin ``digest``."""
+        if self._digest is not None and self.digest is None:
+            self._update_digest(self.stripe)
+            self.digest = self._digest.digest()
+        return self.digest
+
+    def readahead(self, seq):
+        """Pide al kernel que traiga en segundo plano los proximos fragmentos."""
+        last = min(seq + READAHEAD_FRAGMENTS, self.total + 1)
+        if last <= self._readahead_until:
+            return
+        first = max(seq, self._readahead_until)
+        start = self._offset(first)
+        # madvise exige offsets alineados a pagina
+        start -= start % mmap.PAGESIZE
+        end = min(self._offset(last), self.size)
+        self._advise(getattr(mmap, "MADV_WILLNEED", None), start, end - start)
+        self._readahead_until = last
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Todavia hay memoryviews vivos, se libera cuando se recolecten
+                pass
+            self._map = None
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+    def _offset(self, seq):
+        fragment = self.missing.fragment(seq)
+        return _offset(fragment, self.fragment_size, self.index, self.streams)
+
+    def _fragment(self, fragment):
+        start = _offset(fragment, self.fragment_size, self.index, self.streams)
+        return self._view[start : start + self.fragment_size]
+
+    def _update_digest(self, last):
+        # Tambien los salteados al reanudar, que el receptor ya tiene
+        digest = self._digest
+        while digest.next <= last:
+            digest.update(self._fragment(digest.next))
+
+    def _mark_acked(self, seq):
+        if seq == self._base:
+            self._base += 1
+            while self._base in self._acked:
+                self._acked.remove(self._base)
+                self._base += 1
+        else:
+            self._acked.add(seq)
+        if not self:
+            self.finish_digest()  # Antes de cerrar el mapeo
+            self.close()
+
+    def _advise(self, option, start, length):
+        if self._map is None or option is None or length <= 0:
+            return
+        try:
+            self._map.madvise(option, start, length)
+        except (AttributeError, OSError) as e:
+            logger.debug(f"madvise no disponible: {e}")
+
+
+class FragmentSink:
+    """Destino de fragmentos recibidos que escribe directo en disco.
+
+    Cada fragmento se escribe en su offset ``(seq - 1) * fragment_size`` de un
+    archivo temporal junto al destino, desde un hilo escritor alimentado por una
+    cola acotada, para que el hilo de red nunca espere al disco. ``commit()``
+    espera las escrituras pendientes, aplica la politica de fsync y renombra el
+    temporal al destino de forma atomica.
+
+    Con ``stream=(i, n)`` se recibe uno de ``n`` streams paralelos (ver
+    FragmentSource). Los streams de una misma ``transfer`` comparten el
+    temporal, que puede estar abierto en otros hilos o procesos; cada uno deja
+    al terminar un archivo de marca con el tamano que alcanzo, y el que
+    encuentra las ``n`` marcas es quien renombra.
+
+    Con un token de ``resume`` el temporal se nombra por el token y, si la
+    transferencia se interrumpe, close() lo conserva junto con un mapa de los
+    fragmentos ya escritos (que tambien se actualiza cada tanto, por si el
+    proceso muere). Una transferencia con el mismo token retoma ese temporal y
+    recibe solo lo que falta: ``skip`` son los rangos que el emisor saltea.
+
+    Con ``digest`` el hilo escritor calcula el de los fragmentos del stream
+    (ver FragmentDigest): los que llegan en orden se suman al escribirlos y
+    los que llegan antes de tiempo se releen del temporal cuando se llena el
+    hueco, igual que lo recibido antes de reanudar.
+
+    Con ``block=False`` write() nunca espera: si la cola esta llena el
+    fragmento queda en ``backlog`` hasta que flush(), desde otro hilo, lo pase
+    a la cola. Es para el event loop del motor asyncio, que no puede frenarse
+    por un disco lento.
+    """
+
+    def __init__(
+        self,
+        path,
+        fragment_size=FRAGMENT_SIZE,
+        fsync=FSYNC_POLICY,
+        queue_size=WRITE_QUEUE_SIZE,
+        stream=(0, 1),
+        transfer=None,
+        resume=None,
+        skip=(),
+        digest=False,
+        block=True,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Politica de fsync no soportada: {fsync}")
+        self.path = path
+        self.fragment_size = fragment_size
+        self.fsync = fsync
+        self.index, self.streams = stream
+        self.resume = resume
+        self.missing = MissingFragments(skip)
+        self.size = 0
+        self.committed = False
+        self.complete = False  # El archivo ya esta en su destino
+        self._received = set()
+        self._written = ReassemblyTracker()  # Fragmentos ya en disco
+        self._digest = FragmentDigest() if digest else None
+        self._saved = time.monotonic()  # Ultima vez que se guardo el mapa
+        self._error = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.temp_path = _temp_path(path, resume or transfer or secrets.token_hex(4))
+        if resume is not None:
+            self._load_map(skip)
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if transfer is None and resume is None:
+            flags |= os.O_EXCL
+        self._fd = os.open(self.temp_path, flags, 0o666)
+        self._allocated = os.fstat(self._fd).st_size
+        self._window = REASSEMBLY_SIZE * fragment_size * self.streams
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._block = block
+        self._pending = deque()  # Fragmentos que esperan lugar en la cola
+        self._flush_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def __len__(self):
+        return len(self._received)
+
+    def __bool__(self):
+        return len(self._received) > 0
+
+    def __contains__(self, seq):
+        return seq in self._received
+
+    def __setitem__(self, seq, data):
+        self.write(seq, data)
+
+    def write(self, seq, data, buffer=None):
+        """Encola el fragmento para escribirlo. Devuelve False si ya se tenia.
+
+        ``buffer`` es el buffer de recepcion que respalda ``data``; se libera
+        con ``buffer.release()`` una vez escrito (o enseguida si se descarta).
+        """
+        if self._error is not None or seq in self._received:
+            if buffer is not None:
+                buffer.release()
+            if self._error is not None:
+                raise self._error
+            return False
+        self._received.add(seq)
+        fragment = self.missing.fragment(seq)
+        offset = _offset(fragment, self.fragment_size, self.index, self.streams)
+        self.size = max(self.size, offset + len(data))
+        item = (offset, data, buffer, fragment)
+        if self._block:
+            self._queue.put(item)
+        elif self._pending:
+            self._pending.append(item)  # Detras de los que ya esperan
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._pending.append(item)
+        return True
+
+    @property
+    def backlog(self):
+        """Fragmentos recibidos que todavia no entraron en la cola del escritor."""
+        return len(self._pending)
+
+    def flush(self):
+        """Pasa el backlog a la cola del escritor, esperando lugar si hace falta."""
+        with self._flush_lock:
+            while self._pending:
+                self._queue.put(self._pending.popleft())
+
+    def finish_digest(self):
+        """Espera las escrituras pendientes y devuelve el digest de lo
+        recibido, o None sin ``digest``."""
+        self._stop_writer()
+        if self._error is not None:
+            raise self._error
+        if self._digest is None:
+            return None
+        self._update_digest()
+        return self._digest.digest()
+
+    def discard(self):
+        """Descarta lo recibido aunque se pudiera reanudar (no coincidio el
+        digest, asi que algo de lo escrito esta mal)."""
+        self.resume = None
+        self.close()
+        _remove([_map_path(self.temp_path, self.index)])
+
+    def commit(self):
+        """Vuelca lo pendiente y mueve el archivo temporal a su destino final.
+
+        Devuelve True si el archivo quedo en su destino, False si faltan otros
+        streams de la transferencia.
+        """
+        if self.committed:
+            return self.complete
+        self._stop_writer()
+        if self._error is not None:
+            self.close()
+            raise self._error
+        if self.resume is not None:
+            # Si falta otro stream y hay que reanudar, este ya no se repite
+            self._save_map()
+        size = self._finish_stream() if self.streams > 1 else self.size
+        if size is not None:
+            os.ftruncate(self._fd, size)
+        if self.fsync != "never":
+            os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        self.committed = True
+        if size is not None:
+            self._replace()
+        return self.complete
+
+    def close(self):
+        """Descarta la transferencia si no se confirmo con commit(). Con varios
+        streams se descarta la transferencia entera. Si se puede reanudar se
+        conserva lo recibido."""
+        if self.committed:
+            return
+        self._stop_writer()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self.resume is not None:
+            self._save_map()
+            logger.info(f"Transferencia interrumpida, se conserva {self.temp_path}")
+            return
+        paths = [self.temp_path]
+        if self.streams > 1:
+            paths += [self._marker(i) for i in range(self.streams)]
+        _remove(paths)
+
+    def _marker(self, index):
+        return f"{self.temp_path}.{index}.done"
+
+    def _load_map(self, skip):
+        """Retoma lo que una transferencia anterior con el mismo token dejo
+        escrito en el temporal."""
+        saved = None
+        if os.path.exists(self.temp_path):
+            saved = _read_map(_map_path(self.temp_path, self.index))
+        if saved is not None and saved[:2] == (self.fragment_size, self.streams):
+            self.size = saved[2]
+            for start, end in saved[3]:
+                self._written.add_range(start, end)
+        elif skip:
+            raise FileNotFoundError(f"No hay nada para reanudar en {self.temp_path}")
+        # Si termino en la transferencia anterior, vuelve a marcarse al terminar
+        _remove([self._marker(self.index)])
+
+    def _save_map(self):
+        """Guarda que fragmentos ya estan escritos. El mapa se escribe aparte y
+        se renombra, asi si el proceso muere a la mitad queda el anterior."""
+        self._saved = time.monotonic()
+        path = _map_path(self.temp_path, self.index)
+        try:
+            with open(f"{path}.tmp", "w") as saved:
+                saved.write(f"{self.fragment_size} {self.streams} {self.size}\n")
+                saved.write(encode_ranges(self._written.received()))
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar {path}: {e}")
+
+    def _finish_stream(self):
+        """Deja la marca de este stream. Si ya estan las de todos devuelve el
+        tamano final del archivo (el mayor alcanzado), si no None."""
+        if not os.path.exists(self.temp_path):
+            raise FileNotFoundError(f"Otro stream descarto {self.temp_path}")
+        with open(self._marker(self.index), "w") as marker:
+            marker.write(str(self.size))
+        sizes = []
+        for index in range(self.streams):
+            try:
+                with open(self._marker(index)) as marker:
+                    sizes.append(int(marker.read()))
+            except (FileNotFoundError, ValueError):
+                return None  # Falta ese stream (o esta escribiendo su marca)
+        return max(sizes)
+
+    def _replace(self):
+        try:
+            os.replace(self.temp_path, self.path)
+        except FileNotFoundError:
+            # Otro stream vio todas las marcas al mismo tiempo y ya lo movio
+            pass
+        paths = [_map_path(self.temp_path, i) for i in range(self.streams)]
+        if self.streams > 1:
+            paths += [self._marker(i) for i in range(self.streams)]
+        _remove(paths)
+        self.complete = True
+
+    def _stop_writer(self):
+        if self._writer.is_alive():
+            self.flush()
+            self._queue.put(None)
+            self._writer.join()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            offset, data, buffer, fragment = item
+            try:
+                if self._error is None:
+                    self._preallocate(offset + len(data))
+                    _pwrite(self._fd, data, offset)
+                    if self.fsync == "always":
+                        os.fsync(self._fd)
+                    self._written.add(fragment)
+                    if self._digest is not None:
+                        if fragment == self._digest.next:
+                            self._digest.update(data)
+                        self._update_digest()
+                    if self.resume is not None:
+                        if time.monotonic() - self._saved >= RESUME_SAVE_INTERVAL:
+                            self._save_map()
+            except OSError as e:
+                logger.error(f"Error escribiendo {self.temp_path}: {e}")
+                self._error = e
+            finally:
+                if buffer is not None:
+                    buffer.release()
+
+    def _update_digest(self):
+        digest = self._digest
+        while digest.next in self._written:
+            offset = _offset(digest.next, self.fragment_size, self.index, self.streams)
+            size = min(self.fragment_size, self.size - offset)
+            digest.update(os.pread(self._fd, size, offset))
+
+    def _preallocate(self, end):
+        # Solo hasta REASSEMBLY_SIZE fragmentos mas alla de lo reservado: un
+        # offset lejano (de un emisor roto) no agranda el archivo hasta ahi
+        if end <= self._allocated or end > self._allocated + self._window:
+            return
+        size = end + PREALLOCATE_SIZE
+        try:
+            os.posix_fallocate(self._fd, self._allocated, size - self._allocated)
+        except (AttributeError, OSError):
+            # Sin fallocate (Windows, algunos FS) el archivo crece con cada escritura
+            pass
+        self._allocated = size
+
+
+class FragmentDigest:
+    """BLAKE2b de los fragmentos de un stream en el orden del archivo.
+
+    Emisor y receptor lo calculan mientras leen y escriben, sin volver a
+    recorrer el archivo, y lo comparan en el END. Cubre todo el stream, aun
+    lo salteado al reanudar; con un solo stream es el del archivo entero.
+    """
+
+    def __init__(self):
+        self.next = 1  # Proximo fragmento a sumar
+        self._hash = hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+    def update(self, data):
+        """Suma ``data`` como el fragmento ``next``."""
+        self._hash.update(data)
+        self.next += 1
+
+    def digest(self):
+        return self._hash.digest()
+
+
+class MissingFragments:
+    """Numeracion de los fragmentos que faltan al reanudar una transferencia.
+
+    ``ranges`` son los rangos ``[inicio, fin]`` de fragmentos que el receptor
+    ya tiene, tal como viajaron en el START. La secuencia ``seq`` de la
+    transferencia reanudada es el ``seq``-esimo fragmento que no esta en
+    ellos: emisor y receptor numeran igual sin intercambiar la lista de
+    faltantes, y ACKs, SACK y END siguen funcionando sobre ``1..faltantes``.
+    """
+
+    def __init__(self, ranges=()):
+        self.ranges = list(ranges)
+        self._firsts = []  # Primera secuencia que cae despues de cada rango
+        self._skipped = []  # Fragmentos salteados hasta cada rango inclusive
+        skipped = 0
+        for start, end in self.ranges:
+            self._firsts.append(start - skipped)
+            skipped += end - start + 1
+            self._skipped.append(skipped)
+
+    def fragment(self, seq):
+        """Fragmento que lleva la secuencia ``seq``."""
+        i = bisect(self._firsts, seq)
+        return seq + self._skipped[i - 1] if i else seq
+
+    def count(self, last):
+        """Fragmentos salteados entre 1 y ``last``."""
+        return sum(max(min(end, last) - start + 1, 0) for start, end in self.ranges)
+
+
+def resume_token(path):
+    """Identifica la version de ``path``: cambia si el archivo se modifica,
+    asi nunca se completa un temporal con datos de otra version."""
+    stat = os.stat(path)
+    key = f"{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}"
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+def find_partial(path, stream=(0, 1), token=None):
+    """Busca lo que dejo una transferencia interrumpida hacia ``path``.
+
+    Devuelve ``(token, fragment_size, ranges)`` del mapa del stream, el de
+    ``token`` o si no se indica el mas reciente, o None si no hay ninguno.
+    """
+    index, streams = stream
+    directory, name = os.path.split(path)
+    prefix, suffix = f".{name}.", f".part.{index}.map"
+    if token is not None:
+        tokens = [token]
+    else:
+        pattern = glob.escape(os.path.join(directory, prefix)) + "*" + suffix
+        maps = sorted(glob.glob(pattern), key=_mtime, reverse=True)
+        tokens = [os.path.basename(m)[len(prefix) : -len(suffix)] for m in maps]
+    for token in tokens:
+        temp_path = _temp_path(path, token)
+        saved = _read_map(_map_path(temp_path, index))
+        if saved is not None and saved[1] == streams and os.path.exists(temp_path):
+            return token, saved[0], saved[3]
+    return None
+
+
+def discard_partial(path, token, streams=1):
+    """Borra una transferencia interrumpida que ya no se puede reanudar."""
+    temp_path = _temp_path(path, token)
+    paths = [temp_path]
+    for index in range(streams):
+        paths += [_map_path(temp_path, index), f"{temp_path}.{index}.done"]
+    _remove(paths)
+
+
+def encode_ranges(ranges):
+    return ",".join(f"{start}-{end}" for start, end in ranges)
+
+
+def decode_ranges(value):
+    """Inversa de encode_ranges. Lanza ValueError si los rangos no estan
+    ordenados o se solapan."""
+    ranges = []
+    last = 0
+    for item in filter(None, value.split(",")):
+        start, _, end = item.partition("-")
+        start, end = int(start), int(end)
+        if not last < start <= end:
+            raise ValueError(f"Rango invalido: {item}")
+        ranges.append([start, end])
+        last = end
+    return ranges
+
+
+def _temp_path(path, token):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{token}.part")
+
+
+def _map_path(temp_path, index):
+    return f"{temp_path}.{index}.map"
+
+
+def _read_map(path):
+    """``(fragment_size, streams, size, ranges)`` guardados en un mapa, o None
+    si no existe o esta incompleto."""
+    try:
+        with open(path) as saved:
+            header, _, ranges = saved.read().partition("\n")
+        fragment_size, streams, size = (int(value) for value in header.split())
+        return fragment_size, streams, size, decode_ranges(ranges.strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _offset(seq, fragment_size, index=0, streams=1):
+    """Posicion en el archivo del fragmento ``seq`` del stream ``index``."""
+    return ((seq - 1) * streams + index) * fragment_size
+
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, "pwrite"):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = memoryview(data)[written:]
+            offset += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
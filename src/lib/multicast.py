@@ -0,0 +1,463 @@
+import ipaddress
+import logging
+import queue
+import socket
+import threading
+import time
+
+from lib.constants import (
+    MIN_FRAGMENT_SIZE,
+    FRAGMENT_SIZE,
+    MAX_SACK_BLOCKS,
+    MULTICAST_RATE,
+    MULTICAST_JOIN_WAIT,
+    MULTICAST_NACK_INTERVAL,
+    MULTICAST_REPAIR_SHARE,
+    MULTICAST_IDLE_TIMEOUT,
+    MULTICAST_TTL,
+    MULTICAST_RECV_BUFFER,
+)
+from lib.connection import (
+    BaseConnection,
+    data_package,
+    new_header,
+    send_package,
+    send_end,
+    close_connection,
+)
+from lib.fragments import FragmentSource
+from lib.offload import send_buffers
+from lib.udp import UDPFlags, encode_sack_blocks, decode_sack_blocks
+
+logger = logging.getLogger("app_logger")
+
+FANOUT = "fanout"  # Grupo emulado: cada datagrama del grupo va por unicast a cada receptor
+
+
+def parse_group(value):
+    """``(ip, puerto)`` de un grupo ``IP:PUERTO``, o None para el grupo
+    emulado. ValueError si no es un grupo multicast IPv4."""
+    if value == FANOUT:
+        return None
+    host, _, port = value.rpartition(":")
+    if not ipaddress.IPv4Address(host).is_multicast:
+        raise ValueError(f"{host} no es una direccion multicast")
+    port = int(port)
+    if not 0 < port < 65536:
+        raise ValueError(f"puerto invalido: {port}")
+    return host, port
+
+
+def plan_repairs(requests, receivers, share=MULTICAST_REPAIR_SHARE):
+    """Reparte una ronda de reparaciones entre el grupo y el unicast.
+
+    ``requests`` mapea cada receptor a los rangos ``(inicio, fin)`` que le
+    faltan y ``receivers`` es la cantidad de receptores de la sesion. Devuelve
+    tramos ``(inicio, fin, destinos)`` ordenados y sin solaparse: ``destinos``
+    es None si el tramo lo piden al menos dos receptores y al menos ``share``
+    de todos, y sale una vez al grupo, o la lista de quienes lo piden, que lo
+    reciben por unicast.
+    """
+    events = []
+    for receiver, ranges in requests.items():
+        for start, end in ranges:
+            events.append((start, 1, receiver))
+            events.append((end + 1, -1, receiver))
+    events.sort(key=lambda event: event[0])
+
+    plan = []
+    active = []
+    for i, (position, change, receiver) in enumerate(events):
+        if change > 0:
+            active.append(receiver)
+        else:
+            active.remove(receiver)
+        following = events[i + 1][0] if i + 1 < len(events) else position
+        if not active or following == position:
+            continue
+        multicast = len(active) >= max(2, share * receivers)
+        targets = None if multicast else list(active)
+        if plan and plan[-1][1] == position - 1 and plan[-1][2] == targets:
+            plan[-1] = (plan[-1][0], following - 1, targets)
+        else:
+            plan.append((position, following - 1, targets))
+    return plan
+
+
+def missing_ranges(received, last, limit=MAX_SACK_BLOCKS):
+    """Rangos ``(inicio, fin)`` hasta ``last`` que faltan en ``received``
+    (un ReassemblyTracker), a lo sumo ``limit``, los primeros antes."""
+    missing = []
+    start = received.cumulative + 1
+    for first, end in received.ranges:
+        if start > last or len(missing) == limit:
+            return missing
+        missing.append((start, min(first - 1, last)))
+        start = end + 1
+    if start <= last and len(missing) < limit:
+        missing.append((start, last))
+    return missing
+
+
+def send_nack(socket, connection, ranges):
+    """Pide los rangos que faltan: un ACK del acumulado con los rangos en el
+    payload. Sin rangos avisa que se recibio todo."""
+    header = new_header(connection, connection.sequence)
+    header.set_flag(UDPFlags.ACK)
+    send_package(socket, connection, header, encode_sack_blocks(ranges))
+
+
+def open_group_socket(connection):
+    """Socket unido al grupo que confirmo el servidor, sobre la interfaz que
+    lleva al servidor. None si el grupo es emulado y los datos llegan por el
+    socket de la conexion."""
+    group = parse_group(connection.options["mcast"])
+    if group is None:
+        return None
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(connection.addr)
+        interface = probe.getsockname()[0]
+    finally:
+        probe.close()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MULTICAST_RECV_BUFFER)
+    sock.bind(("", group[1]))
+    membership = socket.inet_aton(group[0]) + socket.inet_aton(interface)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    logger.info(f"Unido al grupo {group[0]}:{group[1]} por {interface}")
+    return sock
+
+
+def open_sender(interface=None):
+    """Socket de una sesion: manda al grupo por ``interface`` (la IP en la que
+    escucha el servidor) y los datagramas vuelven a este host, por si hay
+    receptores locales."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    if interface and interface != "0.0.0.0":
+        sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface)
+        )
+        sock.bind((interface, 0))
+    return sock
+
+
+class MulticastMember(BaseConnection):
+    """Receptor de una distribucion multicast del lado del servidor.
+
+    Ocupa el lugar de la conexion del cliente: el servidor le despacha el
+    handshake y el cierre como a cualquier otra, pero los ACKs (NACKs y
+    avisos de fin) pasan a la sesion del archivo.
+    """
+
+    def __init__(self, addr, path):
+        super().__init__(addr, path, download=True)
+        self.session = None
+        self.missing = None  # Rangos del ultimo NACK, hasta que los tome una ronda
+        self.done = False  # Ya recibio todo
+        self.last_heard = time.monotonic()
+
+    def activate(self):
+        self.is_active = True
+
+    def stop(self):
+        self.is_active = False
+        if self.session is not None:
+            self.session.leave(self)
+
+    def put_message(self, message):
+        # La sesion solo necesita los rangos: se copian y se libera el buffer
+        data = bytes(message.data)
+        message.release()
+        self.session.put(self, message.header, data)
+
+
+class MulticastSession(BaseConnection, threading.Thread):
+    """Distribucion de un archivo a los receptores que lo piden con
+    ``--multicast``.
+
+    Cada fragmento sale una sola vez al grupo, a la tasa fija ``rate``: no hay
+    control de congestion porque el grupo no tiene un unico RTT. Los
+    receptores piden lo que les falta con NACKs (ver send_nack) y cada ronda
+    de reparaciones junta los ultimos de todos: lo que piden varios vuelve a
+    salir al grupo y lo que piden pocos va por unicast a cada uno (ver
+    plan_repairs), asi que lo que envia el servidor casi no crece con la
+    cantidad de receptores. Mientras dura una ronda se ignoran los NACKs de
+    sus receptores, que pueden pedir lo que la ronda esta reenviando; los
+    receptores los repiten.
+
+    Quien ya tiene todo lo avisa y recibe por unicast el END con el digest;
+    la confirmacion del END y el CLOSE los atiende el servidor con el
+    MulticastMember del receptor.
+    """
+
+    def __init__(
+        self,
+        group,
+        path,
+        fragment_size,
+        rate=None,
+        interface=None,
+        store=None,
+        cache=None,
+    ):
+        BaseConnection.__init__(
+            self, group, path, download=True, rate=rate or MULTICAST_RATE, cache=cache
+        )
+        threading.Thread.__init__(self, daemon=True)
+        self.group = group
+        self.store = store
+        self.target = f"{group[0]}:{group[1]}" if group else FANOUT
+        self.fragment_size = fragment_size
+        self.pacer.set_package_size(self.package_size)
+        self.crc = True
+        self.verify = True
+        self.sender = open_sender(interface)
+        self.members = {}  # Direccion -> MulticastMember
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.on_close = None  # Aviso al distribuidor cuando termina
+        self.joined = 0  # Receptores que se sumaron en total
+        self.next_seq = 1  # Proximo fragmento de la primera pasada
+        self.finished_at = None  # Fin de la primera pasada
+        self.repairs = iter(())  # Ronda de reparaciones en curso
+        self.round = set()  # Receptores de esa ronda
+        self.sent = 0  # Datagramas al grupo
+        self.repaired = 0  # Reparaciones al grupo
+        self.unicast = 0  # Reparaciones por unicast
+        self.bytes_sent = 0  # Bytes que salieron del servidor
+
+    def __repr__(self):
+        return f"Multicast ({self.target}, {self.path})"
+
+    def member_options(self):
+        """Opciones con las que se confirma el START de cada receptor."""
+        return {
+            "mcast": self.target,
+            "msrc": self.sender.getsockname()[1],
+            "frag": self.fragment_size,
+            "crc": "1",
+            "digest": "1",
+            "size": self.fragments.size,
+        }
+
+    def add(self, member):
+        """Suma un receptor. False si la sesion ya termino."""
+        with self.lock:
+            if self.closed:
+                return False
+            self.members[member.addr] = member
+            self.joined += 1
+        member.session = self
+        member.set_options(self.member_options())
+        return True
+
+    def leave(self, member):
+        with self.lock:
+            self.members.pop(member.addr, None)
+
+    def put(self, member, header, data):
+        self.queue.put((member, header, data))
+
+    def run(self):
+        try:
+            self.distribute()
+        except Exception as e:
+            logger.error(f"Error en la distribucion multicast de {self.path}: {e}")
+        finally:
+            with self.lock:
+                self.closed = True
+                members = list(self.members.values())
+            for member in members:
+                close_connection(self.sender, member, "Distribucion multicast cortada.")
+            self.release_fragments()
+            self.sender.close()
+            if self.on_close is not None:
+                self.on_close(self)
+            logger.info(self.summary())
+
+    def distribute(self):
+        total = self.fragments.total
+        self.digest = self.fragments.finish_digest()
+        self.receive(MULTICAST_JOIN_WAIT)
+        logger.info(f"{self}: enviando a {len(self.members)} receptores")
+        repair_turn = False
+        while self.members:
+            self.receive(0)
+            repair = None
+            if repair_turn or self.next_seq > total:
+                repair = self.next_repair()
+            repair_turn = not repair_turn
+            if repair is not None:
+                self.send(*repair)
+            elif self.next_seq <= total:
+                self.send(self.next_seq)
+                self.next_seq += 1
+            else:
+                if self.finished_at is None:
+                    self.finished_at = time.monotonic()
+                self.receive(MULTICAST_NACK_INTERVAL)
+                self.drop_idle()
+
+    def receive(self, timeout):
+        """Procesa los mensajes de los receptores que lleguen en ``timeout``."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    member, header, data = self.queue.get(timeout=remaining)
+                else:
+                    member, header, data = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self.handle(member, header, data)
+
+    def handle(self, member, header, data):
+        member.last_heard = time.monotonic()
+        if not header.flags & UDPFlags.ACK:
+            return
+        if header.sequence >= self.fragments.total and not data:
+            # Recibio todo: el END se repite mientras lo siga avisando
+            if not member.done:
+                logger.info(f"{self}: {member.addr} recibio todo")
+            member.done = True
+            member.digest = self.digest
+            send_end(self.sender, member)
+        elif member not in self.round:
+            ranges = []
+            for start, end in decode_sack_blocks(data):
+                # Lo que todavia no salio no es una perdida
+                start, end = max(start, 1), min(end, self.next_seq - 1)
+                if start <= end:
+                    ranges.append((start, end))
+            member.missing = ranges
+
+    def next_repair(self):
+        """Proxima ``(secuencia, destinos)`` a reparar, o None. Al terminar
+        una ronda arma la siguiente con los NACKs que hayan llegado."""
+        repair = next(self.repairs, None)
+        if repair is None:
+            self.repairs = self.repair_round()
+            repair = next(self.repairs, None)
+        if repair is None:
+            self.round = set()
+        return repair
+
+    def repair_round(self):
+        with self.lock:
+            members = list(self.members.values())
+        requests = {}
+        for member in members:
+            if member.missing and not member.done:
+                requests[member] = member.missing
+            member.missing = None
+        self.round = set(requests)
+        for start, end, targets in plan_repairs(requests, len(members)):
+            for seq in range(start, end + 1):
+                yield seq, targets
+
+    def send(self, seq, targets=None):
+        """Manda el fragmento ``seq`` al grupo o, si es una reparacion por
+        unicast, a cada receptor de ``targets``."""
+        header, payload = data_package(self, self.fragments[seq], seq)
+        size = len(header) + len(payload)
+        if targets is not None:
+            addrs = [member.addr for member in targets]
+            self.pacer.wait(size * len(addrs))
+            self.unicast += len(addrs)
+        else:
+            if self.group is not None:
+                addrs = [self.group]
+            else:
+                with self.lock:
+                    addrs = list(self.members)
+            # Con el grupo emulado se respeta la tasa del grupo real
+            self.pacer.wait(size)
+            self.sent += 1
+            if seq < self.next_seq:
+                self.repaired += 1
+        for addr in addrs:
+            send_buffers(self.sender, (header, payload), addr)
+        self.bytes_sent += size * len(addrs)
+
+    def drop_idle(self):
+        """Da por perdidos a los receptores que no avisan nada desde el fin
+        de la primera pasada."""
+        now = time.monotonic()
+        with self.lock:
+            members = list(self.members.values())
+        for member in members:
+            if now - max(member.last_heard, self.finished_at) > MULTICAST_IDLE_TIMEOUT:
+                logger.warning(f"{self}: {member.addr} no responde, se lo saca")
+                self.leave(member)
+                close_connection(self.sender, member, "Sin respuesta del receptor.")
+
+    def summary(self):
+        size = self.fragments.size if self.fragments else 0
+        ratio = self.bytes_sent / size if size else 0.0
+        return (
+            f"{self}: {self.joined} receptores, {self.sent} envios al grupo "
+            f"({self.repaired} reparaciones), {self.unicast} reparaciones unicast, "
+            f"{self.bytes_sent} bytes enviados ({ratio:.2f} veces el archivo)"
+        )
+
+
+class MulticastDistributor:
+    """Sesiones multicast del servidor, una por archivo a la vez.
+
+    Un receptor que pide un archivo que ya se esta distribuyendo se suma a
+    esa sesion y pide con NACKs lo que se envio antes de que llegara; si no
+    hay ninguna, arranca una nueva que espera MULTICAST_JOIN_WAIT a que se
+    sumen otros antes de enviar.
+    """
+
+    def __init__(
+        self, group, interface=None, rate=None, max_fragment=None, store=None, cache=None
+    ):
+        self.group = parse_group(group)
+        self.interface = interface
+        self.rate = rate
+        self.max_fragment = max_fragment
+        self.store = store
+        self.cache = cache
+        self.sessions = {}  # Ruta -> MulticastSession
+        self.lock = threading.Lock()
+
+    def join(self, member, requested):
+        """Suma ``member`` a la sesion de su archivo segun las opciones que
+        pidio. False si el archivo no se puede enviar."""
+        with self.lock:
+            session = self.sessions.get(member.path)
+            if session is not None and session.add(member):
+                return True
+            fragment = int(requested.get("frag", FRAGMENT_SIZE))
+            if self.max_fragment:
+                fragment = min(fragment, self.max_fragment)
+            session = MulticastSession(
+                self.group,
+                member.path,
+                max(fragment, MIN_FRAGMENT_SIZE),
+                self.rate,
+                self.interface,
+                self.store,
+                self.cache,
+            )
+            session.get_fragments()
+            if not isinstance(session.fragments, FragmentSource):
+                session.sender.close()
+                return False
+            session.add(member)
+            session.on_close = self.finished
+            self.sessions[member.path] = session
+            session.start()
+        return True
+
+    def finished(self, session):
+        with self.lock:
+            if self.sessions.get(session.path) is session:
+                del self.sessions[session.path]
@@ -0,0 +1,234 @@
+import errno
+import logging
+import socket
+import struct
+import sys
+import threading
+import weakref
+from collections import deque
+
+from lib.constants import (
+    MAX_PACKAGE_SIZE,
+    UDP_OFFLOAD,
+    GSO_MAX_SEGMENTS,
+    RECV_BATCH,
+    RECV_POOL_BYTES,
+)
+
+logger = logging.getLogger("app_logger")
+
+# Valores de linux/udp.h, por si el modulo socket no los expone
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+GRO_BUFFER_SIZE = 65535  # Maximo de un datagrama coalescido por GRO
+
+# Errores con los que el kernel o la interfaz rechazan la segmentacion
+GSO_ERRORS = (errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP, errno.EIO)
+
+gso_enabled = UDP_OFFLOAD and sys.platform.startswith("linux")
+gro_sockets = weakref.WeakKeyDictionary()  # socket -> datagramas ya separados
+
+
+def send_buffers(sock, buffers, addr):
+    """Envia un datagrama armado por partes (header, payload) sin juntarlas."""
+    if hasattr(sock, "sendmsg"):
+        sock.sendmsg(buffers, (), 0, addr)
+    else:
+        # Transportes de asyncio y plataformas sin sendmsg
+        sock.sendto(b"".join(buffers), addr)
+
+
+def send_packages(sock, packages, addr):
+    """Envia una lista de datagramas al mismo destino.
+
+    Cada datagrama es una secuencia de buffers, como en ``send_buffers``. En
+    Linux las tiradas de datagramas del mismo tamano salen en un unico
+    ``sendmsg`` con UDP_SEGMENT (GSO) y el kernel los separa; si el kernel no lo
+    soporta se desactiva y se vuelve a un envio por datagrama.
+    """
+    global gso_enabled
+    sizes = [sum(map(len, package)) for package in packages]
+    start = 0
+    while start < len(packages):
+        end = _segment_run(sizes, start)
+        if gso_enabled and end - start > 1 and hasattr(sock, "sendmsg"):
+            buffers = [buffer for package in packages[start:end] for buffer in package]
+            segment = [(SOL_UDP, UDP_SEGMENT, struct.pack("H", sizes[start]))]
+            try:
+                sock.sendmsg(buffers, segment, 0, addr)
+                start = end
+                continue
+            except OSError as e:
+                if e.errno not in GSO_ERRORS:
+                    raise
+                logger.warning(f"UDP GSO no disponible ({e}), se envia sin segmentar")
+                gso_enabled = False
+        for package in packages[start:end]:
+            send_buffers(sock, package, addr)
+        start = end
+
+
+def _segment_run(sizes, start):
+    """Fin de la tirada que GSO puede mandar junta: mismo tamano, salvo el
+    ultimo que puede ser menor, y a lo sumo GSO_MAX_SEGMENTS y 64 KiB."""
+    size = sizes[start]
+    limit = min(len(sizes), start + GSO_MAX_SEGMENTS, start + GRO_BUFFER_SIZE // size)
+    end = start + 1
+    while end < limit and sizes[end] == size:
+        end += 1
+    if end < limit and sizes[end] < size:
+        end += 1
+    return end
+
+
+def enable_gro(sock):
+    """Pide al kernel que entregue coalescidos los datagramas de un mismo flujo.
+
+    Solo debe usarse en sockets que se leen con ``recv_package``, que es quien
+    sabe separarlos. Devuelve False si el kernel no lo soporta.
+    """
+    if not (UDP_OFFLOAD and sys.platform.startswith("linux")):
+        return False
+    try:
+        sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError as e:
+        logger.info(f"UDP GRO no disponible: {e}")
+        return False
+    gro_sockets[sock] = deque()
+    return True
+
+
+def recv_package(sock, bufsize=MAX_PACKAGE_SIZE):
+    """``recvfrom`` que separa los datagramas coalescidos por GRO."""
+    pending = gro_sockets.get(sock)
+    if pending is None:
+        return sock.recvfrom(bufsize)
+    if pending:
+        return pending.popleft()
+
+    data, ancdata, flags, addr = sock.recvmsg(GRO_BUFFER_SIZE, socket.CMSG_SPACE(4))
+    size = gro_segment_size(ancdata)
+    if not size or size >= len(data):
+        return data, addr
+    view = memoryview(data)
+    for offset in range(size, len(data), size):
+        pending.append((view[offset : offset + size], addr))
+    return view[:size], addr
+
+
+class PooledBuffer:
+    """Buffer de recepcion que vuelve a su pool cuando se liberan todos los
+    datagramas que apuntan a el (varios si GRO los recibio juntos)."""
+
+    __slots__ = ("pool", "data", "view", "refs", "shared")
+
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.refs = 0
+        self.shared = False
+
+    def share(self, refs):
+        self.refs = refs
+        self.shared = True
+
+    def release(self):
+        if not self.shared:
+            # Un unico duenio: no hay con quien competir
+            self.refs = 0
+            self.pool.free.append(self)
+            return
+        with self.pool.lock:
+            self.refs -= 1
+            if self.refs == 0:
+                self.pool.free.append(self)
+
+
+class BufferPool:
+    """Buffers preasignados para ``receive_batch``.
+
+    Si se agotan se crean mas, que quedan en el pool al liberarse, asi que
+    crece hasta la cantidad de datagramas que la aplicacion retiene a la vez
+    (por ejemplo, los que esperan al hilo escritor).
+    """
+
+    def __init__(self, buffer_size, total_bytes=RECV_POOL_BYTES):
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()  # Solo para buffers compartidos por GRO
+        count = max(total_bytes // buffer_size, RECV_BATCH)
+        self.free = deque(PooledBuffer(self, buffer_size) for _ in range(count))
+        self.misses = 0  # Buffers creados porque el pool estaba vacio
+
+    def acquire(self):
+        try:
+            buffer = self.free.pop()
+        except IndexError:
+            self.misses += 1
+            buffer = PooledBuffer(self, self.buffer_size)
+        buffer.refs = 1
+        buffer.shared = False
+        return buffer
+
+
+def create_pool(sock, package_size=MAX_PACKAGE_SIZE):
+    """Pool con buffers para datagramas de hasta ``package_size`` bytes (del
+    maximo que coalesce GRO si ``sock`` lo usa)."""
+    return BufferPool(GRO_BUFFER_SIZE if sock in gro_sockets else package_size)
+
+
+def receive_batch(sock, pool, limit=RECV_BATCH):
+    """Espera el primer datagrama y sigue leyendo sin bloquear los que ya esten
+    en cola, hasta ``limit`` lecturas, sobre buffers del pool.
+
+    Genera ``(addr, payload_view, buffer)`` a medida que lee; cada datagrama se
+    libera con ``buffer.release()`` cuando ya no se necesita su contenido.
+    Las lecturas extra usan MSG_DONTWAIT, que no cambia el modo del socket para
+    los hilos que envian por el; con timeout (o sin MSG_DONTWAIT) Python espera
+    antes de cada lectura, asi que se lee un datagrama por llamada.
+    """
+    gro = sock in gro_sockets
+    dontwait = getattr(socket, "MSG_DONTWAIT", None)
+    if sock.gettimeout() is not None:
+        dontwait = None
+    flags = 0
+    for _ in range(limit):
+        buffer = pool.acquire()
+        try:
+            if gro:
+                nbytes, ancdata, _, addr = sock.recvmsg_into(
+                    [buffer.data], socket.CMSG_SPACE(4), flags
+                )
+            else:
+                nbytes, addr = sock.recvfrom_into(buffer.data, 0, flags)
+        except OSError:
+            buffer.release()
+            if flags:
+                return  # Cola vacia (o error) tras leer algo: se procesa lo que hay
+            raise
+
+        size = gro_segment_size(ancdata) if gro else 0
+        if size and size < nbytes:
+            view = buffer.view[:nbytes]
+            buffer.share((nbytes + size - 1) // size)
+            for offset in range(0, nbytes, size):
+                yield addr, view[offset : offset + size], buffer
+        else:
+            yield addr, buffer.view[:nbytes], buffer
+
+        if dontwait is None:
+            return
+        flags = dontwait
+
+
+def gro_segment_size(ancdata):
+    for level, kind, value in ancdata:
+        if level == SOL_UDP and kind == UDP_GRO:
+            return int.from_bytes(value[:4].ljust(4, b"\0"), sys.byteorder)
+    return 0
+
+
+def has_pending(sock):
+    """Hay datagramas ya leidos del kernel esperando a ``recv_package``."""
+    return bool(gro_sockets.get(sock))
@@ -0,0 +1,78 @@
+import time
+
+from lib.constants import PACKAGE_SIZE, PACING_BURST, PACING_GAIN_SS, PACING_GAIN_CA
+
+
+class Pacer:
+    """Token bucket que espacia los datagramas del emisor.
+
+    La tasa sale de la ventana de congestion y el RTT suavizado
+    (``ganancia * cwnd * package_size / srtt``), acotada por un limite opcional
+    en bytes por segundo, que tiene que ser positivo. Sin muestras de RTT ni
+    limite no se frena el envio.
+    """
+
+    def __init__(self, rate_limit=None, burst=PACING_BURST, package_size=PACKAGE_SIZE):
+        _check_limit(rate_limit)
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.package_size = package_size
+        self.capacity = burst * package_size
+        self.rate = rate_limit
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def set_limit(self, rate_limit):
+        _check_limit(rate_limit)
+        self.rate_limit = rate_limit
+        self.rate = rate_limit
+
+    def set_package_size(self, package_size):
+        """Tamano de los datagramas negociado en el START."""
+        self.package_size = package_size
+        self.capacity = self.burst * package_size
+        self.tokens = self.capacity
+
+    def update(self, congestion, srtt):
+        """Recalcula la tasa objetivo a partir de la ventana y el RTT actuales."""
+        rate = None
+        if srtt:
+            slow_start = congestion.cwnd < congestion.ssthresh
+            gain = PACING_GAIN_SS if slow_start else PACING_GAIN_CA
+            rate = gain * congestion.cwnd * self.package_size / srtt
+        if self.rate_limit is not None:
+            rate = self.rate_limit if rate is None else min(rate, self.rate_limit)
+        self.rate = rate
+
+    def delay(self, size):
+        """Segundos hasta poder enviar ``size`` bytes (0 si se puede ya)."""
+        if self.rate is None:
+            return 0
+        self._refill()
+        if self.tokens >= size:
+            return 0
+        return (size - self.tokens) / self.rate
+
+    def consume(self, size):
+        if self.rate is None:
+            return
+        self._refill()
+        # Las retransmisiones no esperan: pueden dejar el balde en negativo
+        self.tokens -= size
+
+    def wait(self, size):
+        """Version bloqueante para los emisores stop and wait."""
+        delay = self.delay(size)
+        if delay > 0:
+            time.sleep(delay)
+        self.consume(size)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+
+def _check_limit(rate_limit):
+    if rate_limit is not None and rate_limit <= 0:
+        raise ValueError(f"Limite de tasa invalido: {rate_limit}")
@@ -1,5 +1,21 @@
 import argparse  # https://docs.python.org/es/3/library/argparse.html
 from lib.logger import setup_logger
+from lib.constants import (
+    FSYNC_POLICIES,
+    FSYNC_POLICY,
+    CONGESTION_CONTROL,
+    DUPACK_THRESHOLD,
+    ACK_EVERY,
+    ACK_DELAY,
+    MIN_FRAGMENT_SIZE,
+    MAX_FRAGMENT_SIZE,
+    MAX_STREAMS,
+    FILE_CACHE_SIZE,
+)
+from lib.congestion import CONGESTION_CONTROLLERS
+from lib.compression import CODECS
+from lib.multicast import FANOUT, parse_group
+from lib.fec import parse_fec
 
 
 def configure_logging(args):
@@ -32,6 +48,275 @@ def add_protocol_args(parser):
     )
 
 
+def add_storage_args(parser):
+    parser.add_argument(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        default=FSYNC_POLICY,
+        help="when received files are synced to disk (default: %(default)s)",
+    )
+
+
+def add_congestion_args(parser):
+    parser.add_argument(
+        "--congestion",
+        choices=sorted(CONGESTION_CONTROLLERS),
+        default=CONGESTION_CONTROL,
+        help="congestion control for the sack sender (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--reordering",
+        type=parse_reordering,
+        default=DUPACK_THRESHOLD,
+        help="packets sacked or duplicate ACKs above a hole before the sack sender "
+        "retransmits it (default: %(default)s)",
+    )
+
+
+def parse_reordering(value):
+    try:
+        reordering = int(value)
+    except ValueError:
+        reordering = 0
+    if reordering < 1:
+        raise argparse.ArgumentTypeError(f"invalid reordering threshold: {value}")
+    return reordering
+
+
+def parse_ack_every(value):
+    try:
+        every = int(value)
+    except ValueError:
+        every = 0
+    if every < 1:
+        raise argparse.ArgumentTypeError(f"invalid ACK frequency: {value}")
+    return every
+
+
+def parse_ack_delay(value):
+    try:
+        delay = float(value)
+    except ValueError:
+        delay = -1
+    if delay < 0:
+        raise argparse.ArgumentTypeError(f"invalid ACK delay: {value}")
+    return delay
+
+
+def add_ack_args(parser):
+    parser.add_argument(
+        "--ack-every",
+        type=parse_ack_every,
+        default=ACK_EVERY,
+        help="sack data packets per ACK, 1 acknowledges each one (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--ack-delay",
+        type=parse_ack_delay,
+        default=ACK_DELAY,
+        help="maximum delay of a sack ACK in milliseconds (default: %(default)s)",
+    )
+
+
+def parse_fragment_size(value):
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if not MIN_FRAGMENT_SIZE <= size <= MAX_FRAGMENT_SIZE:
+        raise argparse.ArgumentTypeError(
+            f"invalid fragment size: {value} "
+            f"(must be {MIN_FRAGMENT_SIZE}-{MAX_FRAGMENT_SIZE})"
+        )
+    return size
+
+
+def parse_requested_fragment_size(value):
+    """``auto`` (None) deja que el cliente sondee el MTU del camino."""
+    if value == "auto":
+        return None
+    return parse_fragment_size(value)
+
+
+def add_fragment_args(parser):
+    parser.add_argument(
+        "--fragment-size",
+        type=parse_requested_fragment_size,
+        default=None,
+        help="file bytes per datagram to request, or auto to probe the path MTU "
+        "(default: auto)",
+    )
+
+
+def parse_streams(value):
+    try:
+        streams = int(value)
+    except ValueError:
+        streams = 0
+    if not 1 <= streams <= MAX_STREAMS:
+        raise argparse.ArgumentTypeError(
+            f"invalid number of streams: {value} (must be 1-{MAX_STREAMS})"
+        )
+    return streams
+
+
+def parse_stream(value):
+    """``i/n``: el stream que transfiere este proceso (uso interno)."""
+    index, _, streams = value.partition("/")
+    try:
+        index, streams = int(index), int(streams)
+    except ValueError:
+        streams = 0
+    if not 0 <= index < streams <= MAX_STREAMS:
+        raise argparse.ArgumentTypeError(f"invalid stream: {value}")
+    return index, streams
+
+
+def add_stream_args(parser):
+    parser.add_argument(
+        "--streams",
+        type=parse_streams,
+        default=1,
+        help="parallel sessions, each with its own socket and process, that "
+        "split the file between them (default: %(default)s)",
+    )
+    # Los pasa el proceso que reparte la transferencia a cada stream
+    parser.add_argument("--stream", type=parse_stream, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--transfer", default=None, help=argparse.SUPPRESS)
+
+
+def add_resume_args(parser):
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="start over instead of resuming an interrupted transfer of the "
+        "same file",
+    )
+
+
+def add_delta_args(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--delta",
+        action="store_true",
+        help="send only what changed against the server's copy of the file "
+        "(rsync-style delta)",
+    )
+    group.add_argument(
+        "--dedup",
+        action="store_true",
+        help="send only the chunks the server's chunk store does not have yet "
+        "(see the server's --chunk-store)",
+    )
+    # Los usa upload.py --dedup para subir el manifiesto del archivo
+    parser.add_argument("--chunk-manifest", default=None, help=argparse.SUPPRESS)
+
+
+def add_verify_args(parser):
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="do not checksum each datagram nor compare a digest of the file "
+        "at the end",
+    )
+
+
+def add_compression_args(parser):
+    parser.add_argument(
+        "--compress",
+        choices=CODECS,
+        default=None,
+        help="compress each fragment on the wire if the server supports it; "
+        "skipped while the data does not compress",
+    )
+
+
+def parse_fec_option(value):
+    try:
+        return parse_fec(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid FEC block: {value} (expected K:M with 1 <= M <= K)"
+        )
+
+
+def add_fec_args(parser):
+    parser.add_argument(
+        "--fec",
+        type=parse_fec_option,
+        default=None,
+        metavar="K:M",
+        help="with SACK, send M parity packets per block of K fragments so the "
+        "receiver can rebuild up to M lost fragments of each block without "
+        "retransmissions, e.g. 16:2",
+    )
+    parser.add_argument(
+        "--fec-adaptive",
+        action="store_true",
+        help="let the sender raise the parity per block while fragments still "
+        "need retransmissions and lower it when they do not",
+    )
+
+
+def parse_bytes(value):
+    """Convierte una cantidad como 500K, 10M o 1G a entero. Lanza ValueError
+    si no es un numero."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_rate(value):
+    """Convierte una tasa (bytes por segundo, ver parse_bytes) a entero. Tiene
+    que ser positiva: el pacer divide por ella."""
+    try:
+        rate = parse_bytes(value)
+    except (ValueError, OverflowError):
+        raise argparse.ArgumentTypeError(f"invalid rate: {value}")
+    if rate <= 0:
+        raise argparse.ArgumentTypeError(f"rate must be positive: {value}")
+    return rate
+
+
+def parse_size(value):
+    """Convierte un tamano como 64M o 1G (bytes, ver parse_bytes) a entero."""
+    try:
+        size = parse_bytes(value)
+    except (ValueError, OverflowError):
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+    if size < 0:
+        raise argparse.ArgumentTypeError(f"size can't be negative: {value}")
+    return size
+
+
+def parse_multicast(value):
+    try:
+        parse_group(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid multicast group: {value} (expected GROUP:PORT or {FANOUT})"
+        )
+    return value
+
+
+def parse_workers(value):
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise argparse.ArgumentTypeError(f"invalid number of workers: {value}")
+    return workers
+
+
+def add_rate_args(parser, help):
+    parser.add_argument("--rate", type=parse_rate, default=None, help=help)
+
+
 def parse_upload_args():
     parser = argparse.ArgumentParser(
         prog="Upload", description="Upload a file to the server."
@@ -45,6 +330,16 @@ def parse_upload_args():
     parser.add_argument(
         "-n", "--name", required=True, help="file name to store on the server"
     )
+    add_congestion_args(parser)
+    add_rate_args(parser, "maximum send rate in bytes/s, e.g. 500K or 10M")
+    add_ack_args(parser)
+    add_fragment_args(parser)
+    add_stream_args(parser)
+    add_resume_args(parser)
+    add_delta_args(parser)
+    add_compression_args(parser)
+    add_fec_args(parser)
+    add_verify_args(parser)
 
     return parser.parse_args()
 
@@ -64,6 +359,25 @@ def parse_download_args():
     parser.add_argument(
         "-n", "--name", required=True, help="file name to download from the server"
     )
+    add_storage_args(parser)
+    add_rate_args(parser, "maximum rate the server may send at, e.g. 500K or 10M")
+    add_ack_args(parser)
+    add_fragment_args(parser)
+    add_stream_args(parser)
+    add_resume_args(parser)
+    add_compression_args(parser)
+    add_fec_args(parser)
+    add_verify_args(parser)
+    parser.add_argument(
+        "--multicast",
+        action="store_true",
+        help="join the server's multicast distribution of the file and ask "
+        "for what is lost with NACKs (needs a server started with --multicast)",
+    )
+    # La usa upload.py --delta para bajar la firma de la copia del servidor
+    parser.add_argument("--signature", action="store_true", help=argparse.SUPPRESS)
+    # Y upload.py --dedup para bajar los chunks que le faltan al servidor
+    parser.add_argument("--chunk-missing", default=None, help=argparse.SUPPRESS)
 
     return parser.parse_args()
 
@@ -77,5 +391,54 @@ def parse_server_args():
     add_network_args(parser)
 
     parser.add_argument("-s", "--storage", required=True, help="storage directory path")
+    add_storage_args(parser)
+    add_congestion_args(parser)
+    add_rate_args(parser, "maximum send rate per client in bytes/s, e.g. 10M")
+    add_ack_args(parser)
+    parser.add_argument(
+        "--max-fragment-size",
+        type=parse_fragment_size,
+        default=MAX_FRAGMENT_SIZE,
+        help="largest fragment a client may negotiate in bytes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="one thread per client or a single asyncio event loop (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=parse_workers,
+        default=1,
+        help="server processes sharing the port with SO_REUSEPORT (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--chunk-store",
+        action="store_true",
+        help="store files split into content-defined chunks kept once under "
+        "their hash, and let clients upload only the chunks it lacks",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_size,
+        default=FILE_CACHE_SIZE,
+        help="bytes of files downloaded more than once to keep mapped (or, "
+        "with --chunk-store, assembled in memory) and shared by all downloads "
+        "of each worker, e.g. 512M; mapped files live in the OS page cache, so "
+        "this is not a memory limit; 0 disables it (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--multicast",
+        type=parse_multicast,
+        default=None,
+        help="send each file once to the multicast group GROUP:PORT for all "
+        f"the clients that download it with --multicast; '{FANOUT}' emulates "
+        "the group with one unicast copy per client; not with --workers",
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.multicast and args.workers > 1:
+        # Cada worker tendria su propia sesion por archivo: se enviaria N veces
+        parser.error("--multicast needs a single worker (--workers 1)")
+    return args
@@ -0,0 +1,75 @@
+import errno
+import logging
+import select
+import socket
+import sys
+
+from lib.constants import MAX_DATAGRAM_SIZE, MIN_FRAGMENT_SIZE, PMTU_PROBE_WAIT
+from lib.udp import MAX_HEADER_SIZE
+
+logger = logging.getLogger("app_logger")
+
+# Valores de linux/in.h, por si el modulo socket no los expone
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+IP_MTU = getattr(socket, "IP_MTU", 14)
+UDP_IP_OVERHEAD = 28  # Headers IPv4 (20) y UDP (8)
+
+
+def probe_path_mtu(addr, wait=PMTU_PROBE_WAIT):
+    """Mayor payload UDP que llega a ``addr`` sin fragmentarse, o None si no
+    se puede averiguar.
+
+    Solo en Linux: desde un socket conectado con IP_PMTUDISC_DO (bit DF) se
+    manda una sonda del tamano del MTU que el kernel conoce para la ruta. Si un
+    router no la deja pasar responde con ICMP "fragmentation needed", el kernel
+    baja el MTU de la ruta y se prueba con el nuevo; si en ``wait`` segundos no
+    vuelve ningun error, la sonda paso. Las sondas van al puerto del servidor,
+    que las descarta por no traer el flag START.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+            sock.connect(addr)
+            return _search(sock, wait)
+    except OSError as e:
+        logger.info(f"No se pudo sondear el MTU del camino: {e}")
+        return None
+
+
+def path_fragment_size(addr):
+    """Fragmento que entra en un datagrama sin fragmentar hasta ``addr``, o
+    None si no se pudo sondear el camino."""
+    payload = probe_path_mtu(addr)
+    if payload is None:
+        return None
+    return max(payload - MAX_HEADER_SIZE, MIN_FRAGMENT_SIZE)
+
+
+def _search(sock, wait):
+    """Baja desde el MTU de la ruta hasta que una sonda pasa."""
+    mtu = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    while True:
+        size = min(mtu - UDP_IP_OVERHEAD, MAX_DATAGRAM_SIZE)
+        if _probe(sock, size, wait):
+            return size
+        lower = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        if lower >= mtu:
+            return None  # El kernel no aprendio nada nuevo: no se insiste
+        mtu = lower
+
+
+def _probe(sock, size, wait):
+    """Manda una sonda de ``size`` bytes. Devuelve False si el camino (o el
+    MTU que ya conocia el kernel) no la deja pasar."""
+    try:
+        sock.send(bytes(size))
+        if select.select([sock], [], [], wait)[0]:
+            sock.recv(1)
+    except OSError as e:
+        if e.errno == errno.EMSGSIZE:
+            return False
+        raise
+    return True
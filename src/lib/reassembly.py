@@ -0,0 +1,123 @@
+from bisect import bisect
+from collections import deque
+from itertools import islice
+
+from lib.constants import REASSEMBLY_SIZE
+
+
+class ReassemblyTracker:
+    """Secuencias recibidas por el receptor SACK.
+
+    Un anillo de bytes indexado por ``seq % len`` marca lo recibido por delante
+    del ACK acumulado y una lista ordenada de rangos ``[inicio, fin]`` guarda lo
+    mismo agrupado, listo para armar el SACK. Al llegar el hueco siguiente al
+    acumulado se absorbe el primer rango entero, asi que el acumulado avanza en
+    O(1) amortizado. El anillo crece si llega algo mas alla de su tamano.
+
+    Con ``window`` (la ventana de recepcion) lo que llega a mas de ``window``
+    secuencias del acumulado se descarta sin agrandar el anillo: las
+    secuencias vienen de la red y un solo paquete no puede hacer reservar
+    memoria hasta su numero. Sin ``window`` el anillo crece sin tope, para
+    rangos que no vienen de la red (los fragmentos ya escritos de un
+    temporal que se reanuda).
+    """
+
+    def __init__(self, cumulative=0, size=REASSEMBLY_SIZE, window=None):
+        self.cumulative = cumulative  # Ultima secuencia recibida en orden
+        self.window = window  # Mayor distancia aceptada por delante del acumulado
+        self.ring = bytearray(size)
+        self.ranges = deque()  # Recibido fuera de orden, sin solaparse y ordenado
+
+    def __contains__(self, seq):
+        if seq <= self.cumulative:
+            return True
+        if seq - self.cumulative > len(self.ring):
+            return False
+        return bool(self.ring[seq % len(self.ring)])
+
+    def add(self, seq):
+        """Registra ``seq``. Devuelve False si ya se habia recibido o si cae
+        fuera de la ventana."""
+        if seq in self:
+            return False
+        if seq == self.cumulative + 1:
+            self.cumulative = seq
+            if self.ranges and self.ranges[0][0] == seq + 1:
+                start, end = self.ranges.popleft()
+                self._clear(start, end)
+                self.cumulative = end
+            return True
+
+        distance = seq - self.cumulative
+        if self.window is not None and distance > self.window:
+            return False
+        if distance > len(self.ring):
+            self._grow(distance)
+        self.ring[seq % len(self.ring)] = 1
+        self._insert(seq)
+        return True
+
+    def add_range(self, start, end):
+        """Registra ``start..end`` de una vez (lo recibido en una transferencia
+        anterior que se reanuda)."""
+        if not self.ranges and start <= self.cumulative + 1:
+            self.cumulative = max(self.cumulative, end)
+            return
+        for seq in range(start, end + 1):
+            self.add(seq)
+
+    def received(self):
+        """Todo lo recibido como rangos ``[inicio, fin]`` ordenados."""
+        prefix = [[1, self.cumulative]] if self.cumulative else []
+        return prefix + list(self.ranges)
+
+    def sack_ranges(self, limit=None):
+        """Rangos ``[inicio, fin]`` recibidos fuera de orden, los mas viejos primero."""
+        return list(islice(self.ranges, limit))
+
+    def sequences(self, limit):
+        """Secuencias recibidas fuera de orden hasta ``cumulative + limit``
+        (las que entran en el bitmap SACK de 32 bits)."""
+        last = self.cumulative + limit
+        for start, end in self.ranges:
+            if start > last:
+                break
+            yield from range(start, min(end, last) + 1)
+
+    def _insert(self, seq):
+        ranges = self.ranges
+        if not ranges or seq > ranges[-1][1] + 1:
+            ranges.append([seq, seq])
+            return
+        if seq == ranges[-1][1] + 1:
+            # Lo habitual: sigue llegando en orden despues de una perdida
+            ranges[-1][1] = seq
+            return
+
+        # Una retransmision que llena un hueco intermedio
+        i = bisect(ranges, [seq])  # Primer rango que empieza despues de seq
+        joins_prev = i > 0 and ranges[i - 1][1] == seq - 1
+        joins_next = i < len(ranges) and ranges[i][0] == seq + 1
+        if joins_prev and joins_next:
+            ranges[i - 1][1] = ranges[i][1]
+            del ranges[i]
+        elif joins_prev:
+            ranges[i - 1][1] = seq
+        elif joins_next:
+            ranges[i][0] = seq
+        else:
+            ranges.insert(i, [seq, seq])
+
+    def _clear(self, start, end):
+        size = len(self.ring)
+        for seq in range(start, end + 1):
+            self.ring[seq % size] = 0
+
+    def _grow(self, distance):
+        size = len(self.ring)
+        while size < distance:
+            size *= 2
+        self.ring = bytearray(size)
+        for start, end in self.ranges:
+            for seq in range(start, end + 1):
+                self.ring[seq % size] = 1
@@ -0,0 +1,66 @@
+import time
+
+from lib.constants import MIN_RTO, MAX_RTO, CLOCK_GRANULARITY
+
+TIMESTAMP_MASK = 0xFFFFFFFF
+
+
+def timestamp():
+    """Reloj local en milisegundos, truncado a los 32 bits del header."""
+    # 0 esta reservado para "sin timestamp"
+    return (time.monotonic_ns() // 1_000_000) & TIMESTAMP_MASK or 1
+
+
+def echo_age(header):
+    """Segundos desde que se envio el paquete cuyo timestamp devuelve
+    ``header.ts_echo``, o None si no trae eco."""
+    if not header.ts_echo:
+        return None
+    return ((timestamp() - header.ts_echo) & TIMESTAMP_MASK) / 1000
+
+
+class RTTEstimator:
+    """Estimador de RTT y timeout de retransmision (Jacobson/Karels, RFC 6298).
+
+    Las muestras salen del timestamp que cada extremo devuelve en ``ts_echo``,
+    asi que un paquete retransmitido trae el tiempo de su propio envio y la
+    muestra no es ambigua.
+    """
+
+    def __init__(self, initial_rto, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.base_rto = initial_rto
+        self.backoff = 1
+        self.ts_recent = 0  # Ultimo timestamp recibido del otro extremo
+
+    @property
+    def rto(self):
+        return min(self.base_rto * self.backoff, self.max_rto)
+
+    def sample(self, rtt):
+        """Incorpora una muestra de RTT en segundos y recalcula el RTO."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        rto = self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar)
+        self.base_rto = min(max(rto, self.min_rto), self.max_rto)
+        self.backoff = 1
+
+    def on_receive(self, header):
+        """Registra el timestamp del paquete y toma una muestra si trae eco."""
+        if header.ts:
+            self.ts_recent = header.ts
+        if header.ts_echo:
+            self.sample(echo_age(header))
+
+    def on_timeout(self):
+        """Duplica el RTO; lo proximo que se envie no vuelve a pedir muestra."""
+        self.backoff = min(self.backoff * 2, 64)
+        # Un eco viejo mediria la espera del timeout y no el camino
+        self.ts_recent = 0
@@ -0,0 +1,163 @@
+from array import array
+
+# Estado de cada secuencia enviada y todavia no confirmada en forma acumulada
+UNSENT = 0
+IN_FLIGHT = 1
+SACKED = 2
+LOST = 3
+
+MARK_LOST = bytes(LOST if i == IN_FLIGHT else i for i in range(256))
+COMPACT_MIN = 1024  # Entradas confirmadas que se acumulan antes de descartarlas
+
+
+class Scoreboard:
+    """Registro del emisor SACK de lo enviado y no confirmado (RFC 6675).
+
+    Por cada secuencia guarda su estado, cuando se envio por ultima vez y
+    cuantas veces, en arreglos compactos indexados por ``seq - offset``: un
+    ``bytearray`` para el estado y ``array`` para tiempos y envios. Los ACK
+    acumulados, los rangos SACK y la deteccion de perdidas operan sobre
+    porciones del ``bytearray`` (count, translate, asignacion por slice), asi
+    que su costo por paquete queda en C.
+    """
+
+    def __init__(self, first=1):
+        self.offset = first
+        self.base = first  # Primera secuencia sin confirmar en forma acumulada
+        self.next_seq = first  # Proxima secuencia nueva a enviar
+        self.pipe = 0  # Enviados que no se confirmaron ni se dieron por perdidos
+        self.loss_mark = first  # Lo que esta por debajo ya se juzgo por SACK
+        self.state = bytearray()
+        self.sent_at = array("d")
+        self.transmissions = array("H")
+
+    @property
+    def highest_sent(self):
+        return self.next_seq - 1
+
+    def on_send(self, seq, now):
+        """Registra el envio (o reenvio) de ``seq``."""
+        i = seq - self.offset
+        if i >= len(self.state):
+            grow = i + 1 - len(self.state)
+            self.state.extend(bytes(grow))
+            self.sent_at.extend(array("d", bytes(8 * grow)))
+            self.transmissions.extend(array("H", bytes(2 * grow)))
+        if self.state[i] != IN_FLIGHT:
+            self.pipe += 1
+        self.state[i] = IN_FLIGHT
+        self.sent_at[i] = now
+        self.transmissions[i] += 1
+        if seq >= self.next_seq:
+            self.next_seq = seq + 1
+
+    def ack(self, cumulative):
+        """Confirma hasta ``cumulative`` inclusive. Devuelve cuantas secuencias
+        se entregaron que no se conocian por SACK."""
+        cumulative = min(cumulative, self.highest_sent)
+        if cumulative < self.base:
+            return 0
+        start, end = self.base - self.offset, cumulative + 1 - self.offset
+        segment = self.state[start:end]
+        self.pipe -= segment.count(IN_FLIGHT)
+        delivered = len(segment) - segment.count(SACKED)
+        self.base = cumulative + 1
+        self.loss_mark = max(self.loss_mark, self.base)
+        self._compact()
+        return delivered
+
+    def sack(self, start, end):
+        """Marca recibido el rango ``[start, end]``. Devuelve cuantas secuencias
+        son nuevas."""
+        start, end = max(start, self.base), min(end, self.highest_sent)
+        if start > end:
+            return 0
+        first, last = start - self.offset, end + 1 - self.offset
+        segment = self.state[first:last]
+        self.pipe -= segment.count(IN_FLIGHT)
+        newly = len(segment) - segment.count(SACKED)
+        if newly:
+            self.state[first:last] = bytes([SACKED]) * len(segment)
+        return newly
+
+    def detect_losses(self, threshold):
+        """Da por perdidas las secuencias en vuelo que tienen al menos
+        ``threshold`` secuencias SACKeadas por encima. Devuelve cuantas.
+
+        Solo se revisa lo que esta por encima de la ultima busqueda, asi una
+        retransmision no se vuelve a dar por perdida hasta el siguiente timeout.
+        """
+        low = self.loss_mark - self.offset
+        limit = self.next_seq - self.offset
+        for _ in range(threshold):
+            limit = self.state.rfind(SACKED, low, limit)
+            if limit < 0:
+                return 0
+        segment = self.state[low:limit]
+        lost = segment.count(IN_FLIGHT)
+        if lost:
+            self.state[low:limit] = segment.translate(MARK_LOST)
+            self.pipe -= lost
+        self.loss_mark = limit + self.offset
+        return lost
+
+    def on_timeout(self, cutoff):
+        """Da por perdidas las secuencias en vuelo enviadas antes de ``cutoff``.
+
+        Los SACK que sigan llegando pueden ser anteriores a los reenvios, asi
+        que lo ya enviado deja de juzgarse por SACK y queda para
+        ``detect_lost_retransmissions``.
+        """
+        self.loss_mark = self.next_seq
+        state, sent_at = self.state, self.sent_at
+        i = state.find(IN_FLIGHT, self.base - self.offset)
+        lost = 0
+        while i >= 0:
+            if sent_at[i] <= cutoff:
+                state[i] = LOST
+                lost += 1
+            i = state.find(IN_FLIGHT, i + 1)
+        self.pipe -= lost
+        return lost
+
+    def mark_lost(self, seq):
+        """Da por perdida ``seq`` si sigue en vuelo desde su primer envio."""
+        i = seq - self.offset
+        if not (self.base <= seq < self.next_seq) or self.state[i] != IN_FLIGHT:
+            return False
+        if self.transmissions[i] > 1:
+            return False
+        self.state[i] = LOST
+        self.pipe -= 1
+        return True
+
+    def detect_lost_retransmissions(self, before):
+        """Da por perdido lo que sigue en vuelo por debajo de ``loss_mark``
+        (reenvios, o lo que quedo en vuelo tras un timeout) si se envio antes
+        de ``before``, el envio de algo que el receptor ya recibio (RACK).
+        Devuelve cuantas."""
+        state, sent_at = self.state, self.sent_at
+        end = self.loss_mark - self.offset
+        i = state.find(IN_FLIGHT, self.base - self.offset, end)
+        lost = 0
+        while i >= 0:
+            if sent_at[i] < before:
+                state[i] = LOST
+                lost += 1
+            i = state.find(IN_FLIGHT, i + 1, end)
+        self.pipe -= lost
+        return lost
+
+    def next_lost(self):
+        """Menor secuencia dada por perdida y todavia no reenviada, o None."""
+        i = self.state.find(LOST, self.base - self.offset)
+        return None if i < 0 else i + self.offset
+
+    def _compact(self):
+        drop = self.base - self.offset
+        if drop < COMPACT_MIN or drop < len(self.state) // 2:
+            return
+        del self.state[:drop]
+        del self.sent_at[:drop]
+        del self.transmissions[:drop]
+        self.offset = self.base
@@ -0,0 +1,48 @@
+import logging
+import secrets
+import subprocess
+import sys
+
+from lib.constants import FRAGMENT_SIZE
+from lib.pmtu import path_fragment_size
+
+logger = logging.getLogger("app_logger")
+
+
+def run_streams(args, size=None):
+    """Transfiere el archivo en ``args.streams`` sesiones paralelas.
+
+    Cada stream es este mismo script relanzado en otro proceso, con su propio
+    socket y su propia conexion en el servidor, asi que cada uno puede usar un
+    nucleo. El stream ``i`` de ``n`` lleva los fragmentos ``i, i + n, ...`` del
+    archivo, y todos piden el mismo tamano de fragmento, que se sondea una sola
+    vez aca. ``size`` es el tamano del archivo si se conoce (upload), para no
+    abrir mas streams que fragmentos. Devuelve True si todos terminaron bien.
+    """
+    fragment_size = (
+        args.fragment_size
+        or path_fragment_size((args.host, args.port))
+        or FRAGMENT_SIZE
+    )
+    streams = args.streams
+    if size is not None:
+        streams = max(min(streams, -(-size // fragment_size)), 1)
+    transfer = secrets.token_hex(8)
+    command = [
+        sys.executable,
+        sys.argv[0],
+        *sys.argv[1:],
+        "--fragment-size",
+        str(fragment_size),
+        "--transfer",
+        transfer,
+    ]
+    logger.info(f"Transfiriendo en {streams} streams, fragmento {fragment_size}")
+    children = [
+        subprocess.Popen([*command, "--stream", f"{index}/{streams}"])
+        for index in range(streams)
+    ]
+    failed = [index for index, child in enumerate(children) if child.wait() != 0]
+    if failed:
+        logger.error(f"Error: Fallaron los streams {failed}")
+    return not failed
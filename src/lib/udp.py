@@ -1,44 +1,114 @@
 import struct
 import socket
+import sys
+from array import array
+from itertools import chain
 import threading
 import queue
 import os
 import logging
+import zlib
 
-from lib.constants import TIMEOUT, FRAGMENT_SIZE, PACKAGE_SIZE
+from lib.constants import (
+    TIMEOUT,
+    FRAGMENT_SIZE,
+    PACKAGE_SIZE,
+    HEADER_FORMAT,
+    EXT_HEADER_FORMAT,
+    CRC_FORMAT,
+)
 
 logger = logging.getLogger("app_logger")
 
+# Compiled once: base header, extension, and both together for a single call
+HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
+EXT_STRUCT = struct.Struct(EXT_HEADER_FORMAT)
+EXTENDED_STRUCT = struct.Struct(HEADER_FORMAT + EXT_HEADER_FORMAT.lstrip("!"))
+# Optional CRC32 of the whole datagram (header and payload), after the header
+CRC_STRUCT = struct.Struct(CRC_FORMAT)
+MAX_HEADER_SIZE = EXTENDED_STRUCT.size + CRC_STRUCT.size
+# SACK ranges travel as uint32 pairs; array does the byte order in C
+SACK_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+SACK_BLOCK_SIZE = 8
+
+
+def pack_header_into(buffer, offset, flags, sequence, sack=0, ts=None, ts_echo=0):
+    """Write a header into ``buffer`` at ``offset`` and return its size.
+
+    The extension is written only when ``ts`` is given, so hot paths can build
+    headers without creating a UDPHeader.
+    """
+    if ts is None:
+        HEADER_STRUCT.pack_into(buffer, offset, flags, sequence, sack)
+        return HEADER_STRUCT.size
+    EXTENDED_STRUCT.pack_into(buffer, offset, flags, sequence, sack, ts, ts_echo)
+    return EXTENDED_STRUCT.size
+
+
+def pack_crc_into(buffer, offset, size, payload):
+    """Append to the header of ``size`` bytes at ``offset`` the CRC32 of the
+    header and ``payload``, and return the new header size."""
+    crc = zlib.crc32(payload, zlib.crc32(memoryview(buffer)[offset : offset + size]))
+    CRC_STRUCT.pack_into(buffer, offset + size, crc)
+    return size + CRC_STRUCT.size
+
 
 class UDPHeader:
-    HEADER_FORMAT = "!B I I"
-    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)  # Size of the header in bytes
+    __slots__ = ("flags", "sequence", "sack", "extended", "ts", "ts_echo", "crc")
 
-    def __init__(self, sequence, flags=0, sack=0):
+    HEADER_FORMAT = HEADER_FORMAT
+    HEADER_SIZE = HEADER_STRUCT.size  # Size of the header in bytes
+    EXT_FORMAT = EXT_HEADER_FORMAT
+    EXT_SIZE = EXT_STRUCT.size  # Size of the negotiated extension
+
+    def __init__(
+        self, sequence, flags=0, sack=0, ts=0, ts_echo=0, extended=False, crc=False
+    ):
         self.flags = flags  # Flags (1 byte)
         self.sequence = sequence  # Sequence number (4 bytes)
         self.sack = sack  # SACK Sequence (4 bytes)
-
-    def pack(self):
-        """Pack the header into binary format."""
-        return struct.pack(self.HEADER_FORMAT, self.flags, self.sequence, self.sack)
+        self.extended = extended  # Extension present (negotiated in START)
+        self.ts = ts  # Sender timestamp in ms (4 bytes, extension)
+        self.ts_echo = ts_echo  # Last timestamp received from the peer (4 bytes, extension)
+        self.crc = crc  # Ends with the CRC32 of the datagram (negotiated in START)
+
+    def pack(self, payload=b""):
+        """Pack the header into binary format. With ``crc`` the header ends
+        with the checksum of itself and ``payload``, the data sent after it."""
+        if self.extended:
+            header = EXTENDED_STRUCT.pack(
+                self.flags, self.sequence, self.sack, self.ts, self.ts_echo
+            )
+        else:
+            header = HEADER_STRUCT.pack(self.flags, self.sequence, self.sack)
+        if self.crc:
+            header += CRC_STRUCT.pack(zlib.crc32(payload, zlib.crc32(header)))
+        return header
+
+    def pack_into(self, buffer, offset=0):
+        """Pack the header into ``buffer`` at ``offset`` and return its size."""
+        return pack_header_into(
+            buffer,
+            offset,
+            self.flags,
+            self.sequence,
+            self.sack,
+            self.ts if self.extended else None,
+            self.ts_echo,
+        )
 
     def get_sequences(self) -> tuple:
-        try:
-            """Devuelve el primer elemento el num_sequence en el que esta y en el 2 elemento resto de los packetes recividos"""
-            one_bits = []
-            sequences = []
-
-            bits_total = 32
-            for i in range(bits_total - 1, -1, -1):
-                if (self.sack >> i) & 1:
-                    one_bits.append(bits_total - i)
-                    sequences.append(bits_total - i + self.sequence)
-
-            return (self.sequence, sequences)
-
-        except Exception as e:
-            logger.error(f"Error al obtener la secuencia: {e}")
+        """Devuelve el ACK acumulado y las secuencias marcadas en el bitmap SACK,
+        en orden creciente. Solo recorre los bits en 1."""
+        sequences = []
+        sack = self.sack
+        base = self.sequence + 33  # El bit 31 es sequence + 1
+        while sack:
+            low = sack & -sack
+            sequences.append(base - low.bit_length())
+            sack ^= low
+        sequences.reverse()
+        return (self.sequence, sequences)
 
     def set_sack(self, packages_secuence: list):
         bits = 0
@@ -57,11 +127,16 @@ class UDPHeader:
     @classmethod
     def unpack(cls, binary_header):
         """Unpack the binary header and return an instance of ProtocolHeader."""
-        flags, sequence, sack = struct.unpack(cls.HEADER_FORMAT, binary_header)
+        flags, sequence, sack = HEADER_STRUCT.unpack_from(binary_header)
         return cls(sequence, flags=flags, sack=sack)
 
+    def unpack_extension(self, binary_extension):
+        """Unpack the negotiated extension that follows the base header."""
+        self.ts, self.ts_echo = EXT_STRUCT.unpack_from(binary_extension)
+        self.extended = True
+
     def has_flag(self, flag):
-        """Checks if the flag is set."""
+        """Checks if the flag is set. Hot paths test ``header.flags & flag``."""
         return (self.flags & flag) != 0
 
     def set_flag(self, flag):
@@ -97,27 +172,78 @@ class UDPHeader:
 
 
 class UDPPackage:
+    __slots__ = ("data",)
+
     def __init__(self, data=None):
         self.data = data
 
-    def unpack(self):
-        """Unpack the data into ProtocolHeader and remaining data."""
-        # Ensure there is enough data to unpack the header
-        if len(self.data) < UDPHeader.HEADER_SIZE:
-            raise ValueError("Data is smaller than header size")
-
-        # Extract header and remaining data
-        binary_header = self.data[: UDPHeader.HEADER_SIZE]
-        header = UDPHeader.unpack(binary_header)
-        remaining_data = self.data[UDPHeader.HEADER_SIZE :]
+    def unpack(self, extended=False):
+        """Unpack the data into ProtocolHeader and remaining data.
 
-        return remaining_data, header
+        If the connection negotiated the extended header, every package but the
+        START handshake carries the extension right after the base header.
+        The payload is a memoryview over the received buffer, not a copy.
+        """
+        return unpack_package(self.data, extended)
 
     def pack(self, header: UDPHeader, data):
         """Pack the header and data into a single binary format."""
         return header.pack() + data
 
 
+def unpack_package(data, extended=False, crc=False):
+    """Return ``(payload_view, header)`` for a received datagram.
+
+    With ``crc`` every package but the START handshake must end its header
+    with a valid CRC32 of the datagram; a corrupted one raises ValueError.
+    """
+    # Ensure there is enough data to unpack the header
+    size = len(data)
+    if size < HEADER_STRUCT.size:
+        raise ValueError("Data is smaller than header size")
+
+    flags, sequence, sack = HEADER_STRUCT.unpack_from(data)
+    header = UDPHeader(sequence, flags, sack)
+    header_size = HEADER_STRUCT.size
+    if extended and not flags & UDPFlags.START:
+        header_size = EXTENDED_STRUCT.size
+        if size < header_size:
+            raise ValueError("Data is smaller than extended header size")
+        _, _, _, header.ts, header.ts_echo = EXTENDED_STRUCT.unpack_from(data)
+        header.extended = True
+    if crc and not flags & UDPFlags.START:
+        if size < header_size + CRC_STRUCT.size:
+            raise ValueError("Data is smaller than header and CRC size")
+        view = memoryview(data)
+        (expected,) = CRC_STRUCT.unpack_from(data, header_size)
+        actual = zlib.crc32(view[:header_size])
+        header_size += CRC_STRUCT.size
+        if zlib.crc32(view[header_size:], actual) != expected:
+            raise ValueError("CRC mismatch")
+        header.crc = True
+        return view[header_size:], header
+
+    return memoryview(data)[header_size:], header
+
+
+def encode_sack_blocks(blocks) -> bytes:
+    """Encode ``(start, end)`` SACK ranges (both inclusive) as network-order
+    uint32 pairs, the payload of an ACK when ranges were negotiated."""
+    values = array(SACK_TYPECODE, chain.from_iterable(blocks))
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+def decode_sack_blocks(data) -> list:
+    """Inverse of encode_sack_blocks; trailing partial blocks are ignored."""
+    values = array(SACK_TYPECODE)
+    values.frombytes(data[: len(data) // SACK_BLOCK_SIZE * SACK_BLOCK_SIZE])
+    if sys.byteorder == "little":
+        values.byteswap()
+    return list(zip(values[::2], values[1::2]))
+
+
 class UDPFlags:
     START = 0b00000001
     DATA = 0b00000010
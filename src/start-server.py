@@ -2,59 +2,121 @@ import socket
 from lib.logger import setup_logger
 from lib.parser import parse_server_args
 from lib.connection import (
-    receive_package,
     reject_connection,
     close_connection,
     send_start_confirmation,
     send_end_confirmation,
+    decode_start,
+    negotiate_options,
     Connection,
     ClientConnection,
     ClientConnectionSACK,
+    Message,
 )
-from lib.udp import UDPFlags, UDPHeader
+from lib.chunks import ChunkStore
+from lib.cache import FileCache
+from lib.multicast import MulticastDistributor, MulticastMember
+from lib.aio_server import AsyncClientConnection, AsyncClientConnectionSACK, serve
+from lib.udp import UDPFlags, UDPHeader, MAX_HEADER_SIZE, unpack_package
+from lib.constants import WORKER_RESTART_DELAY
+from lib.offload import enable_gro, create_pool, receive_batch
+import asyncio
 import signal
 import sys
 import os
+import time
+
+# Clases de conexion (stop and wait, SACK) de cada motor del servidor
+ENGINES = {
+    "threads": (ClientConnection, ClientConnectionSACK),
+    "asyncio": (AsyncClientConnection, AsyncClientConnectionSACK),
+}
 
 
 connections: dict[Connection] = {}
 args = parse_server_args()
 logger = setup_logger(verbose=args.verbose, quiet=args.quiet)
 
-# Create a UDP socket
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+server_socket = None
+store = ChunkStore(args.storage) if args.chunk_store else None
+# Cada worker tiene la suya: se crea antes de forkear pero se llena despues
+cache = FileCache(args.cache_size) if args.cache_size > 0 else None
+distributor = None
+if args.multicast:
+    distributor = MulticastDistributor(
+        args.multicast, args.host, args.rate, args.max_fragment_size, store, cache
+    )
 server_address = (args.host, args.port)
 logger.info(f"Server listening on {server_address}")
 
 recv_buffer_size = 1024 * 1024  # 1 MB
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer_size)
-server_socket.bind(server_address)
+
+# Solo en el proceso padre con --workers: pid -> indice del worker
+workers: dict[int, int] = {}
+worker_sockets: list[socket.socket] = []
+SHUTDOWN_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+if os.name != "nt":
+    SHUTDOWN_SIGNALS |= {signal.SIGQUIT, signal.SIGHUP}
+
+
+def create_server_socket(address, reuse_port=False):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer_size)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind(address)
+    return server_socket
 
 
 def check_connection(
     server_socket, addr, header: UDPHeader, data: bytes, storage_dir: str, logger
 ):
+    name, options = decode_start(data)
+    if distributor is not None and header.has_download() and options.get("mcast"):
+        if join_multicast(server_socket, addr, header, name, options, storage_dir):
+            return
+    stop_and_wait_class, sack_class = ENGINES[args.engine]
     if header.has_protocol():
-        connection = ClientConnectionSACK(
+        connection = sack_class(
             server_socket,
             addr,
-            f"{storage_dir}/{data.decode()}",
+            f"{storage_dir}/{name}",
             download=header.has_download(),
             protocol="sack",
+            fsync=args.fsync,
+            congestion=args.congestion,
+            rate=args.rate,
+            reordering=args.reordering,
+            cache=cache,
         )
     else:
-        connection = ClientConnection(
+        connection = stop_and_wait_class(
             server_socket,
             addr,
-            f"{storage_dir}/{data.decode()}",
+            f"{storage_dir}/{name}",
             download=header.has_download(),
             protocol="stop_and_wait",
+            fsync=args.fsync,
+            congestion=args.congestion,
+            rate=args.rate,
+            cache=cache,
         )
 
     logger.info(
-        f"Path: {data.decode()} | Upload: {connection.upload} | Download: {connection.download}"
+        f"Path: {name} | Upload: {connection.upload} | Download: {connection.download}"
     )
-    if header.has_start() and header.sequence == 0 and data.decode() != "":
+    if header.flags & UDPFlags.START and header.sequence == 0 and name != "":
+        accepted = negotiate_options(
+            options,
+            rate=args.rate,
+            ack_every=args.ack_every,
+            ack_delay=args.ack_delay,
+            max_fragment=args.max_fragment_size,
+        )
+        connection.set_options(accepted)
+        connection.negotiate_resume(options)
+        connection.negotiate_chunks(options, store)
+        connection.negotiate_delta(options)
         if header.has_protocol():
             logger.info(f"Mensaje Recibido: {addr} [Start] con protocolo SACK")
         else:
@@ -66,88 +128,232 @@ def check_connection(
         reject_connection(server_socket, connection)
 
 
-def handle_connection(server_socket, storage_dir, logger):
-    try:
-        addr, header, data = receive_package(server_socket)
-
-        if not connections.get(addr):
-            if header.has_start():
-                check_connection(server_socket, addr, header, data, storage_dir, logger)
-            return None
-
-        connection = connections.get(addr)
-        # No se inicializo la conexion y se recibio un paquete de datos
-        if header.has_flag(UDPFlags.DATA) and not connection.is_active:
-            connection.is_active = False
-            if connection.is_alive():
-                connection.join()
-            close_connection(server_socket, connection)
-            connections.pop(addr)
-
-        # Confirmacion de inicio de conexion
-        elif header.has_flag(UDPFlags.START) and header.has_flag(UDPFlags.ACK):
-            if not connection.is_active:
-                connection.is_active = True
-                if not connection.is_alive():
-                    connection.start()
-
-        # Confirmacion de recepcion de paquete de fin (download)
-        elif header.has_flag(UDPFlags.END) and header.has_flag(UDPFlags.ACK):
-            connection.is_active = False
-            if connection.is_alive():
-                connection.join()
-            logger.info(f"Mensaje Recibido: {addr} [END]")
-            close_connection(server_socket, connection)
-
-        # Se recibio un paquete de End
-        elif header.has_flag(UDPFlags.END) and not connection.is_active:
-            send_end_confirmation(server_socket, connection)
-
-        # Se recibio un paquete de cierre
-        elif header.has_flag(UDPFlags.CLOSE):
-            logger.info(f"Mensaje Recibido: {addr} [Close]")
-            connection.is_active = False
-            if connection.is_alive():
-                connection.join()
-            connections.pop(addr)
-            close_connection(server_socket, connection)
-            logger.info(f"Cliente Desconectado: {addr}")
-        else:
-            message = {"addr": addr, "header": header, "data": data}
-            connection.put_message(message)
+def join_multicast(server_socket, addr, header, name, options, storage_dir):
+    """Suma el cliente a la distribucion multicast de su archivo. Si no se
+    puede (START invalido, archivo inexistente) devuelve False y se lo
+    atiende como a cualquier descarga, que reporta el error."""
+    member = MulticastMember(addr, f"{storage_dir}/{name}")
+    if header.sequence != 0 or name == "" or not distributor.join(member, options):
+        return False
+    logger.info(f"Mensaje Recibido: {addr} [Start] multicast de {name}")
+    send_start_confirmation(server_socket, member)
+    send_start_confirmation(server_socket, member)
+    connections[addr] = member
+    return True
+
 
+def handle_connection(server_socket, storage_dir, logger, pool):
+    try:
+        for addr, data, buffer in receive_batch(server_socket, pool):
+            handle_package(server_socket, addr, data, storage_dir, logger, buffer)
     except ConnectionResetError as e:
         logger.error("Error: Conexión rechazada por el cliente.")
 
 
+def handle_package(server_socket, addr, data, storage_dir, logger, buffer=None):
+    """Despacha un datagrama recibido, sea cual sea el motor que lo leyo.
+
+    ``buffer`` es el buffer del pool que respalda ``data``: se libera aca salvo
+    que el paquete pase a la cola de la conexion. Un error al procesarlo se
+    registra y el paquete se descarta: un cliente no puede tirar el servidor.
+    """
+    try:
+        dispatch_package(server_socket, addr, data, storage_dir, logger, buffer)
+    except Exception:
+        if buffer is not None:
+            buffer.release()
+        logger.exception(f"Paquete descartado de {addr}: error al procesarlo")
+    except BaseException:
+        if buffer is not None:
+            buffer.release()
+        raise
+
+
+def dispatch_package(server_socket, addr, data, storage_dir, logger, buffer):
+    connection = connections.get(addr)
+    try:
+        data, header = unpack_package(
+            data, connection and connection.extended, connection and connection.crc
+        )
+    except ValueError as e:
+        logger.warning(f"Paquete descartado de {addr}: {e}")
+        connection = None
+        header = None
+
+    if not connection:
+        if header is not None and header.flags & UDPFlags.START:
+            check_connection(server_socket, addr, header, data, storage_dir, logger)
+
+    # DATA antes de la confirmacion del START: si se adelanto a la confirmacion
+    # el cliente ya la recibio, asi que se arranca; si la conexion ya termino
+    # se cierra
+    elif header.flags & UDPFlags.DATA and not connection.is_active and (
+        connection.activate() or not connection.is_active
+    ):
+        connection.stop()
+        close_connection(server_socket, connection)
+        connections.pop(addr)
+
+    # Confirmacion de inicio de conexion
+    elif header.flags & UDPFlags.START and header.flags & UDPFlags.ACK:
+        connection.activate()
+
+    # START repetido: el cliente no recibio la confirmacion
+    elif header.flags & UDPFlags.START and not connection.is_active:
+        send_start_confirmation(server_socket, connection)
+
+    # Confirmacion de recepcion de paquete de fin (download)
+    elif header.flags & UDPFlags.END and header.flags & UDPFlags.ACK:
+        connection.stop()
+        connection.check_peer_digest(data)
+        logger.info(f"Mensaje Recibido: {addr} [END]")
+        close_connection(server_socket, connection)
+
+    # Se recibio un paquete de End
+    elif header.flags & UDPFlags.END and not connection.is_active:
+        send_end_confirmation(server_socket, connection)
+
+    # Se recibio un paquete de cierre
+    elif header.flags & UDPFlags.CLOSE:
+        logger.info(f"Mensaje Recibido: {addr} [Close]")
+        connection.stop()
+        connections.pop(addr)
+        close_connection(server_socket, connection)
+        logger.info(f"Cliente Desconectado: {addr}")
+    else:
+        # La conexion pasa a ser duena del buffer
+        connection.put_message(Message(header, data, buffer))
+        return
+
+    if buffer is not None:
+        buffer.release()
+
+
 def start_server():
     try:
-        while True:
-            handle_connection(server_socket, args.storage, logger)
+        if args.engine == "asyncio":
+            asyncio.run(
+                serve(
+                    server_socket,
+                    lambda transport, addr, data: handle_package(
+                        transport, addr, data, args.storage, logger
+                    ),
+                )
+            )
+        else:
+            # El event loop lee con recvfrom: GRO solo con el motor de hilos
+            enable_gro(server_socket)
+            pool = create_pool(server_socket, args.max_fragment_size + MAX_HEADER_SIZE)
+            while True:
+                handle_connection(server_socket, args.storage, logger, pool)
     except KeyboardInterrupt:
         logger.info("\nInterruption detected. The program has been stopped.")
 
 
+def spawn_worker(index):
+    """Forkea el worker ``index`` sobre su socket ya enlazado."""
+    # Las senales quedan bloqueadas hasta que el hijo instala sus handlers
+    signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+    pid = os.fork()
+    if pid == 0:
+        run_worker(index)
+    workers[pid] = index
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+    logger.info(f"Worker {index} iniciado (pid {pid})")
+
+
+def run_worker(index):
+    global server_socket
+    server_socket = worker_sockets[index]
+    for i, sock in enumerate(worker_sockets):
+        if i != index:
+            sock.close()
+    workers.clear()
+    worker_sockets.clear()
+    setup_signal_handling()
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+    try:
+        start_server()
+        limpiar_recursos(0, 0)
+    finally:
+        os._exit(0)  # Nunca volver al codigo del padre
+
+
+def supervise_workers(count):
+    """Lanza ``count`` workers en el mismo puerto y relanza los que se caen.
+
+    Todos los sockets se enlazan en el padre con SO_REUSEPORT antes de forkear
+    y el padre los mantiene abiertos: si un worker se cae el grupo no cambia de
+    tamano, el kernel sigue mandando cada cliente al mismo socket y sus
+    paquetes esperan en el buffer hasta que el reemplazo los atienda.
+    """
+    for _ in range(count):
+        worker_sockets.append(create_server_socket(server_address, reuse_port=True))
+    for index in range(count):
+        spawn_worker(index)
+
+    while True:
+        pid, status = os.wait()
+        index = workers.pop(pid, None)
+        if index is None:
+            continue
+        logger.error(
+            f"Worker {index} (pid {pid}) terminado con codigo "
+            f"{os.waitstatus_to_exitcode(status)}, relanzando"
+        )
+        time.sleep(WORKER_RESTART_DELAY)
+        spawn_worker(index)
+
+
+def stop_workers():
+    """Reenvia el cierre a los workers y espera a que terminen todos."""
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid, index in workers.items():
+        try:
+            _, status = os.waitpid(pid, 0)
+        except ChildProcessError:
+            continue
+        logger.info(
+            f"Worker {index} (pid {pid}) finalizado con codigo "
+            f"{os.waitstatus_to_exitcode(status)}"
+        )
+    workers.clear()
+    for sock in worker_sockets:
+        sock.close()
+
+
 def limpiar_recursos(signum, frame):
     logger.info(f"Recibiendo señal {signum}, limpiando recursos...")
+    if workers:
+        stop_workers()
     for addr, connection in connections.items():
-        connection.is_active = False
-        if connection.is_alive():
-            connection.join()
+        connection.stop()
         close_connection(server_socket, connection)
-    server_socket.close()
+    if cache is not None and cache.hits + cache.misses:
+        logger.info(cache.summary())
+    if server_socket is not None:
+        server_socket.close()
     sys.exit(0)  # Salgo del programa con código 0 (exito)
 
 
 def setup_signal_handling():
-    signal.signal(signal.SIGINT, limpiar_recursos)
-    signal.signal(signal.SIGTERM, limpiar_recursos)
-    if os.name != "nt":
-        signal.signal(signal.SIGQUIT, limpiar_recursos)
-        signal.signal(signal.SIGHUP, limpiar_recursos)
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, limpiar_recursos)
 
 
 if __name__ == "__main__":
     setup_signal_handling()
-    start_server()
+    if args.workers > 1 and (not hasattr(socket, "SO_REUSEPORT") or os.name == "nt"):
+        logger.warning("SO_REUSEPORT no disponible, se usa un unico proceso")
+        args.workers = 1
+
+    if args.workers > 1:
+        supervise_workers(args.workers)
+    else:
+        server_socket = create_server_socket(server_address)
+        start_server()
     limpiar_recursos(0, 0)
@@ -1,5 +1,4 @@
 import socket
-import time
 import signal
 import sys
 import os
@@ -18,14 +17,13 @@ from lib.connection import (
     force_send_close,
     connect_server,
 )
+from lib.delta import prepare_delta, discard_delta
+from lib.chunks import prepare_dedup, discard_dedup
+from lib.offload import enable_gro
+from lib.streams import run_streams
 from lib.udp import UDPFlags, UDPHeader
 from lib.constants import (
     TIMEOUT,
-    TIMEOUT_SACK,
-    SACK_WINDOW_SIZE,
-    SEND_WINDOW_SIZE,
-    PACKAGE_SEND_DELAY,
-    MAX_SAC_DIF,
     MAX_RETRIES,
 )
 
@@ -39,12 +37,17 @@ logger = setup_logger(verbose=args.verbose, quiet=args.quiet)
 # Crear un socket UDP
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 client_socket.settimeout(TIMEOUT)
+enable_gro(client_socket)
 
 connection = Connection(
     addr=(args.host, args.port),
     sequence=0,
     download=DOWNLOAD,
     path=args.name,
+    protocol=args.protocol,
+    congestion=args.congestion,
+    rate=args.rate,
+    reordering=args.reordering,
 )
 
 
@@ -57,19 +60,21 @@ def upload_stop_and_wait():
         key = next(iter(connection.fragments))
         connection.sequence = key
         data = connection.fragments[key]
+        connection.pacer.wait(len(data) + UDPHeader.HEADER_SIZE)
         send_data(client_socket, connection, data, sequence=connection.sequence)
         logger.info(
             f"Enviando paquete {connection.sequence} - Quedan [{len(connection.fragments)}]"
         )
 
         try:
-            addr, header, data = receive_package(client_socket)
+            client_socket.settimeout(connection.rtt.rto)
+            addr, header, data = receive_package(client_socket, connection)
             connection.retries = 0
-            if header.has_ack() and header.sequence == connection.sequence:
+            if header.flags & UDPFlags.ACK and header.sequence == connection.sequence:
                 logger.info(f"ACK {connection.sequence} recibido del servidor.")
                 if header.sequence in connection.fragments:
                     connection.fragments.pop(header.sequence)
-            elif header.has_close():
+            elif header.flags & UDPFlags.CLOSE:
                 connection.is_active = False
             else:
                 logger.warning(
@@ -80,88 +85,65 @@ def upload_stop_and_wait():
             logger.warning(
                 f"ACK {connection.sequence} no recibido del servidor. Reenviando."
             )
+            connection.rtt.on_timeout()
             if connection.retries > MAX_RETRIES:
                 connection.is_active = False
             connection.retries += 1
 
 
 def send_sack_data():
-    for seq, (key, data) in enumerate(connection.fragments.items()):
-        if (
-            seq >= SACK_WINDOW_SIZE or connection.window_sents > SEND_WINDOW_SIZE
-        ):  # Solo mandamos los primeros 8 elementos
-            break
-        if key > connection.sequence + MAX_SAC_DIF:
-            break
-
-        send_data(client_socket, connection, data, sequence=key)
-        connection.window_sents += 1
-        logger.info(f"Enviando paquete  {key}  quedan {len(connection.fragments)}")
+    connection.send_window(client_socket)
 
     # Se enviaron por completo el archivo
     if not connection.fragments:
         connection.is_active = False
 
 
-def handle_ack_sack(header: UDPHeader):
-    if header.has_ack():
-        connection.window_sents -= 1
-        if header.sequence > connection.sequence:
-            connection.window_sents -= header.sequence - connection.sequence
-
-            seq = connection.sequence
-            connection.sequence = header.sequence
-
-            for i in range(seq, header.sequence + 1):
-                if i in connection.fragments:
-                    logger.info(f"Borrando fragmento {i}")
-                    del connection.fragments[i]
-
-        else:
-            sack = header.get_sequences()[1]
-            for i in sack:
-                if i in connection.fragments:
-                    # connection.window_sents -= 1
-                    del connection.fragments[i]
-    if header.has_close():
+def handle_ack_sack(header: UDPHeader, data):
+    if header.flags & UDPFlags.ACK:
+        connection.process_sack(client_socket, header, data)
+    if header.flags & UDPFlags.CLOSE:
         connection.is_active = False
 
 
 def upload_with_sack():
-    client_socket.settimeout(TIMEOUT_SACK)
-    connection.sequence = 1
     connection.get_fragments()
     connection.is_active = True
 
     send_sack_data()
     while connection.is_active:
         try:
-            addr, header, data = receive_package(client_socket)
+            client_socket.settimeout(connection.sender_wait())
+            addr, header, data = receive_package(client_socket, connection)
             connection.retries = 0
-            handle_ack_sack(header)
+            handle_ack_sack(header, data)
             while is_data_available(client_socket):
-                addr, header, data = receive_package(client_socket)
-                handle_ack_sack(header)
+                addr, header, data = receive_package(client_socket, connection)
+                handle_ack_sack(header, data)
 
             send_sack_data()
-            # Para que el cliente no sature al servidor con el envio de paquetes
-            time.sleep(PACKAGE_SEND_DELAY)
 
         except TimeoutError:
-            connection.window_sents -= SACK_WINDOW_SIZE / 2
+            if not connection.rto_expired():
+                # Solo vencio la espera del pacer, no hubo timeout
+                send_sack_data()
+                continue
+            connection.rtt.on_timeout()
+            connection.on_send_timeout()
             if connection.retries > MAX_RETRIES:
                 connection.is_active = False
-            if connection.retries % 2 == 0:
-                # logger.info(f"Quedan fragmentos:  {len(connection.fragments)}")
-                # time.sleep(PACKAGE_SEND_DELAY)
+            else:
                 send_sack_data()
             connection.retries += 1
         except Exception as e:
             logger.error(f"Error: {e} - Traceback info:\n" + traceback.format_exc())
 
 
-def handle_upload():
-    connection.path = args.src
+def handle_upload(path):
+    """Sube ``path`` (el archivo o su delta). Devuelve True si el servidor
+    confirmo el END."""
+    connection.path = path
+    uploaded = False
     try:
         if args.protocol == "stop_and_wait":
             upload_stop_and_wait()
@@ -171,13 +153,18 @@ def handle_upload():
             logger.error(f"Protocolo no soportado: {args.protocol}")
             raise ValueError(f"Protocolo no soportado: {args.protocol}")
 
-        if not connection.fragments and connection.sequence > 1:
-            force_send_end(client_socket, connection, send_end)
+        # Al reanudar puede que el servidor ya tuviera todo y no se envie nada,
+        # y un archivo vacio (o un paquete de chunks sin chunks) no tiene fragmentos
+        sent = connection.sequence > 0 or connection.skip
+        empty = getattr(connection.fragments, "total", None) == 0
+        if not connection.fragments and (sent or empty):
+            uploaded = force_send_end(client_socket, connection, send_end)
             logger.info(f"Archivo cargado exitosamente")
     except Exception as e:
         logger.error(f"Error durante el upload: {e}")
     finally:
         force_send_close(client_socket, connection, close_connection)
+    return uploaded
 
 
 def limpiar_recursos(signum, frame):
@@ -195,10 +182,38 @@ def setup_signal_handling():
 
 
 if __name__ == "__main__":
+    if not os.path.isfile(args.src):
+        logger.error(f"Error: Archivo {args.src} no encontrado.")
+        sys.exit(1)
+    if args.streams > 1 and args.stream is None:
+        if args.delta or args.dedup:
+            logger.warning(
+                "--delta y --dedup no se combinan con --streams, se sube el archivo entero"
+            )
+        sys.exit(0 if run_streams(args, os.path.getsize(args.src)) else 1)
     setup_signal_handling()
+    uploaded = False
+    delta = dedup = None
     try:
-        if connect_server(client_socket, connection, DOWNLOAD, args):
-            handle_upload()
+        extra = None
+        if args.delta and args.stream is None:
+            delta = prepare_delta(args)
+            extra = {"delta": delta[0]} if delta else None
+        elif args.dedup and args.stream is None:
+            dedup = prepare_dedup(args)
+            if dedup:
+                extra = {"chunks": dedup[0]}
+                args.resume = False  # Lo parcial seria del archivo, no del paquete
+        elif args.chunk_manifest:
+            extra = {"manifest": args.chunk_manifest}
+        if connect_server(client_socket, connection, DOWNLOAD, args, extra):
+            # Si la copia del servidor cambio desde la firma, va el archivo entero
+            path = args.src
+            if connection.delta:
+                path = delta[1]
+            elif dedup and connection.dedup:
+                path = dedup[1]
+            uploaded = handle_upload(path)
     except ValueError as e:
         logger.error(e)
     except Exception as e:
@@ -206,3 +221,9 @@ if __name__ == "__main__":
     finally:
         close_connection(client_socket, connection)
         client_socket.close()
+        connection.release_fragments()
+        if delta:
+            discard_delta(delta[1])
+        if dedup:
+            discard_dedup(dedup[1])
+    sys.exit(0 if uploaded else 1)
@@ -0,0 +1,45 @@
+import time
+import unittest
+from src.lib.ack_policy import AckPolicy
+
+
+class TestAckPolicy(unittest.TestCase):
+
+    def test_every_packet_by_default(self):
+        """Without negotiation every DATA packet is acknowledged."""
+        acks = AckPolicy()
+        self.assertTrue(acks.on_data())
+        self.assertTrue(acks.on_data())
+
+    def test_one_ack_every_n(self):
+        acks = AckPolicy(every=3, delay=1.0)
+        sent = 0
+        for _ in range(9):
+            if acks.on_data():
+                acks.on_ack_sent()
+                sent += 1
+        self.assertEqual(sent, 3)
+        self.assertAlmostEqual(acks.ratio, 1 / 3)
+        self.assertEqual(str(acks), "3/9 (0.33)")
+
+    def test_immediate_on_gap(self):
+        acks = AckPolicy(every=4, delay=1.0)
+        self.assertFalse(acks.on_data())
+        self.assertTrue(acks.on_data(immediate=True))
+
+    def test_delay_timer(self):
+        """A lone packet is acknowledged once the delay expires."""
+        acks = AckPolicy(every=2, delay=0.01)
+        self.assertEqual(acks.wait(1.0), 1.0)
+        self.assertFalse(acks.on_data())
+        self.assertFalse(acks.due())
+        self.assertLessEqual(acks.wait(1.0), 0.01)
+        time.sleep(0.02)
+        self.assertTrue(acks.due())
+        acks.on_ack_sent()
+        self.assertFalse(acks.due())
+        self.assertEqual(acks.wait(1.0), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
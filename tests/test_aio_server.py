@@ -0,0 +1,215 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from src.lib.aio_server import AsyncClientConnectionSACK
+from src.lib.connection import Message
+from src.lib.udp import UDPFlags, UDPHeader
+
+# The engine imports its modules as lib.*, so that is what gets patched
+from lib.delta import write_signature
+from lib.fragments import _pwrite
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+FRAGMENT = 1449
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def data_message(seq):
+    return Message(UDPHeader(seq, flags=UDPFlags.DATA), bytes([seq % 256]) * FRAGMENT)
+
+
+class TestAsyncSession(unittest.TestCase):
+    """Drives an upload session of the asyncio engine with a slow disk."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "file.bin")
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.peer.bind(("127.0.0.1", 0))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.peer.close()
+        self.sock.close()
+        self.dir.cleanup()
+
+    async def session(self, download=False):
+        connection = AsyncClientConnectionSACK(
+            self.sock, self.peer.getsockname(), self.path, download=download, protocol="sack"
+        )
+        connection.activate()
+        await self.wait_for(lambda: connection.waiting is None)
+        return connection
+
+    async def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            await asyncio.sleep(0.01)
+
+    def test_slow_disk_does_not_block_loop(self):
+        """Fragments keep being accepted while the writer lags, and all are saved."""
+        total = 1500
+
+        async def scenario():
+            connection = await self.session()
+            for seq in range(1, total + 1):
+                connection.put_message(data_message(seq))
+            # A blocking write would have waited for the disk instead
+            self.assertGreater(connection.fragments.backlog, 0)
+            connection.put_message(Message(UDPHeader(0, flags=UDPFlags.END), b""))
+            await self.wait_for(lambda: os.path.exists(self.path))
+
+        def slow_pwrite(*args):
+            time.sleep(0.0005)
+            return _pwrite(*args)
+
+        with patch("lib.fragments._pwrite", slow_pwrite):
+            asyncio.run(scenario())
+        with open(self.path, "rb") as f:
+            content = f.read()
+        self.assertEqual(len(content), total * FRAGMENT)
+        self.assertEqual(content[-FRAGMENT:], bytes([total % 256]) * FRAGMENT)
+
+    def test_full_backlog_drops_data(self):
+        """Past the backlog limit DATA is dropped unacknowledged, to be resent."""
+        written = threading.Event()
+
+        async def scenario():
+            connection = await self.session()
+            for seq in range(1, 1100):
+                connection.put_message(data_message(seq))
+            self.assertEqual(connection.fragments.backlog, 10)
+            self.assertNotIn(1099, connection.reassembly)
+            self.assertIn(1, connection.reassembly)
+            written.set()
+            await self.wait_for(lambda: connection.fragments.backlog == 0)
+            connection.stop()
+            await asyncio.sleep(0.1)
+
+        with patch("lib.fragments._pwrite", lambda *args: written.wait()), patch(
+            "src.lib.aio_server.WRITE_QUEUE_SIZE", 10
+        ):
+            asyncio.run(scenario())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_source_prepared_off_loop(self):
+        """A download prepares its source (assemble, sign, cache) in the executor."""
+        with open(self.path, "wb") as f:
+            f.write(os.urandom(10 * FRAGMENT))
+        threads = []
+        get_fragments = AsyncClientConnectionSACK.get_fragments
+
+        def slow_get_fragments(connection):
+            threads.append(threading.current_thread())
+            time.sleep(0.2)
+            get_fragments(connection)
+
+        async def tick(ticks):
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            ticks = []
+            ticker = asyncio.create_task(tick(ticks))
+            connection = await self.session(download=True)
+            ticker.cancel()
+            # The loop kept running while the source was being prepared
+            self.assertGreater(len(ticks), 5)
+            self.assertGreater(connection.scoreboard.pipe, 0)
+            connection.stop()
+            await asyncio.sleep(0.1)
+
+        with patch.object(AsyncClientConnectionSACK, "get_fragments", slow_get_fragments):
+            asyncio.run(scenario())
+        self.assertIsNot(threads[0], threading.main_thread())
+        self.peer.settimeout(2)
+        self.assertTrue(self.peer.recv(65536))
+
+    def test_signature_off_loop(self):
+        """The signature a delta upload asks for is computed in the executor."""
+        with open(self.path, "wb") as f:
+            f.write(os.urandom(10 * FRAGMENT))
+        threads = []
+
+        def recording_signature(path):
+            threads.append(threading.current_thread())
+            return write_signature(path)
+
+        async def scenario():
+            connection = AsyncClientConnectionSACK(
+                self.sock, self.peer.getsockname(), self.path, download=True, protocol="sack"
+            )
+            connection.set_options({"sig": "1"})
+            connection.activate()
+            await self.wait_for(lambda: connection.waiting is None)
+            self.assertIsNotNone(connection.temp_source)
+            connection.stop()
+            await self.wait_for(lambda: connection.temp_source is None)
+
+        with patch("lib.connection.write_signature", recording_signature):
+            asyncio.run(scenario())
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+
+class TestAsyncServer(unittest.TestCase):
+    """Uploads and downloads through the server running with --engine asyncio."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.port = free_port()
+        os.makedirs(os.path.join(self.dir.name, "storage"))
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(SRC, "start-server.py"), "-H", "127.0.0.1",
+             "-p", str(self.port), "-s", "storage", "--engine", "asyncio", "-q"],
+            cwd=self.dir.name,
+        )
+        time.sleep(0.5)
+        self.content = os.urandom(300 * 1024)
+        with open(os.path.join(self.dir.name, "src.bin"), "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        self.dir.cleanup()
+
+    def client(self, script, *args):
+        command = [sys.executable, os.path.join(SRC, script), "-H", "127.0.0.1",
+                   "-p", str(self.port), "-q", "--no-resume", *args]
+        return subprocess.run(command, cwd=self.dir.name, timeout=60).returncode
+
+    def read(self, path):
+        with open(os.path.join(self.dir.name, path), "rb") as f:
+            return f.read()
+
+    def test_upload_and_download(self):
+        for protocol in ("sack", "stop_and_wait"):
+            with self.subTest(protocol=protocol):
+                name = f"{protocol}.bin"
+                self.assertEqual(
+                    self.client("upload.py", "-s", "src.bin", "-n", name, "-P", protocol), 0
+                )
+                self.assertEqual(self.read(os.path.join("storage", name)), self.content)
+                self.assertEqual(
+                    self.client("download.py", "-d", "dst", "-n", name, "-P", protocol), 0
+                )
+                self.assertEqual(self.read(os.path.join("dst", name)), self.content)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import mmap
+import os
+import tempfile
+import threading
+import time
+import unittest
+from src.lib.cache import FileCache, read_file
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.loads = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def file(self, name, data):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def load(self, path):
+        self.loads.append(path)
+        return read_file(path)
+
+    def get(self, cache, path):
+        return cache.get(path, os.path.getsize(path), self.load)
+
+    def warm(self, cache, *paths):
+        """First requests, which are served from disk and only remembered."""
+        for path in paths:
+            self.assertIsNone(self.get(cache, path))
+
+    def test_cold_download_not_loaded(self):
+        """A file requested once is not read into memory."""
+        cache = FileCache(100)
+        path = self.file("a", b"x" * 10)
+        self.assertIsNone(self.get(cache, path))
+        self.assertEqual((self.loads, cache.size), ([], 0))
+
+    def test_hit_shares_content(self):
+        cache = FileCache(100)
+        path = self.file("a", b"x" * 10)
+        self.warm(cache, path)
+        first = self.get(cache, path)
+        self.assertIs(self.get(cache, path), first)
+        self.assertEqual(bytes(first), b"x" * 10)
+        self.assertEqual(self.loads, [path])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_least_recently_used_evicted(self):
+        cache = FileCache(25)
+        a, b, c = (self.file(name, name.encode() * 10) for name in "abc")
+        self.warm(cache, a, b, c)
+        self.get(cache, a)
+        self.get(cache, b)
+        self.get(cache, a)
+        self.get(cache, c)  # Evicts b, the least recently used
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(cache.evictions, 1)
+        self.get(cache, a)
+        self.get(cache, b)  # An evicted file comes back on its next request
+        self.assertEqual(self.loads, [a, b, c, b])
+
+    def test_file_larger_than_budget_not_cached(self):
+        cache = FileCache(5)
+        path = self.file("a", b"x" * 10)
+        self.assertIsNone(self.get(cache, path))
+        self.assertEqual((cache.size, self.loads), (0, []))
+
+    def test_replaced_file_is_reloaded(self):
+        """A new version of the file never gets the cached old one."""
+        cache = FileCache(100)
+        path = self.file("a", b"old")
+        self.warm(cache, path)
+        self.get(cache, path)
+        replacement = self.file("new", b"new content")
+        os.replace(replacement, path)
+        self.warm(cache, path)
+        self.assertEqual(bytes(self.get(cache, path)), b"new content")
+        self.assertEqual(cache.size, len(b"new content"))
+
+    def test_invalidate(self):
+        cache = FileCache(100)
+        path = self.file("a", b"data")
+        self.warm(cache, path)
+        self.get(cache, path)
+        cache.invalidate(path)
+        self.assertEqual(cache.size, 0)
+        self.warm(cache, path)
+        self.get(cache, path)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_concurrent_misses_load_once(self):
+        """Downloads that ask for a file being loaded wait for that load."""
+        cache = FileCache(100)
+        path = self.file("a", b"data")
+        self.warm(cache, path)
+
+        def slow_load(path):
+            time.sleep(0.05)
+            return self.load(path)
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get(path, 4, slow_load)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.loads, [path])
+        self.assertEqual([bytes(data) for data in results], [b"data"] * 8)
+        self.assertEqual((cache.hits, cache.misses), (7, 2))
+
+    def test_memory_counts_only_copies(self):
+        """Mapped files count toward the budget but not as memory held."""
+        cache = FileCache(100)
+        mapped, copied = self.file("a", b"x" * 10), self.file("b", b"y" * 20)
+        for _ in range(2):
+            self.get(cache, mapped)
+            cache.get(copied, 20, lambda path: b"y" * 20)
+        self.assertEqual((cache.size, cache.memory), (30, 20))
+        cache.invalidate(copied)
+        self.assertEqual((cache.size, cache.memory), (10, 0))
+
+    def test_read_file_maps_instead_of_copying(self):
+        path = self.file("a", b"mapped")
+        data = read_file(path)
+        self.assertIsInstance(data, mmap.mmap)
+        self.assertEqual(data[:], b"mapped")
+        self.assertEqual(read_file(self.file("empty", b"")), b"")
+
+
+if __name__ == '__main__':
+    unittest.main()
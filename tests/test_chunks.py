@@ -0,0 +1,157 @@
+import os
+import random
+import tempfile
+import unittest
+from src.lib.chunks import (
+    ChunkStore,
+    CHUNK_ENTRY,
+    chunk_boundaries,
+    chunk_file,
+    chunk_hash,
+    write_manifest,
+    read_manifest,
+    is_manifest,
+    dedup_path,
+)
+from src.lib.constants import CHUNK_MIN_SIZE, CHUNK_MAX_SIZE
+
+
+class TestChunkBoundaries(unittest.TestCase):
+
+    def setUp(self):
+        self.data = random.Random(1).randbytes(2 * 1024 * 1024)
+
+    def chunks(self, data):
+        cuts = chunk_boundaries(data)
+        return [data[start:end] for start, end in zip([0] + cuts, cuts)]
+
+    def test_chunk_size_bounds(self):
+        cuts = chunk_boundaries(self.data)
+        self.assertEqual(cuts[-1], len(self.data))
+        sizes = [end - start for start, end in zip([0] + cuts, cuts)]
+        for size in sizes[:-1]:
+            self.assertGreaterEqual(size, CHUNK_MIN_SIZE)
+            self.assertLessEqual(size, CHUNK_MAX_SIZE)
+        self.assertLess(sum(sizes) / len(sizes), CHUNK_MAX_SIZE / 2)
+
+    def test_insertion_keeps_other_chunks(self):
+        """Inserting bytes only changes the chunks around the insertion."""
+        old = self.chunks(self.data)
+        middle = len(self.data) // 2
+        new = self.chunks(self.data[:middle] + b"inserted" + self.data[middle:])
+        self.assertGreaterEqual(len(set(old) & set(new)), len(old) - 3)
+
+    def test_repetitive_data_is_cut(self):
+        """Text without random bytes is cut by content too, not at the maximum."""
+        text = b"".join(b"%d,item-%d,%d\n" % (i, i % 7, i * 3) for i in range(100000))
+        cuts = chunk_boundaries(text)
+        self.assertGreater(len(cuts), len(text) // CHUNK_MAX_SIZE + 1)
+
+    def test_empty_data(self):
+        self.assertEqual(chunk_boundaries(b""), [])
+
+
+class TestChunkStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = ChunkStore(self.dir.name)
+        self.path = os.path.join(self.dir.name, "file.bin")
+        self.data = random.Random(2).randbytes(600 * 1024)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_store_and_assemble(self):
+        self.write(self.path, self.data)
+        self.store.store_file(self.path, fsync=False)
+        self.assertTrue(is_manifest(self.path))
+        size, chunks = read_manifest(self.path)
+        self.assertEqual(size, len(self.data))
+        self.assertTrue(all(self.store.has(key) for key, _ in chunks))
+        assembled = self.store.assemble(self.path)
+        self.assertEqual(self.read(assembled), self.data)
+        os.remove(assembled)
+
+    def test_identical_file_stores_nothing_new(self):
+        self.write(self.path, self.data)
+        self.store.store_file(self.path, fsync=False)
+        other = os.path.join(self.dir.name, "copy.bin")
+        self.write(other, self.data)
+        key = read_manifest(self.path)[1][0][0]
+        self.assertFalse(self.store.put(key, self.data[:10], fsync=False))
+        self.store.store_file(other, fsync=False)
+        self.assertEqual(self.read(other), self.read(self.path))
+
+    def dedup_upload(self, data, token="ab12"):
+        """Run the server side of a deduplicated upload of ``data``."""
+        source = os.path.join(self.dir.name, "source")
+        self.write(source, data)
+        size, chunks = chunk_file(source)
+        manifest = dedup_path(self.path, "manifest", token)
+        write_manifest(manifest, size, chunks)
+        missing_path = self.store.write_missing(manifest)
+        missing = self.read(missing_path)
+        os.remove(missing_path)
+        pack = dedup_path(self.path, "chunks", token)
+        with open(pack, "wb") as f:
+            for key, offset, length in chunks:
+                if key in missing:
+                    f.write(CHUNK_ENTRY.pack(key, length) + data[offset : offset + length])
+        self.store.commit_pack(self.path, pack, manifest, fsync=False)
+        self.assertFalse(os.path.exists(pack))
+        assembled = self.store.assemble(self.path)
+        self.assertEqual(self.read(assembled), data)
+        os.remove(assembled)
+        return len(missing) // 16, len(chunks)
+
+    def test_dedup_upload_sends_only_missing_chunks(self):
+        missing, total = self.dedup_upload(self.data)
+        self.assertEqual(missing, total)
+        self.assertEqual(self.dedup_upload(self.data), (0, total))
+        changed = self.data[:1000] + b"changed" + self.data[1000:]
+        missing, total = self.dedup_upload(changed)
+        self.assertLessEqual(missing, 2)
+
+    def test_empty_file(self):
+        self.assertEqual(self.dedup_upload(b""), (0, 0))
+
+    def test_corrupt_pack_refused(self):
+        """A chunk that does not match its hash is not stored nor committed."""
+        token = "cd34"
+        manifest = dedup_path(self.path, "manifest", token)
+        write_manifest(manifest, 5, [(chunk_hash(b"hello"), 5)])
+        pack = dedup_path(self.path, "chunks", token)
+        self.write(pack, CHUNK_ENTRY.pack(chunk_hash(b"hello"), 5) + b"jello")
+        with self.assertRaises(ValueError):
+            self.store.commit_pack(self.path, pack, manifest, fsync=False)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(self.store.has(chunk_hash(b"hello")))
+
+    def test_missing_chunk_refused(self):
+        token = "ef56"
+        manifest = dedup_path(self.path, "manifest", token)
+        write_manifest(manifest, 5, [(chunk_hash(b"hello"), 5)])
+        pack = dedup_path(self.path, "chunks", token)
+        self.write(pack, b"")
+        with self.assertRaises(ValueError):
+            self.store.commit_pack(self.path, pack, manifest, fsync=False)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_invalid_manifest(self):
+        self.write(self.path, b"not a manifest")
+        self.assertFalse(is_manifest(self.path))
+        with self.assertRaises(ValueError):
+            read_manifest(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import unittest
+from src.lib.compression import FragmentCompression, RAW, CODECS
+from src.lib.constants import COMPRESSION_SAMPLE, COMPRESSION_BACKOFF
+
+TEXT = b"id,name,value\n" + b"".join(b"%d,item-%d,%d\n" % (i, i % 7, i * 3) for i in range(200))
+
+
+class TestFragmentCompression(unittest.TestCase):
+
+    def test_round_trip(self):
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                sender, receiver = FragmentCompression(codec), FragmentCompression(codec)
+                data = TEXT[:1449]
+                payload, sent_codec = sender.compress(memoryview(data))
+                self.assertNotEqual(sent_codec, RAW)
+                self.assertLess(len(payload), len(data) // 2)
+                self.assertEqual(receiver.decompress(sent_codec, payload, 1449), data)
+                self.assertEqual(receiver.raw_bytes, len(data))
+                self.assertEqual(receiver.wire_bytes, len(payload))
+
+    def test_incompressible_fragment_goes_raw(self):
+        compression = FragmentCompression("zlib")
+        data = os.urandom(1449)
+        payload, codec = compression.compress(data)
+        self.assertEqual(codec, RAW)
+        self.assertIs(payload, data)
+        self.assertEqual(compression.decompress(RAW, payload, 1449), data)
+
+    def test_bypass_after_incompressible_sample(self):
+        """A sample that does not compress stops compression for a while."""
+        compression = FragmentCompression("zlib")
+        for _ in range(COMPRESSION_SAMPLE):
+            compression.compress(os.urandom(1449))
+        cpu = compression.cpu
+        for _ in range(COMPRESSION_BACKOFF):
+            self.assertEqual(compression.compress(TEXT[:1449])[1], RAW)
+        self.assertEqual(compression.cpu, cpu)
+        self.assertNotEqual(compression.compress(TEXT[:1449])[1], RAW)
+
+    def test_retransmission_reuses_payload(self):
+        compression = FragmentCompression("lzma")
+        first = compression.compress(TEXT[:1449], seq=7)
+        self.assertEqual(compression.compress(TEXT[:1449], seq=7), first)
+        self.assertEqual(compression.fragments, 1)
+
+    def test_decompression_bounded_by_fragment(self):
+        """A payload that inflates past the fragment size is rejected."""
+        sender, receiver = FragmentCompression("zlib"), FragmentCompression("zlib")
+        payload, codec = sender.compress(b"\0" * 4096)
+        with self.assertRaises(ValueError):
+            receiver.decompress(codec, payload, 1449)
+        with self.assertRaises(ValueError):
+            receiver.decompress(codec, b"not deflate", 1449)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            FragmentCompression("brotli")
+
+
+if __name__ == '__main__':
+    unittest.main()
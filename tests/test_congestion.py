@@ -0,0 +1,85 @@
+import unittest
+from src.lib.congestion import (
+    CongestionController,
+    NewReno,
+    Cubic,
+    create_congestion_controller,
+)
+
+
+class TestNewReno(unittest.TestCase):
+
+    def test_slow_start(self):
+        """Below ssthresh the window grows by one packet per acknowledged packet."""
+        cc = NewReno(initial_window=4)
+        cc.on_ack(4)
+        self.assertEqual(cc.window, 8)
+
+    def test_congestion_avoidance(self):
+        """Above ssthresh a full window of ACKs adds about one packet."""
+        cc = NewReno(initial_window=10)
+        cc.ssthresh = 10
+        for _ in range(10):
+            cc.on_ack(1)
+        self.assertEqual(cc.window, 10)
+        self.assertGreater(cc.cwnd, 10.9)
+
+    def test_loss_and_timeout(self):
+        """A loss halves the window; a timeout goes back to the minimum window."""
+        cc = NewReno(initial_window=20)
+        cc.on_loss()
+        self.assertEqual(cc.window, 10)
+        self.assertEqual(cc.available(4), 6)
+        self.assertEqual(cc.available(12), 0)
+        cc.on_timeout()
+        self.assertEqual(cc.window, 2)
+        self.assertEqual(cc.ssthresh, 5)
+
+    def test_snapshot_restore(self):
+        """Restoring a snapshot undoes a reduction found to be spurious."""
+        cc = NewReno(initial_window=20)
+        state = cc.snapshot()
+        cc.on_loss()
+        cc.restore(state)
+        self.assertEqual(cc.window, 20)
+        self.assertEqual(cc.ssthresh, state["ssthresh"])
+
+    def test_max_window(self):
+        cc = NewReno(initial_window=8, max_window=10)
+        cc.on_ack(100)
+        self.assertEqual(cc.window, 10)
+
+
+class TestCubic(unittest.TestCase):
+
+    def test_reduction_and_growth(self):
+        """CUBIC reduces by beta = 0.7 and grows back towards the last maximum."""
+        cc = Cubic(initial_window=100)
+        cc.on_loss()
+        self.assertEqual(cc.window, 70)
+        for _ in range(70):
+            cc.on_ack(1, rtt=0.01)
+        self.assertGreater(cc.cwnd, 70)
+        self.assertLessEqual(cc.cwnd, 100)
+
+
+class TestFactory(unittest.TestCase):
+
+    def test_controller_without_growth(self):
+        """A controller that does not define congestion avoidance fails when created."""
+        class Incomplete(CongestionController):
+            name = "incomplete"
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+        with self.assertRaises(TypeError):
+            CongestionController()
+
+    def test_unknown_controller(self):
+        self.assertIsInstance(create_congestion_controller("cubic"), Cubic)
+        with self.assertRaises(ValueError):
+            create_congestion_controller("vegas")
+
+
+if __name__ == '__main__':
+    unittest.main()
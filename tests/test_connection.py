@@ -0,0 +1,92 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from src.lib.connection import encode_start, negotiate_options
+from src.lib.constants import ACK_DELAY, ACK_EVERY, MIN_FRAGMENT_SIZE
+from src.lib.udp import UDPFlags, UDPHeader, unpack_package
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+class TestNegotiateOptions(unittest.TestCase):
+
+    def test_valid_values(self):
+        accepted = negotiate_options(
+            {"ack": "1", "ack_delay": "2.5", "frag": "4000", "rate": "1000"}, rate=500
+        )
+        self.assertEqual(accepted["ack"], 1)
+        self.assertEqual(accepted["ack_delay"], 2.5)
+        self.assertEqual(accepted["frag"], 4000)
+        self.assertEqual(accepted["rate"], 500)
+
+    def test_malformed_values_ignored(self):
+        """Numbers the server can't parse are dropped instead of raising."""
+        for value in ("abc", "", "1.5", "nan", "inf", "1e999"):
+            with self.subTest(value=value):
+                accepted = negotiate_options({"frag": value, "rate": value})
+                self.assertNotIn("frag", accepted)
+                self.assertNotIn("rate", accepted)
+        accepted = negotiate_options({"ack": "x", "ack_delay": "nan"})
+        self.assertNotIn("ack", accepted)
+        accepted = negotiate_options({"ack": "2", "ack_delay": "nan"})
+        self.assertEqual(accepted["ack_delay"], 0)
+
+    def test_out_of_range_values(self):
+        """Out of range values are clamped, and a non-positive rate is ignored."""
+        accepted = negotiate_options(
+            {"ack": "-3", "ack_delay": "-1", "frag": "-1", "rate": "0"}
+        )
+        self.assertEqual(accepted["ack"], 1)
+        self.assertEqual(accepted["ack_delay"], 0)
+        self.assertEqual(accepted["frag"], MIN_FRAGMENT_SIZE)
+        self.assertNotIn("rate", accepted)
+        accepted = negotiate_options({"ack": "1000", "ack_delay": "1e9"})
+        self.assertEqual(accepted["ack"], ACK_EVERY)
+        self.assertEqual(accepted["ack_delay"], ACK_DELAY)
+
+
+class TestServerRobustness(unittest.TestCase):
+    """A malformed START from one client must not stop the server."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.dir.name, "storage"))
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(SRC, "start-server.py"), "-H", "127.0.0.1",
+             "-p", str(self.port), "-s", "storage", "-q"],
+            cwd=self.dir.name,
+        )
+        time.sleep(0.5)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.terminate()
+        self.server.wait()
+        self.dir.cleanup()
+
+    def start(self, payload):
+        header = UDPHeader(0, flags=UDPFlags.START)
+        self.client.sendto(header.pack() + payload, ("127.0.0.1", self.port))
+
+    def test_malformed_start(self):
+        self.start(encode_start("a.bin", {"frag": "abc", "ack": "x", "rate": "-5"}))
+        self.start(b"\xff\xfe")  # Name that is not UTF-8
+        time.sleep(0.2)
+        self.assertIsNone(self.server.poll())
+        self.start(encode_start("b.bin", {"frag": "4000"}))
+        data, _ = self.client.recvfrom(65536)
+        _, header = unpack_package(data)
+        self.assertTrue(header.flags & UDPFlags.START and header.flags & UDPFlags.ACK)
+
+
+if __name__ == "__main__":
+    unittest.main()
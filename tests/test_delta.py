@@ -0,0 +1,86 @@
+import os
+import random
+import tempfile
+import unittest
+from src.lib.delta import (
+    write_signature,
+    read_signature,
+    write_delta,
+    apply_delta,
+    delta_block_size,
+)
+from src.lib.constants import DELTA_MIN_BLOCK
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.basis = os.path.join(self.dir.name, "file.bin")
+        self.source = os.path.join(self.dir.name, "new.bin")
+        self.delta = os.path.join(self.dir.name, "delta")
+        self.old = random.Random(1).randbytes(20 * DELTA_MIN_BLOCK + 100)
+        self.write(self.basis, self.old)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def signature(self):
+        path = write_signature(self.basis)
+        try:
+            return read_signature(path)
+        finally:
+            os.remove(path)
+
+    def sync(self, new):
+        """Upload ``new`` as a delta and return (copied, literal) bytes."""
+        self.write(self.source, new)
+        signature = self.signature()
+        result = write_delta(self.source, signature, self.delta)
+        apply_delta(self.basis, self.delta, signature[0])
+        with open(self.basis, "rb") as f:
+            self.assertEqual(f.read(), new)
+        self.assertFalse(os.path.exists(self.delta))
+        return result
+
+    def test_unchanged_file_is_all_copies(self):
+        self.assertEqual(self.sync(self.old), (len(self.old), 0))
+
+    def test_shifted_blocks_are_found(self):
+        """An insertion shifts every block; the rolling checksum still finds them."""
+        new = b"inserted" + self.old[:5000] + b"changed" + self.old[5007:-50] + b"end"
+        copied, literal = self.sync(new)
+        self.assertLess(literal, 3 * DELTA_MIN_BLOCK)
+        self.assertEqual(copied + literal, len(new))
+
+    def test_empty_files(self):
+        self.assertEqual(self.sync(b""), (0, 0))
+        self.assertEqual(self.sync(b"now it has data"), (0, 15))
+
+    def test_changed_basis_refused(self):
+        """The delta only applies to the version of the file that was signed."""
+        signature = self.signature()
+        self.write(self.source, self.old[::-1])
+        write_delta(self.source, signature, self.delta)
+        self.write(self.basis, b"someone else uploaded this")
+        with self.assertRaises(ValueError):
+            apply_delta(self.basis, self.delta, signature[0])
+        with open(self.basis, "rb") as f:
+            self.assertEqual(f.read(), b"someone else uploaded this")
+
+    def test_too_different_gives_up(self):
+        self.write(self.source, random.Random(2).randbytes(len(self.old)))
+        result = write_delta(self.source, self.signature(), self.delta, len(self.old) // 2)
+        self.assertIsNone(result)
+
+    def test_block_size_bounds(self):
+        self.assertEqual(delta_block_size(0), DELTA_MIN_BLOCK)
+        self.assertEqual(delta_block_size(1 << 30), 32768)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+import os
+import socket
+import tempfile
+import unittest
+from src.lib.connection import BaseConnection
+from src.lib.fec import (
+    FecDecoder,
+    FecEncoder,
+    gf_inv,
+    gf_mul,
+    invert,
+    pack_parity,
+    parse_fec,
+    unpack_parity,
+)
+from src.lib.constants import FEC_ADAPT_BLOCKS, MAX_REORDERING
+from src.lib.reassembly import ReassemblyTracker
+from src.lib.udp import UDPFlags, UDPHeader
+
+SIZE = 64
+
+
+def fragments(total, last=SIZE):
+    return {
+        seq: os.urandom(last if seq == total else SIZE) for seq in range(1, total + 1)
+    }
+
+
+def encode(data, block, parity):
+    encoder = FecEncoder(block, parity, len(data), SIZE)
+    parities = {}
+    for seq in sorted(data):
+        result = encoder.add(seq, data[seq])
+        if result:
+            parities[seq - (seq - 1) % block] = result
+    return encoder, parities
+
+
+def decode(data, parities, block, lost, lost_parities=()):
+    """Feeds everything but ``lost`` to a decoder; returns what it rebuilt."""
+    received = ReassemblyTracker()
+    decoder = FecDecoder(block, SIZE, received)
+    rebuilt = {}
+    for first in sorted(parities):
+        for seq in range(first, first + block):
+            if seq in data and seq not in lost:
+                received.add(seq)
+                rebuilt.update(decoder.add_data(seq, data[seq]))
+        for index, (field, payload) in enumerate(parities[first]):
+            if (first, index) not in lost_parities:
+                rebuilt.update(decoder.add_parity(first, field, payload))
+    return decoder, rebuilt
+
+
+class TestGaloisField(unittest.TestCase):
+
+    def test_inverse(self):
+        for value in range(1, 256):
+            self.assertEqual(gf_mul(value, gf_inv(value)), 1)
+
+    def test_invert_matrix(self):
+        matrix = [[1, 1], [3, 7]]
+        inverse = invert(matrix)
+        for i in range(2):
+            for j in range(2):
+                product = 0
+                for k in range(2):
+                    product ^= gf_mul(matrix[i][k], inverse[k][j])
+                self.assertEqual(product, int(i == j))
+
+
+class TestParseFec(unittest.TestCase):
+
+    def test_valid(self):
+        self.assertEqual(parse_fec("16:2"), (16, 2))
+
+    def test_invalid(self):
+        for value in ("16", "2:4", "0:0", "16:0", "a:b", "200:2"):
+            with self.assertRaises(ValueError):
+                parse_fec(value)
+
+    def test_pack_parity(self):
+        self.assertEqual(unpack_parity(pack_parity(16, 3, 1449)), (16, 3, 1449))
+
+
+class TestFecEncoder(unittest.TestCase):
+
+    def test_first_parity_is_xor(self):
+        data = fragments(4)
+        _, parities = encode(data, 4, 2)
+        field, payload = parities[1][0]
+        expected = bytes(a ^ b ^ c ^ d for a, b, c, d in zip(*data.values()))
+        self.assertEqual(payload, expected)
+        self.assertEqual(unpack_parity(field), (4, 0, SIZE))
+
+    def test_short_last_block(self):
+        data = fragments(10, last=10)
+        encoder, parities = encode(data, 4, 1)
+        self.assertEqual(sorted(parities), [1, 5, 9])
+        self.assertEqual(unpack_parity(parities[9][0][0]), (2, 0, 10))
+        self.assertEqual(encoder.sent, 3)
+
+    def test_skipped_fragment_leaves_block_without_parity(self):
+        encoder = FecEncoder(4, 1, 8, SIZE)
+        for seq in (1, 2, 4):
+            self.assertEqual(encoder.add(seq, bytes(SIZE)), [])
+        for seq in (5, 6, 7):
+            encoder.add(seq, bytes(SIZE))
+        self.assertEqual(len(encoder.add(8, bytes(SIZE))), 1)
+
+    def test_parity_in_flight(self):
+        """Parities count as in flight until their block is acknowledged."""
+        encoder, _ = encode(fragments(8), 4, 2)
+        self.assertEqual(encoder.pipe, 4)
+        encoder.on_ack(3)
+        self.assertEqual(encoder.pipe, 4)
+        encoder.on_ack(4)
+        self.assertEqual(encoder.pipe, 2)
+        encoder.on_timeout()
+        self.assertEqual(encoder.pipe, 0)
+
+    def test_adaptive(self):
+        """Parity goes up after retransmissions and back down once clean."""
+        encoder = FecEncoder(2, 1, 10**6, SIZE, adaptive=True)
+        seq = 1
+        for evaluation in range(6):
+            if evaluation == 0:
+                encoder.on_retransmit(1)
+            for _ in range(FEC_ADAPT_BLOCKS * 2):
+                encoder.add(seq, bytes(SIZE))
+                seq += 1
+            if evaluation == 0:
+                self.assertEqual(encoder.parity, 2)
+        self.assertEqual(encoder.parity, 1)
+
+
+class TestFecDecoder(unittest.TestCase):
+
+    def test_recovers_up_to_parity(self):
+        data = fragments(8)
+        _, parities = encode(data, 8, 3)
+        decoder, rebuilt = decode(data, parities, 8, lost={1, 4, 8})
+        self.assertEqual(rebuilt, {seq: data[seq] for seq in (1, 4, 8)})
+        self.assertEqual(decoder.recovered, 3)
+        self.assertEqual(decoder.size, 0)
+
+    def test_any_parity_subset(self):
+        data = fragments(6)
+        _, parities = encode(data, 6, 3)
+        lost_parities = {(1, 0)}
+        _, rebuilt = decode(data, parities, 6, {2, 5}, lost_parities)
+        self.assertEqual(rebuilt, {2: data[2], 5: data[5]})
+
+    def test_short_last_fragment(self):
+        data = fragments(7, last=5)
+        _, parities = encode(data, 4, 1)
+        _, rebuilt = decode(data, parities, 4, lost={7})
+        self.assertEqual(rebuilt, {7: data[7]})
+
+    def test_too_many_losses(self):
+        data = fragments(8)
+        _, parities = encode(data, 8, 2)
+        decoder, rebuilt = decode(data, parities, 8, lost={1, 2, 3})
+        self.assertEqual(rebuilt, {})
+        self.assertEqual(decoder.recovered, 0)
+
+    def test_misaligned_parity_ignored(self):
+        decoder = FecDecoder(4, SIZE, ReassemblyTracker())
+        self.assertEqual(decoder.add_parity(2, pack_parity(4, 0, SIZE), bytes(SIZE)), [])
+
+    def test_block_dropped_once_complete(self):
+        """Retransmissions complete the block and free what it kept."""
+        data = fragments(4)
+        _, parities = encode(data, 4, 1)
+        received = ReassemblyTracker()
+        decoder = FecDecoder(4, SIZE, received)
+        for seq in (1, 2, 3, 4):
+            received.add(seq)
+            self.assertEqual(decoder.add_data(seq, data[seq]), [])
+        self.assertEqual(decoder.size, 0)
+        self.assertEqual(decoder.add_parity(1, *parities[1][0]), [])
+
+
+class TestFecSender(unittest.TestCase):
+    """FEC settings of a SACK sender connection."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.peer.bind(("127.0.0.1", 0))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.peer.close()
+        self.sock.close()
+        self.dir.cleanup()
+
+    def sender(self, fec, size):
+        path = os.path.join(self.dir.name, "file.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        connection = BaseConnection(
+            self.peer.getsockname(), path, download=True, protocol="sack"
+        )
+        connection.set_options({"fec": fec, "frag": str(SIZE)})
+        connection.get_fragments()
+        return connection
+
+    def test_reordering_clamped(self):
+        """Large blocks and spurious undos never push it past the cap or lower it."""
+        connection = self.sender("128:32", SIZE)
+        self.assertEqual(connection.reordering, MAX_REORDERING)
+        connection.undo_state = connection.congestion.snapshot()
+        connection.undo_seq = 1
+        connection.check_spurious(UDPHeader(1, flags=UDPFlags.ACK))
+        self.assertEqual(connection.reordering, MAX_REORDERING)
+
+    def test_parity_charged_to_window(self):
+        """Parities fill the congestion window like data until acknowledged."""
+        connection = self.sender("4:2", 20 * SIZE)
+        window = connection.congestion.window
+        self.assertEqual(connection.send_window(self.sock), window)
+        self.assertEqual(connection.in_flight(), window)
+        self.assertEqual(connection.send_window(self.sock), 0)
+        connection.process_sack(self.sock, UDPHeader(4, flags=UDPFlags.ACK))
+        self.assertEqual(connection.fec.pipe, 0)
+        self.assertLess(connection.in_flight(), window)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,264 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from src.lib.fragments import (
+    FragmentSource,
+    FragmentSink,
+    MissingFragments,
+    find_partial,
+    decode_ranges,
+)
+
+
+class TestFragmentSource(unittest.TestCase):
+
+    def setUp(self):
+        """Create a temporary file of 10 fragments of 4 bytes (the last one partial)."""
+        self.content = bytes(range(38))
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_fragments_match_file(self):
+        """Each fragment is a slice of the file at (seq-1) * fragment_size."""
+        source = FragmentSource(self.path, fragment_size=4)
+        self.assertEqual(len(source), 10)
+        self.assertEqual(bytes(source[1]), self.content[:4])
+        self.assertEqual(bytes(source[10]), self.content[36:])
+        self.assertEqual(b"".join(bytes(data) for _, data in source.items()), self.content)
+        source.close()
+
+    def test_ack_out_of_order(self):
+        """Acknowledged fragments disappear and the source closes once drained."""
+        source = FragmentSource(self.path, fragment_size=4)
+        del source[3]
+        self.assertNotIn(3, source)
+        self.assertEqual(next(iter(source)), 1)
+        self.assertEqual(source.pop(1), self.content[:4])
+        self.assertEqual(source.pop(1), None)
+        self.assertEqual(list(source)[:2], [2, 4])
+        for seq in list(source):
+            del source[seq]
+        self.assertFalse(source)
+        with self.assertRaises(KeyError):
+            source[5]
+
+    def test_fragments_from_memory(self):
+        """With the content already in memory the file is not read and
+        fragments are read-only views."""
+        os.remove(self.path)
+        with open(self.path, "wb"):
+            pass
+        source = FragmentSource(self.path, fragment_size=4, data=self.content)
+        self.assertEqual(len(source), 10)
+        self.assertEqual(bytes(source[10]), self.content[36:])
+        self.assertTrue(source[1].readonly)
+        source.close()
+
+    def test_empty_file(self):
+        """An empty file has no fragments to send."""
+        open(self.path, "wb").close()
+        source = FragmentSource(self.path, fragment_size=4)
+        self.assertFalse(source)
+        source.close()
+
+
+    def test_streams_split_fragments(self):
+        """Stream i of n carries fragments i, i + n, ... of the file."""
+        sources = [FragmentSource(self.path, fragment_size=4, stream=(i, 3)) for i in range(3)]
+        self.assertEqual([len(source) for source in sources], [4, 3, 3])
+        self.assertEqual(bytes(sources[1][2]), self.content[16:20])
+        self.assertEqual(bytes(sources[0][4]), self.content[36:])
+        for source in sources:
+            source.close()
+
+    def test_skip_received_fragments(self):
+        """When resuming, sequences number only the fragments still missing."""
+        source = FragmentSource(self.path, fragment_size=4, skip=[[1, 3], [5, 5]])
+        self.assertEqual(len(source), 6)
+        self.assertEqual(bytes(source[1]), self.content[12:16])
+        self.assertEqual(bytes(source[2]), self.content[20:24])
+        self.assertEqual(bytes(source[6]), self.content[36:])
+        source.close()
+
+
+class TestFragmentSink(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "sub", "file.bin")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_out_of_order_writes(self):
+        """Fragments received in any order end up at their offset after commit."""
+        sink = FragmentSink(self.path, fragment_size=4)
+        sink[3] = b"ij"
+        sink[1] = b"abcd"
+        self.assertFalse(sink.write(1, b"zzzz"))
+        sink[2] = b"efgh"
+        self.assertFalse(os.path.exists(self.path))
+        sink.commit()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"abcdefghij")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["file.bin"])
+
+    def test_distant_fragment_not_preallocated(self):
+        """A fragment far ahead is written without reserving disk up to it."""
+        sink = FragmentSink(self.path, fragment_size=4)
+        sink[10**6] = b"abcd"
+        sink.commit()
+        stat = os.stat(self.path)
+        self.assertEqual(stat.st_size, 4 * 10**6)
+        self.assertLess(stat.st_blocks * 512, 1024 * 1024)
+
+    def test_non_blocking_backlog(self):
+        """Without blocking, what does not fit in the queue waits in the backlog."""
+        sink = FragmentSink(self.path, fragment_size=4, queue_size=1, block=False)
+        with patch("src.lib.fragments._pwrite", side_effect=lambda *a: time.sleep(0.05)):
+            for seq in range(1, 6):
+                self.assertTrue(sink.write(seq, b"abcd"))
+            self.assertGreater(sink.backlog, 0)
+            sink.flush()
+        self.assertEqual(sink.backlog, 0)
+        sink.commit()
+        self.assertEqual(len(sink), 5)
+
+    def test_close_discards(self):
+        """Closing an uncommitted sink leaves no file behind."""
+        sink = FragmentSink(self.path, fragment_size=4, fsync="never")
+        sink[1] = b"abcd"
+        sink.close()
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_buffers_released_after_write(self):
+        """Receive buffers go back once written, or right away for duplicates."""
+        released = []
+
+        class Buffer:
+            def __init__(self, name):
+                self.name = name
+
+            def release(self):
+                released.append(self.name)
+
+        sink = FragmentSink(self.path, fragment_size=4)
+        sink.write(1, b"abcd", Buffer("first"))
+        self.assertFalse(sink.write(1, b"abcd", Buffer("duplicate")))
+        self.assertIn("duplicate", released)
+        sink.commit()
+        self.assertEqual(sorted(released), ["duplicate", "first"])
+
+    def test_streams_commit_together(self):
+        """The file appears only when the last stream of the transfer commits."""
+        sinks = [
+            FragmentSink(self.path, fragment_size=4, stream=(i, 2), transfer="ab12")
+            for i in range(2)
+        ]
+        sinks[1][1] = b"efgh"
+        sinks[0][2] = b"ij"
+        sinks[0][1] = b"abcd"
+        self.assertFalse(sinks[0].commit())
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(sinks[1].commit())
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"abcdefghij")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["file.bin"])
+
+    def test_stream_close_discards_transfer(self):
+        """A failed stream discards the parts the others already committed."""
+        first = FragmentSink(self.path, fragment_size=4, stream=(0, 2), transfer="ab12")
+        second = FragmentSink(self.path, fragment_size=4, stream=(1, 2), transfer="ab12")
+        first[1] = b"abcd"
+        first.commit()
+        second.close()
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_resume_after_interruption(self):
+        """An interrupted sink keeps what it wrote and a later one fills the rest."""
+        sink = FragmentSink(self.path, fragment_size=4, resume="cafe")
+        sink[1] = b"abcd"
+        sink[3] = b"ij"
+        sink.close()
+        token, fragment_size, ranges = find_partial(self.path)
+        self.assertEqual((token, fragment_size, ranges), ("cafe", 4, [[1, 1], [3, 3]]))
+
+        sink = FragmentSink(self.path, fragment_size=4, resume=token, skip=ranges)
+        sink[1] = b"efgh"
+        self.assertTrue(sink.commit())
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"abcdefghij")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["file.bin"])
+        self.assertIsNone(find_partial(self.path))
+
+    def test_resume_without_partial(self):
+        """Skipping fragments that are not on disk would corrupt the file."""
+        with self.assertRaises(FileNotFoundError):
+            FragmentSink(self.path, fragment_size=4, resume="cafe", skip=[[1, 1]])
+
+    def source_digest(self, content, skip=()):
+        """Digest the sender computes while sending ``content`` in 4 byte fragments."""
+        source_path = os.path.join(self.dir.name, "source.bin")
+        with open(source_path, "wb") as f:
+            f.write(content)
+        source = FragmentSource(source_path, fragment_size=4, skip=skip, digest=True)
+        for seq in list(source):
+            source.pop(seq)
+        return source.finish_digest()
+
+    def test_digest_out_of_order(self):
+        """Fragments hashed as they are written match the sender's digest."""
+        sink = FragmentSink(self.path, fragment_size=4, digest=True)
+        sink[3] = b"ij"
+        sink[1] = b"abcd"
+        sink[2] = b"efgh"
+        self.assertEqual(sink.finish_digest(), self.source_digest(b"abcdefghij"))
+        self.assertNotEqual(sink.finish_digest(), self.source_digest(b"abcdefghiX"))
+        sink.close()
+
+    def test_digest_covers_resumed_fragments(self):
+        """After resuming, what was received before is read back into the digest."""
+        sink = FragmentSink(self.path, fragment_size=4, resume="cafe")
+        sink[1] = b"abcd"
+        sink[3] = b"ij"
+        sink.close()
+        sink = FragmentSink(
+            self.path, fragment_size=4, resume="cafe", skip=[[1, 1], [3, 3]], digest=True
+        )
+        sink[1] = b"efgh"
+        skipped = self.source_digest(b"abcdefghij", skip=[[1, 1], [3, 3]])
+        self.assertEqual(sink.finish_digest(), skipped)
+        self.assertEqual(skipped, self.source_digest(b"abcdefghij"))
+        sink.discard()
+        self.assertIsNone(find_partial(self.path))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_invalid_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            FragmentSink(self.path, fsync="sometimes")
+
+
+class TestMissingFragments(unittest.TestCase):
+
+    def test_numbering(self):
+        missing = MissingFragments([[1, 5], [8, 9]])
+        self.assertEqual([missing.fragment(seq) for seq in range(1, 5)], [6, 7, 10, 11])
+        self.assertEqual(missing.count(8), 6)
+        self.assertEqual(MissingFragments().fragment(3), 3)
+
+    def test_decode_ranges(self):
+        self.assertEqual(decode_ranges("1-5,8-9"), [[1, 5], [8, 9]])
+        self.assertEqual(decode_ranges(""), [])
+        for value in ("5-1", "1-5,3-9", "1-x", "0-2"):
+            with self.assertRaises(ValueError):
+                decode_ranges(value)
+
+
+if __name__ == '__main__':
+    unittest.main()
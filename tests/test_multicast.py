@@ -0,0 +1,74 @@
+import unittest
+from src.lib.multicast import parse_group, plan_repairs, missing_ranges
+from src.lib.reassembly import ReassemblyTracker
+
+
+class TestParseGroup(unittest.TestCase):
+
+    def test_group(self):
+        self.assertEqual(parse_group("239.1.2.3:5001"), ("239.1.2.3", 5001))
+
+    def test_fanout(self):
+        self.assertIsNone(parse_group("fanout"))
+
+    def test_unicast_rejected(self):
+        with self.assertRaises(ValueError):
+            parse_group("10.0.0.1:5001")
+        with self.assertRaises(ValueError):
+            parse_group("239.1.2.3:0")
+
+
+class TestPlanRepairs(unittest.TestCase):
+
+    def test_single_receiver_unicast(self):
+        plan = plan_repairs({"a": [(3, 5), (9, 9)]}, 4)
+        self.assertEqual(plan, [(3, 5, ["a"]), (9, 9, ["a"])])
+
+    def test_shared_loss_multicast(self):
+        """What several receivers lost goes to the group once."""
+        plan = plan_repairs({"a": [(1, 10)], "b": [(5, 12)]}, 4)
+        self.assertEqual(plan, [(1, 4, ["a"]), (5, 10, None), (11, 12, ["b"])])
+
+    def test_share_of_receivers(self):
+        """Two requests out of many receivers are still sent by unicast."""
+        plan = plan_repairs({"a": [(1, 2)], "b": [(1, 2)]}, 20, share=0.25)
+        self.assertEqual(plan, [(1, 2, ["a", "b"])])
+        plan = plan_repairs({"a": [(1, 2)], "b": [(1, 2)]}, 8, share=0.25)
+        self.assertEqual(plan, [(1, 2, None)])
+
+    def test_adjacent_ranges_merged(self):
+        plan = plan_repairs({"a": [(1, 3), (4, 6)]}, 1)
+        self.assertEqual(plan, [(1, 6, ["a"])])
+
+    def test_no_requests(self):
+        self.assertEqual(plan_repairs({}, 3), [])
+
+
+class TestMissingRanges(unittest.TestCase):
+
+    def tracker(self, *sequences):
+        tracker = ReassemblyTracker()
+        for seq in sequences:
+            tracker.add(seq)
+        return tracker
+
+    def test_gaps_up_to_last(self):
+        tracker = self.tracker(1, 2, 5, 6, 9)
+        self.assertEqual(missing_ranges(tracker, 9), [(3, 4), (7, 8)])
+
+    def test_tail_missing(self):
+        """Up to the last fragment of the file the tail is missing too."""
+        tracker = self.tracker(1, 2, 5)
+        self.assertEqual(missing_ranges(tracker, 10), [(3, 4), (6, 10)])
+
+    def test_complete(self):
+        self.assertEqual(missing_ranges(self.tracker(1, 2, 3), 3), [])
+        self.assertEqual(missing_ranges(self.tracker(), 0), [])
+
+    def test_limit(self):
+        tracker = self.tracker(2, 4, 6, 8)
+        self.assertEqual(missing_ranges(tracker, 9, limit=2), [(1, 1), (3, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import errno
+import socket
+import unittest
+from src.lib import offload
+
+
+class FakeSocket:
+    def __init__(self, gso_error=None):
+        self.gso_error = gso_error
+        self.sendmsg_calls = []
+        self.sent = []
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        if ancdata and self.gso_error:
+            raise OSError(self.gso_error, "not supported")
+        if ancdata:
+            self.sendmsg_calls.append((list(buffers), ancdata))
+        else:
+            self.sent.append(b"".join(buffers))
+
+
+class TestOffload(unittest.TestCase):
+
+    def setUp(self):
+        self.gso_enabled = offload.gso_enabled
+        offload.gso_enabled = True
+
+    def tearDown(self):
+        offload.gso_enabled = self.gso_enabled
+
+    def test_equal_sized_window_in_one_send(self):
+        """A run of equal datagrams plus a shorter last one goes out in one sendmsg."""
+        sock = FakeSocket()
+        packages = [(b"h" * 10, b"a" * 90)] * 5 + [(b"h" * 10, b"b")]
+        offload.send_packages(sock, packages, ("127.0.0.1", 1))
+        self.assertEqual(len(sock.sendmsg_calls), 1)
+        self.assertEqual(
+            sock.sendmsg_calls[0][0], [buffer for p in packages for buffer in p]
+        )
+        self.assertEqual(sock.sent, [])
+
+    def test_size_change_splits_the_run(self):
+        """A shorter datagram ends the run; what follows is sent separately."""
+        sock = FakeSocket()
+        packages = [(b"a" * 100,)] * 3 + [(b"b" * 10,), (b"c" * 10,), (b"d" * 10,)]
+        offload.send_packages(sock, packages, ("127.0.0.1", 1))
+        self.assertEqual([len(c[0]) for c in sock.sendmsg_calls], [4, 2])
+
+    def test_fallback_when_kernel_rejects_gso(self):
+        """An unsupported GSO disables it and sends one datagram at a time."""
+        sock = FakeSocket(gso_error=errno.EIO)
+        packages = [(b"h", b"a" * 100)] * 4
+        offload.send_packages(sock, packages, ("127.0.0.1", 1))
+        self.assertEqual(sock.sent, [b"h" + b"a" * 100] * 4)
+        self.assertFalse(offload.gso_enabled)
+
+    def test_gro_splits_coalesced_datagrams(self):
+        """Datagrams sent with GSO come back one by one through recv_package."""
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        self.addCleanup(sender.close)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(1)
+        gro = offload.enable_gro(receiver)
+
+        packages = [(b"h", bytes([i]) * 1000) for i in range(6)] + [(b"h", b"z" * 30)]
+        offload.send_packages(sender, packages, receiver.getsockname())
+        received = [bytes(offload.recv_package(receiver)[0]) for _ in packages]
+        self.assertEqual(received, [b"".join(p) for p in packages])
+        self.assertFalse(offload.has_pending(receiver))
+        if not gro:
+            self.skipTest("UDP GRO not supported, checked the plain path only")
+
+
+class TestReceiveBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.receiver.close)
+        self.addCleanup(self.sender.close)
+        self.receiver.bind(("127.0.0.1", 0))
+
+    def test_drains_queued_datagrams(self):
+        """Queued datagrams come out of one call on pooled buffers."""
+        pool = offload.BufferPool(64, total_bytes=0)
+        free = len(pool.free)
+        for i in range(5):
+            self.sender.sendto(bytes([i]) * (10 + i), self.receiver.getsockname())
+
+        received = []
+        for addr, data, buffer in offload.receive_batch(self.receiver, pool):
+            received.append(bytes(data))
+            buffer.release()
+        if not hasattr(socket, "MSG_DONTWAIT"):
+            self.skipTest("MSG_DONTWAIT not supported, one datagram per call")
+        self.assertEqual(received, [bytes([i]) * (10 + i) for i in range(5)])
+        self.assertEqual(len(pool.free), free)
+        self.assertEqual(pool.misses, 0)
+
+    def test_gro_segments_share_the_buffer(self):
+        """Coalesced segments keep their own length and free the buffer together."""
+        if not (offload.gso_enabled and offload.enable_gro(self.receiver)):
+            self.skipTest("UDP GSO/GRO not supported")
+        pool = offload.create_pool(self.receiver)
+        free = len(pool.free)
+        packages = [(b"h", b"a" * 1000)] * 3 + [(b"h", b"z" * 30)]
+        offload.send_packages(self.sender, packages, self.receiver.getsockname())
+
+        received = []
+        buffers = []
+        for addr, data, buffer in offload.receive_batch(self.receiver, pool, limit=1):
+            received.append(bytes(data))
+            buffers.append(buffer)
+        self.assertEqual(received, [b"".join(p) for p in packages])
+        for buffer in buffers:
+            buffer.release()
+        self.assertEqual(len(pool.free), free)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from src.lib.pacer import Pacer
+from src.lib.congestion import NewReno
+from src.lib.constants import PACKAGE_SIZE
+
+
+class TestPacer(unittest.TestCase):
+
+    def test_unlimited_without_rtt(self):
+        """Without RTT samples nor rate limit packets are never delayed."""
+        pacer = Pacer()
+        pacer.update(NewReno(), None)
+        for _ in range(100):
+            self.assertEqual(pacer.delay(PACKAGE_SIZE), 0)
+            pacer.consume(PACKAGE_SIZE)
+
+    def test_rate_from_window(self):
+        """The pacing rate is gain * cwnd * PACKAGE_SIZE / srtt."""
+        pacer = Pacer()
+        cc = NewReno(initial_window=10)
+        cc.ssthresh = 10
+        pacer.update(cc, 0.1)
+        self.assertAlmostEqual(pacer.rate, 1.25 * 10 * PACKAGE_SIZE / 0.1)
+
+    def test_rate_limit(self):
+        """The user limit caps the rate and the bucket delays once the burst is spent."""
+        pacer = Pacer(rate_limit=1000, burst=1)
+        pacer.update(NewReno(), 0.001)
+        self.assertEqual(pacer.rate, 1000)
+        self.assertEqual(pacer.delay(PACKAGE_SIZE), 0)
+        pacer.consume(PACKAGE_SIZE)
+        self.assertAlmostEqual(pacer.delay(PACKAGE_SIZE), PACKAGE_SIZE / 1000, places=2)
+
+
+    def test_non_positive_limit(self):
+        for limit in (0, -1):
+            with self.assertRaises(ValueError):
+                Pacer(rate_limit=limit)
+            with self.assertRaises(ValueError):
+                Pacer().set_limit(limit)
+
+    def test_package_size(self):
+        """The negotiated datagram size scales both the rate and the burst."""
+        pacer = Pacer(burst=2)
+        pacer.set_package_size(4 * PACKAGE_SIZE)
+        self.assertEqual(pacer.capacity, 8 * PACKAGE_SIZE)
+        cc = NewReno(initial_window=10)
+        cc.ssthresh = 10
+        pacer.update(cc, 0.1)
+        self.assertAlmostEqual(pacer.rate, 1.25 * 10 * 4 * PACKAGE_SIZE / 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
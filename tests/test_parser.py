@@ -1,6 +1,6 @@
 import unittest
 from unittest.mock import patch
-from src.lib.parser import parse_download_args, parse_upload_args
+from src.lib.parser import parse_download_args, parse_upload_args, parse_server_args
 
 class TestUploadParser(unittest.TestCase):
     
@@ -25,6 +25,50 @@ class TestUploadParser(unittest.TestCase):
         with self.assertRaises(SystemExit):  # argparse exits when required args are missing
             parse_upload_args()
 
+    @patch('sys.argv', ['upload.py', '-H', '127.0.0.1', '-p', '8000', '-P', 'sack', '-s', 'file.txt', '-n', 'file_on_server.txt', '--fragment-size', 'auto'])
+    def test_upload_parser_fragment_auto(self):
+        """Test that auto leaves the fragment size to the path MTU probe."""
+        args = parse_upload_args()
+        self.assertIsNone(args.fragment_size)
+
+    @patch('sys.argv', ['upload.py', '-H', '127.0.0.1', '-p', '8000', '-P', 'sack', '-s', 'file.txt', '-n', 'file_on_server.txt', '--streams', '4'])
+    def test_upload_parser_streams(self):
+        """Test the number of parallel streams."""
+        args = parse_upload_args()
+        self.assertEqual(args.streams, 4)
+        self.assertIsNone(args.stream)
+
+    @patch('sys.argv', ['upload.py', '-H', '127.0.0.1', '-p', '8000', '-P', 'sack', '-s', 'file.txt', '-n', 'file_on_server.txt', '--stream', '4/4'])
+    def test_upload_parser_invalid_stream(self):
+        """Test that a stream index is below the number of streams."""
+        with self.assertRaises(SystemExit):
+            parse_upload_args()
+
+    @patch('sys.argv', ['upload.py', '-H', '127.0.0.1', '-p', '8000', '-P', 'sack', '-s', 'file.txt', '-n', 'file_on_server.txt', '--fragment-size', '100'])
+    def test_upload_parser_fragment_too_small(self):
+        """Test that the fragment size has a lower bound."""
+        with self.assertRaises(SystemExit):
+            parse_upload_args()
+
+    @patch('sys.argv', ['upload.py', '-H', '127.0.0.1', '-p', '8000', '-P', 'sack', '-s', 'file.txt', '-n', 'file_on_server.txt', '--delta', '--dedup'])
+    def test_upload_parser_delta_or_dedup(self):
+        """Test that a delta upload and a deduplicated upload exclude each other."""
+        with self.assertRaises(SystemExit):
+            parse_upload_args()
+
+    @patch('sys.argv', ['upload.py', '-H', '127.0.0.1', '-p', '8000', '-P', 'sack', '-s', 'file.txt', '-n', 'file_on_server.txt', '--fec', '16:2', '--fec-adaptive'])
+    def test_upload_parser_fec(self):
+        """Test the FEC block and parity."""
+        args = parse_upload_args()
+        self.assertEqual(args.fec, (16, 2))
+        self.assertTrue(args.fec_adaptive)
+
+    @patch('sys.argv', ['upload.py', '-H', '127.0.0.1', '-p', '8000', '-P', 'sack', '-s', 'file.txt', '-n', 'file_on_server.txt', '--fec', '2:4'])
+    def test_upload_parser_invalid_fec(self):
+        """Test that a block has at least as many fragments as parities."""
+        with self.assertRaises(SystemExit):
+            parse_upload_args()
+
 class TestDownloadParser(unittest.TestCase):
     
     @patch('sys.argv', ['download.py', '-H', '127.0.0.1', '-p', '8000', '-d', 'destination.txt', '-n', 'file_on_server.txt'])
@@ -48,5 +92,85 @@ class TestDownloadParser(unittest.TestCase):
         with self.assertRaises(SystemExit):  # argparse exits when required args are missing
             parse_download_args()
 
+class TestServerParser(unittest.TestCase):
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage'])
+    def test_server_parser_single_worker_by_default(self):
+        """Test that the server runs a single process unless asked otherwise."""
+        args = parse_server_args()
+        self.assertEqual(args.workers, 1)
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--workers', '4'])
+    def test_server_parser_workers(self):
+        """Test the number of worker processes."""
+        args = parse_server_args()
+        self.assertEqual(args.workers, 4)
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--workers', '0'])
+    def test_server_parser_invalid_workers(self):
+        """Test that at least one worker is required."""
+        with self.assertRaises(SystemExit):
+            parse_server_args()
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--ack-every', '4', '--ack-delay', '2.5'])
+    def test_server_parser_ack_policy(self):
+        """Test the delayed ACK settings."""
+        args = parse_server_args()
+        self.assertEqual(args.ack_every, 4)
+        self.assertEqual(args.ack_delay, 2.5)
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--ack-every', '0'])
+    def test_server_parser_invalid_ack_every(self):
+        """Test that an ACK covers at least one packet."""
+        with self.assertRaises(SystemExit):
+            parse_server_args()
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--reordering', '6'])
+    def test_server_parser_reordering(self):
+        """Test the reordering threshold for fast retransmit."""
+        args = parse_server_args()
+        self.assertEqual(args.reordering, 6)
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--max-fragment-size', '8000'])
+    def test_server_parser_max_fragment(self):
+        """Test the largest fragment clients may negotiate."""
+        args = parse_server_args()
+        self.assertEqual(args.max_fragment_size, 8000)
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage'])
+    def test_server_parser_cache_disabled_by_default(self):
+        """Test that the file cache is off unless a size is given."""
+        args = parse_server_args()
+        self.assertEqual(args.cache_size, 0)
+
+    def test_server_parser_rate(self):
+        """Test that the rate limit must be a positive number of bytes/s."""
+        with patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--rate', '10M']):
+            self.assertEqual(parse_server_args().rate, 10 * 1024**2)
+        for rate in ('0', '--rate=-5', '0.0001K', 'abc'):
+            argv = ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage']
+            argv += [rate] if rate.startswith('--') else ['--rate', rate]
+            with self.subTest(rate=rate), patch('sys.argv', argv):
+                with self.assertRaises(SystemExit):
+                    parse_server_args()
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--multicast', '239.1.2.3:5001'])
+    def test_server_parser_multicast(self):
+        """Test the multicast group of the server."""
+        args = parse_server_args()
+        self.assertEqual(args.multicast, '239.1.2.3:5001')
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--multicast', '10.0.0.1:5001'])
+    def test_server_parser_invalid_multicast(self):
+        """Test that a unicast address is not taken as a group."""
+        with self.assertRaises(SystemExit):
+            parse_server_args()
+
+    @patch('sys.argv', ['start-server.py', '-H', '127.0.0.1', '-p', '8000', '-s', 'storage', '--multicast', '239.1.2.3:5001', '--workers', '4'])
+    def test_server_parser_multicast_with_workers(self):
+        """Test that a multicast distribution is not split among workers."""
+        with self.assertRaises(SystemExit):
+            parse_server_args()
+
 if __name__ == '__main__':
     unittest.main()
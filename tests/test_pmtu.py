@@ -0,0 +1,66 @@
+import errno
+import socket
+import sys
+import unittest
+from src.lib import pmtu
+from src.lib.constants import MAX_DATAGRAM_SIZE, MAX_FRAGMENT_SIZE
+
+
+class FakeSocket:
+    """Route whose MTU drops to ``path_mtu`` once a larger probe is sent."""
+
+    def __init__(self, route_mtu, path_mtu):
+        self.route_mtu = route_mtu
+        self.path_mtu = path_mtu
+        self.sent = []
+        self.idle = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def fileno(self):
+        return self.idle.fileno()
+
+    def getsockopt(self, level, option):
+        return self.route_mtu
+
+    def send(self, data):
+        self.sent.append(len(data))
+        if len(data) + pmtu.UDP_IP_OVERHEAD > self.path_mtu:
+            self.route_mtu = min(self.route_mtu, self.path_mtu)
+            raise OSError(errno.EMSGSIZE, "Message too long")
+
+    def close(self):
+        self.idle.close()
+
+
+class TestPathMTU(unittest.TestCase):
+
+    def test_search_follows_lower_mtu(self):
+        """A rejected probe is retried with the MTU the kernel learned."""
+        sock = FakeSocket(9000, 1500)
+        self.addCleanup(sock.close)
+        self.assertEqual(pmtu._search(sock, wait=0), 1472)
+        self.assertEqual(sock.sent, [8972, 1472])
+
+    def test_search_gives_up_without_feedback(self):
+        """If the kernel does not learn a lower MTU the probe is not repeated."""
+        sock = FakeSocket(1500, 1000)
+        sock.getsockopt = lambda level, option: 1500
+        self.addCleanup(sock.close)
+        self.assertIsNone(pmtu._search(sock, wait=0))
+
+    def test_search_capped_to_udp_payload(self):
+        sock = FakeSocket(65536, 65536)
+        self.addCleanup(sock.close)
+        self.assertEqual(pmtu._search(sock, wait=0), MAX_DATAGRAM_SIZE)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "IP_MTU is Linux only")
+    def test_loopback(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        receiver.bind(("127.0.0.1", 0))
+        size = pmtu.path_fragment_size(receiver.getsockname())
+        self.assertIsNotNone(size)
+        self.assertLessEqual(size, MAX_FRAGMENT_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
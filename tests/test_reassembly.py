@@ -0,0 +1,90 @@
+import unittest
+from src.lib.reassembly import ReassemblyTracker
+
+
+class TestReassemblyTracker(unittest.TestCase):
+
+    def test_in_order_advances_cumulative(self):
+        tracker = ReassemblyTracker()
+        for seq in range(1, 6):
+            self.assertTrue(tracker.add(seq))
+        self.assertEqual(tracker.cumulative, 5)
+        self.assertEqual(tracker.sack_ranges(), [])
+
+    def test_duplicates_rejected(self):
+        tracker = ReassemblyTracker()
+        tracker.add(1)
+        tracker.add(3)
+        self.assertFalse(tracker.add(1))
+        self.assertFalse(tracker.add(3))
+        self.assertIn(3, tracker)
+        self.assertNotIn(2, tracker)
+
+    def test_out_of_order_ranges(self):
+        """Gaps leave separate ranges that merge when the hole is filled."""
+        tracker = ReassemblyTracker()
+        for seq in (3, 4, 7, 8, 10):
+            tracker.add(seq)
+        self.assertEqual(tracker.sack_ranges(), [[3, 4], [7, 8], [10, 10]])
+        tracker.add(9)
+        self.assertEqual(tracker.sack_ranges(), [[3, 4], [7, 10]])
+        tracker.add(6)
+        self.assertEqual(tracker.sack_ranges(), [[3, 4], [6, 10]])
+        self.assertEqual(tracker.sack_ranges(limit=1), [[3, 4]])
+
+    def test_filling_first_hole_absorbs_range(self):
+        tracker = ReassemblyTracker()
+        for seq in (2, 3, 4, 6):
+            tracker.add(seq)
+        tracker.add(1)
+        self.assertEqual(tracker.cumulative, 4)
+        self.assertEqual(tracker.sack_ranges(), [[6, 6]])
+
+    def test_ring_reused_after_wrap(self):
+        """Slots freed by the cumulative ACK do not report later sequences."""
+        tracker = ReassemblyTracker(size=8)
+        for seq in range(2, 6):
+            tracker.add(seq)
+        tracker.add(1)
+        self.assertNotIn(13, tracker)
+        self.assertTrue(tracker.add(13))
+        self.assertEqual(tracker.sack_ranges(), [[13, 13]])
+
+    def test_grows_for_distant_sequences(self):
+        tracker = ReassemblyTracker(size=8)
+        tracker.add(3)
+        tracker.add(100)
+        self.assertIn(3, tracker)
+        self.assertIn(100, tracker)
+        self.assertNotIn(11, tracker)
+        self.assertEqual(tracker.sack_ranges(), [[3, 3], [100, 100]])
+
+    def test_bitmap_sequences(self):
+        tracker = ReassemblyTracker()
+        for seq in (2, 3, 32, 33, 40):
+            tracker.add(seq)
+        self.assertEqual(list(tracker.sequences(32)), [2, 3, 32])
+
+    def test_add_range(self):
+        """Ranges loaded when resuming merge like single sequences."""
+        tracker = ReassemblyTracker()
+        tracker.add_range(1, 1000)
+        tracker.add_range(1003, 1004)
+        self.assertEqual(tracker.cumulative, 1000)
+        tracker.add(1001)
+        tracker.add_range(1002, 1002)
+        self.assertEqual(tracker.received(), [[1, 1004]])
+
+    def test_window_drops_distant_sequences(self):
+        """Past the receive window a sequence is dropped without growing the ring."""
+        tracker = ReassemblyTracker(size=8, window=16)
+        self.assertFalse(tracker.add(2**31))
+        self.assertFalse(tracker.add(17))
+        self.assertEqual(len(tracker.ring), 8)
+        self.assertNotIn(2**31, tracker)
+        self.assertTrue(tracker.add(16))
+        self.assertEqual(tracker.sack_ranges(), [[16, 16]])
+
+
+if __name__ == '__main__':
+    unittest.main()
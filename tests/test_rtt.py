@@ -0,0 +1,50 @@
+import unittest
+from src.lib.rtt import RTTEstimator, timestamp
+from src.lib.udp import UDPHeader
+
+
+class TestRTTEstimator(unittest.TestCase):
+
+    def test_initial_rto(self):
+        """Before any sample the configured initial timeout is used."""
+        rtt = RTTEstimator(0.6)
+        self.assertEqual(rtt.rto, 0.6)
+
+    def test_first_sample(self):
+        """The first sample sets SRTT = R and RTTVAR = R / 2 (RFC 6298)."""
+        rtt = RTTEstimator(0.6, min_rto=0.0)
+        rtt.sample(0.1)
+        self.assertAlmostEqual(rtt.srtt, 0.1)
+        self.assertAlmostEqual(rtt.rttvar, 0.05)
+        self.assertAlmostEqual(rtt.rto, 0.3)
+
+    def test_rto_bounds(self):
+        """The RTO never goes below the minimum nor above the maximum."""
+        rtt = RTTEstimator(0.6, min_rto=0.02, max_rto=1.0)
+        rtt.sample(0.0)
+        self.assertEqual(rtt.rto, 0.02)
+        rtt.sample(5.0)
+        self.assertEqual(rtt.rto, 1.0)
+
+    def test_backoff(self):
+        """Every timeout doubles the RTO until a new sample arrives."""
+        rtt = RTTEstimator(0.1, max_rto=10.0)
+        rtt.on_timeout()
+        rtt.on_timeout()
+        self.assertAlmostEqual(rtt.rto, 0.4)
+        rtt.sample(0.1)
+        self.assertEqual(rtt.backoff, 1)
+
+    def test_timestamp_echo(self):
+        """A header echoing our timestamp yields a sample; its own timestamp is kept."""
+        rtt = RTTEstimator(0.6)
+        header = UDPHeader(1, ts=1234, ts_echo=timestamp(), extended=True)
+        rtt.on_receive(header)
+        self.assertIsNotNone(rtt.srtt)
+        self.assertEqual(rtt.ts_recent, 1234)
+        rtt.on_timeout()
+        self.assertEqual(rtt.ts_recent, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from src.lib.scoreboard import Scoreboard, IN_FLIGHT, SACKED, LOST
+
+
+def sent(count, now=0.0):
+    scoreboard = Scoreboard()
+    for seq in range(1, count + 1):
+        scoreboard.on_send(seq, now)
+    return scoreboard
+
+
+class TestScoreboard(unittest.TestCase):
+
+    def test_send_and_cumulative_ack(self):
+        scoreboard = sent(10)
+        self.assertEqual(scoreboard.pipe, 10)
+        self.assertEqual(scoreboard.next_seq, 11)
+        self.assertEqual(scoreboard.ack(4), 4)
+        self.assertEqual(scoreboard.pipe, 6)
+        self.assertEqual(scoreboard.base, 5)
+        self.assertEqual(scoreboard.ack(4), 0)
+
+    def test_sack_counts_only_new(self):
+        """Ranges already SACKed are not delivered twice, nor by the cumulative ACK."""
+        scoreboard = sent(10)
+        self.assertEqual(scoreboard.sack(3, 5), 3)
+        self.assertEqual(scoreboard.sack(4, 6), 1)
+        self.assertEqual(scoreboard.pipe, 6)
+        self.assertEqual(scoreboard.ack(7), 3)
+        self.assertEqual(scoreboard.pipe, 3)
+
+    def test_sack_clamped_to_sent(self):
+        scoreboard = sent(5)
+        self.assertEqual(scoreboard.sack(4, 50), 2)
+        self.assertEqual(scoreboard.sack(0, 0), 0)
+
+    def test_loss_needs_threshold_sacked_above(self):
+        scoreboard = sent(10)
+        scoreboard.sack(3, 4)
+        self.assertEqual(scoreboard.detect_losses(3), 0)
+        scoreboard.sack(6, 6)
+        self.assertEqual(scoreboard.detect_losses(3), 2)
+        self.assertEqual(scoreboard.state[0], LOST)
+        self.assertEqual(scoreboard.state[4], IN_FLIGHT)
+        self.assertEqual(scoreboard.pipe, 5)
+        self.assertEqual(scoreboard.next_lost(), 1)
+
+    def test_retransmission_not_lost_again(self):
+        """A retransmitted hole is only declared lost again by a timeout."""
+        scoreboard = sent(10)
+        scoreboard.sack(2, 4)
+        scoreboard.detect_losses(3)
+        scoreboard.on_send(1, 1.0)
+        self.assertIsNone(scoreboard.next_lost())
+        scoreboard.sack(5, 8)
+        self.assertEqual(scoreboard.detect_losses(3), 0)
+        self.assertEqual(scoreboard.transmissions[0], 2)
+        self.assertEqual(scoreboard.on_timeout(cutoff=1.0), 3)
+        self.assertEqual(scoreboard.next_lost(), 1)
+
+    def test_timeout_spares_recent(self):
+        scoreboard = sent(4, now=1.0)
+        scoreboard.on_send(5, 2.0)
+        scoreboard.sack(2, 2)
+        self.assertEqual(scoreboard.on_timeout(cutoff=1.5), 3)
+        self.assertEqual(scoreboard.pipe, 1)
+        self.assertEqual(scoreboard.state[1], SACKED)
+
+    def test_mark_lost_only_first_transmission(self):
+        """Duplicate ACKs mark a hole lost once; its retransmission is left alone."""
+        scoreboard = sent(5)
+        self.assertTrue(scoreboard.mark_lost(1))
+        self.assertFalse(scoreboard.mark_lost(1))
+        scoreboard.on_send(1, 1.0)
+        self.assertFalse(scoreboard.mark_lost(1))
+        self.assertFalse(scoreboard.mark_lost(9))
+        self.assertEqual(scoreboard.pipe, 5)
+
+    def test_lost_retransmission(self):
+        """A retransmission sent before something the receiver already has is lost."""
+        scoreboard = sent(10)
+        scoreboard.sack(2, 4)
+        scoreboard.detect_losses(3)
+        scoreboard.on_send(1, 1.0)
+        self.assertEqual(scoreboard.detect_lost_retransmissions(before=1.0), 0)
+        self.assertEqual(scoreboard.detect_lost_retransmissions(before=2.0), 1)
+        self.assertEqual(scoreboard.next_lost(), 1)
+        self.assertEqual(scoreboard.state[5], IN_FLIGHT)
+
+    def test_compaction_keeps_offsets(self):
+        scoreboard = Scoreboard()
+        for seq in range(1, 5001):
+            scoreboard.on_send(seq, 0.0)
+            scoreboard.ack(seq - 2)
+        self.assertGreater(scoreboard.offset, 1)
+        self.assertLess(len(scoreboard.state), 5000)
+        self.assertEqual(scoreboard.sack(5000, 5000), 1)
+        self.assertEqual(scoreboard.pipe, 1)
+        self.assertEqual(scoreboard.ack(5000), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
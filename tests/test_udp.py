@@ -0,0 +1,182 @@
+import socket
+import unittest
+from src.lib.udp import (
+    UDPHeader,
+    UDPFlags,
+    MAX_HEADER_SIZE,
+    pack_header_into,
+    pack_crc_into,
+    unpack_package,
+    encode_sack_blocks,
+    decode_sack_blocks,
+)
+from src.lib.connection import BaseConnection, data_package, encode_start, decode_start
+from src.lib.offload import send_buffers
+
+
+class TestHeaderCodec(unittest.TestCase):
+
+    def test_base_round_trip(self):
+        header = UDPHeader(2**32 - 1, flags=UDPFlags.DATA | UDPFlags.SACK, sack=7)
+        packed = header.pack()
+        self.assertEqual(len(packed), UDPHeader.HEADER_SIZE)
+        data, unpacked = unpack_package(packed + b"abc")
+        self.assertEqual(bytes(data), b"abc")
+        self.assertEqual(unpacked.flags, UDPFlags.DATA | UDPFlags.SACK)
+        self.assertEqual((unpacked.sequence, unpacked.sack), (2**32 - 1, 7))
+        self.assertFalse(unpacked.extended)
+
+    def test_extension_round_trip(self):
+        """The timestamps follow the base header once the extension is negotiated."""
+        header = UDPHeader(3, flags=UDPFlags.ACK, ts=1000, ts_echo=999, extended=True)
+        packed = header.pack()
+        self.assertEqual(len(packed), UDPHeader.HEADER_SIZE + UDPHeader.EXT_SIZE)
+        data, unpacked = unpack_package(packed + b"x", extended=True)
+        self.assertEqual(bytes(data), b"x")
+        self.assertEqual((unpacked.ts, unpacked.ts_echo), (1000, 999))
+        self.assertTrue(unpacked.extended)
+
+    def test_truncated_extension(self):
+        with self.assertRaises(ValueError):
+            unpack_package(UDPHeader(3, flags=UDPFlags.ACK).pack(), extended=True)
+
+    def test_start_options_round_trip(self):
+        """The START carries the path and, after a NUL, the requested options."""
+        options = {"hdr": 2, "frag": 8000, "comp": "zlib"}
+        data = encode_start("dir/file.txt", options)
+        path, decoded = decode_start(memoryview(data))
+        self.assertEqual(path, "dir/file.txt")
+        self.assertEqual(decoded, {"hdr": "2", "frag": "8000", "comp": "zlib"})
+        self.assertEqual(decode_start(encode_start("old.txt", {})), ("old.txt", {}))
+
+
+class TestHeaderSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = BaseConnection(("127.0.0.1", 9), protocol="sack")
+        self.connection.set_options({"hdr": "2", "crc": "1"})
+
+    def test_data_package_round_trip(self):
+        """The header is written in its slot and the payload is not copied."""
+        payload = memoryview(b"fragment")
+        header, data = data_package(self.connection, payload, sequence=42, slot=3)
+        self.assertIs(data, payload)
+        self.assertIs(header.obj, self.connection.header_buffer)
+        datagram = bytes(header) + bytes(data)
+        received, unpacked = unpack_package(datagram, extended=True, crc=True)
+        self.assertEqual(bytes(received), b"fragment")
+        self.assertEqual((unpacked.flags, unpacked.sequence), (UDPFlags.DATA, 42))
+
+    def test_slots_are_independent(self):
+        """A window of packages keeps one header per slot until it is sent."""
+        packages = [
+            data_package(self.connection, b"data%d" % slot, sequence=slot + 1, slot=slot)
+            for slot in range(4)
+        ]
+        for slot, (header, data) in enumerate(packages):
+            _, unpacked = unpack_package(bytes(header) + data, extended=True, crc=True)
+            self.assertEqual(unpacked.sequence, slot + 1)
+
+    def test_slot_reuse_overwrites(self):
+        """Reusing a slot rewrites the header an earlier view points to."""
+        first, _ = data_package(self.connection, b"a", sequence=1, slot=0)
+        data_package(self.connection, b"b", sequence=2, slot=0)
+        _, unpacked = unpack_package(bytes(first) + b"b", extended=True, crc=True)
+        self.assertEqual(unpacked.sequence, 2)
+
+
+class TestSendBuffers(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(("127.0.0.1", 0))
+        self.receiver.settimeout(1)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.receiver.close()
+        self.sender.close()
+
+    def test_scatter_send_is_one_datagram(self):
+        """Header and payload go out from separate buffers as a single datagram."""
+        connection = BaseConnection(("127.0.0.1", 9), protocol="sack")
+        package = data_package(connection, memoryview(b"payload"), sequence=5, slot=1)
+        send_buffers(self.sender, package, self.receiver.getsockname())
+        datagram = self.receiver.recv(MAX_HEADER_SIZE + 64)
+        data, header = unpack_package(datagram)
+        self.assertEqual((bytes(data), header.sequence), (b"payload", 5))
+
+    def test_fallback_without_sendmsg(self):
+        """Transports without sendmsg get the buffers joined."""
+        sent = []
+
+        class Transport:
+            def sendto(self, data, addr):
+                sent.append((data, addr))
+
+        send_buffers(Transport(), (memoryview(b"head"), b"body"), ("h", 1))
+        self.assertEqual(sent, [(b"headbody", ("h", 1))])
+
+
+class TestSackBitmap(unittest.TestCase):
+
+    def test_bitmap_round_trip(self):
+        """Sequences within 32 of the cumulative ACK come back in order."""
+        header = UDPHeader(100)
+        header.set_sack([132, 101, 117, 102])
+        self.assertEqual(header.get_sequences(), (100, [101, 102, 117, 132]))
+
+    def test_empty_bitmap(self):
+        header = UDPHeader(7)
+        self.assertEqual(header.get_sequences(), (7, []))
+
+
+class TestSackBlocks(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Ranges survive encoding, including sequences above 2**31."""
+        blocks = [(5, 9), (12, 12), (2**32 - 10, 2**32 - 1)]
+        data = encode_sack_blocks(blocks)
+        self.assertEqual(len(data), 8 * len(blocks))
+        self.assertEqual(decode_sack_blocks(data), blocks)
+
+    def test_network_byte_order(self):
+        self.assertEqual(encode_sack_blocks([(1, 2)]), b"\0\0\0\1\0\0\0\2")
+
+    def test_partial_block_ignored(self):
+        data = encode_sack_blocks([(1, 3)]) + b"\0\0\0"
+        self.assertEqual(decode_sack_blocks(memoryview(data)), [(1, 3)])
+
+
+
+class TestCRC(unittest.TestCase):
+
+    def test_round_trip(self):
+        header = UDPHeader(5, flags=UDPFlags.ACK, ts=1, ts_echo=2, extended=True, crc=True)
+        data, unpacked = unpack_package(header.pack(b"payload") + b"payload", True, True)
+        self.assertEqual(bytes(data), b"payload")
+        self.assertEqual((unpacked.sequence, unpacked.ts), (5, 1))
+
+    def test_pack_into_matches_pack(self):
+        """The hot path that writes headers in place checksums the same way."""
+        buffer = bytearray(MAX_HEADER_SIZE)
+        size = pack_header_into(buffer, 0, UDPFlags.DATA, 9, 0, 3, 4)
+        size = pack_crc_into(buffer, 0, size, b"data")
+        header = UDPHeader(9, UDPFlags.DATA, ts=3, ts_echo=4, extended=True, crc=True)
+        self.assertEqual(bytes(buffer[:size]), header.pack(b"data"))
+
+    def test_corruption_detected(self):
+        datagram = bytearray(UDPHeader(1, UDPFlags.DATA, crc=True).pack(b"abc") + b"abc")
+        for i in range(len(datagram)):
+            corrupted = bytearray(datagram)
+            corrupted[i] ^= 0x10
+            with self.assertRaises(ValueError):
+                unpack_package(bytes(corrupted), crc=True)
+
+    def test_start_has_no_crc(self):
+        """The START handshake is sent before the CRC is negotiated."""
+        data, header = unpack_package(UDPHeader(0, UDPFlags.START).pack() + b"x", True, True)
+        self.assertEqual(bytes(data), b"x")
+
+if __name__ == '__main__':
+    unittest.main()